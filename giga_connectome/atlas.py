@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import json
 import os
+import re
 from pathlib import Path
 from typing import Any, TypedDict
 
@@ -35,6 +36,9 @@ deprecations = {
     "Schaefer20187Networks": ("Schaefer2018", "0.7.0"),
 }
 
+# parcels of the templateflow atlases not counted in their descriptions
+N_PARCELS = {"HOCPA": 48, "HOCPAL": 96, "HOSPA": 21}
+
 
 def load_atlas_setting(
     atlas: str | Path | dict[str, Any],
@@ -98,6 +102,36 @@ def load_atlas_setting(
     }
 
 
+def get_atlas_n_parcels(
+    atlas: str | Path | dict[str, Any],
+) -> tuple[str, dict[str, int | None]]:
+    """Number of parcels of each description of an atlas, without
+    fetching it.
+
+    The number is read from the description (``100Parcels7Networks``,
+    ``64dimensions`` or ``7``), or from :data:`N_PARCELS` for the
+    templateflow atlases whose descriptions do not give it.
+
+    Parameters
+    ----------
+    atlas: str or pathlib.Path or dict
+        Atlas name, path to its configuration json file or configuration.
+
+    Returns
+    -------
+    tuple[str, dict]
+        Name of the atlas, and number of parcels by description, None if
+        unknown.
+    """
+    atlas_config = _check_altas_config(atlas)
+    known = N_PARCELS.get(atlas_config["parameters"].get("atlas", ""))
+    n_parcels: dict[str, int | None] = {}
+    for desc in atlas_config["desc"]:
+        number = re.match(r"\d+", str(desc))
+        n_parcels[str(desc)] = int(number.group()) if number else known
+    return atlas_config["name"], n_parcels
+
+
 def resample_atlas_collection(
     subject_seg_file_names: list[str],
     atlas_config: ATLAS_SETTING_TYPE,
@@ -0,0 +1,151 @@
+"""Persisted cache of the denoised voxel time series."""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any
+
+import nilearn
+import numpy as np
+
+from giga_connectome import utils
+from giga_connectome._version import __version__
+from giga_connectome.context import SubjectContext
+from giga_connectome.denoise import STRATEGY_TYPE, get_confounds_file
+from giga_connectome.logger import gc_logger
+
+gc_log = gc_logger()
+
+
+class VoxelCache:
+    """Denoised voxel time series of each run, reused across atlases.
+
+    The smoothed, masked and cleaned float32 time series of a run are
+    saved as a ``.npy`` file and memory-mapped when read again, so a
+    later run with another atlas goes straight to the parcel extraction.
+    The file name is derived from the BOLD image, its confounds, the
+    denoising strategy, the smoothing, the standardization and the
+    subject mask, but not from the atlas.
+
+    The least recently used files are removed once the cache exceeds
+    ``max_size`` bytes, and files unused for ``max_age`` seconds are
+    removed as well.
+
+    Parameters
+    ----------
+    cache_dir : pathlib.Path
+        Directory of the cache. Created if needed.
+
+    max_size : int or None
+        Maximum size of the cache in bytes. None for no limit.
+
+    max_age : float or None
+        Maximum time in seconds since a file was last used. None for no
+        limit.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str | Path,
+        max_size: int | None = None,
+        max_age: float | None = None,
+    ) -> None:
+        self.cache_dir = Path(cache_dir) / "voxels"
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.max_age = max_age
+        self.evict()
+
+    def run_path(
+        self,
+        strategy: STRATEGY_TYPE,
+        context: SubjectContext,
+        img: str,
+        smoothing_fwhm: float,
+        standardize: bool,
+    ) -> Path:
+        """Cache file of the denoised voxel time series of a run."""
+        key = hashlib.sha1(usedforsecurity=False)
+        parameters = {
+            "strategy": strategy["name"],
+            "parameters": strategy["parameters"],
+            "smoothing_fwhm": smoothing_fwhm,
+            "standardize": standardize,
+            "nilearn": nilearn.__version__,
+            "version": __version__,
+        }
+        key.update(
+            json.dumps(parameters, sort_keys=True, default=str).encode()
+        )
+        confounds_file = get_confounds_file(strategy, img)
+        sidecar = str(confounds_file).replace(".tsv", ".json")
+        for path in (img, confounds_file, sidecar):
+            key.update(utils.file_signature(path).encode())
+        # voxels of the subject mask, in order
+        key.update(np.asarray(context.mask_img.affine).tobytes())
+        key.update(str(context.mask_array.shape).encode())
+        key.update(context.voxel_indices.tobytes())
+        name = Path(img).name.split(".")[0]
+        return self.cache_dir / f"{name}_{key.hexdigest()[:16]}.npy"
+
+    def read(self, path: Path) -> np.ndarray[Any, Any] | None:
+        """Memory-map the cached time series, None if not cached."""
+        try:
+            time_series = np.load(path, mmap_mode="r")
+        except (FileNotFoundError, ValueError):
+            return None
+        # last use, for the eviction
+        os.utime(path)
+        gc_log.info(f"Denoised voxel time series read from {path.name}")
+        return time_series
+
+    def write(self, path: Path, time_series: np.ndarray[Any, Any]) -> None:
+        """Cache the time series, then evict old files if needed."""
+        with utils.atomic_path(path) as tmp_path:
+            np.save(tmp_path, np.asarray(time_series, dtype=np.float32))
+        gc_log.debug(f"Cached denoised voxel time series: {path.name}")
+        self.evict()
+
+    def evict(self) -> list[Path]:
+        """Remove the files unused for ``max_age`` seconds, then the least
+        recently used ones until the cache fits in ``max_size`` bytes.
+
+        Returns
+        -------
+        list of pathlib.Path
+            Removed files.
+        """
+        if self.max_size is None and self.max_age is None:
+            return []
+        entries = []
+        for path in self.cache_dir.glob("*.npy"):
+            # files being written
+            if ".tmp" in path.name:
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        removed = []
+        for mtime, size, path in entries:
+            too_old = self.max_age is not None and now - mtime > self.max_age
+            too_big = self.max_size is not None and total > self.max_size
+            if not (too_old or too_big):
+                continue
+            path.unlink(missing_ok=True)
+            total -= size
+            removed.append(path)
+        if removed:
+            gc_log.info(
+                f"Removed {len(removed)} files from the voxel cache, "
+                f"{total / 1e9:.2f} GB left."
+            )
+        return removed
@@ -0,0 +1,176 @@
+"""Persisted cache of the fMRIPrep confounds tables."""
+
+from __future__ import annotations
+
+import hashlib
+import json
+from collections.abc import Callable, Sequence
+from importlib.util import find_spec
+from pathlib import Path
+from typing import Any
+
+import nilearn
+import numpy as np
+import pandas as pd
+
+from giga_connectome import utils
+from giga_connectome.logger import gc_logger
+
+gc_log = gc_logger()
+
+SAMPLE_MASK_KEY = b"giga_connectome_sample_mask"
+
+
+class ConfoundsCache:
+    """Columnar copies of the confounds tables, converted once.
+
+    Each confounds TSV is converted to a parquet file the first time it
+    is read. The file name is derived from the path, modification time
+    and size of the TSV and its json sidecar, so an edited or replaced
+    input is converted again. The confounds selected by a denoising
+    strategy are cached the same way, together with the sample mask.
+
+    Parameters
+    ----------
+    cache_dir : pathlib.Path
+        Directory of the parquet files. Created if needed.
+    """
+
+    def __init__(self, cache_dir: str | Path) -> None:
+        if find_spec("pyarrow") is None:
+            raise ImportError(
+                "The confounds cache needs pyarrow. Install it with "
+                "`pip install giga_connectome[fast]`."
+            )
+        self.cache_dir = Path(cache_dir) / "confounds"
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def read_table(
+        self, confounds_file: str | Path, columns: Sequence[str] | None = None
+    ) -> pd.DataFrame:
+        """Read the full confounds table, or only some columns of it.
+
+        Parameters
+        ----------
+        confounds_file : str or pathlib.Path
+            fMRIPrep confounds TSV.
+
+        columns : list of str or None
+            Columns to read. None reads all columns.
+
+        Returns
+        -------
+        pd.DataFrame
+            Confounds table, as read by ``pd.read_csv(sep="\\t")``.
+        """
+        path = self._table_path(confounds_file)
+        if not path.exists():
+            table = pd.read_csv(confounds_file, sep="\t")
+            _write_parquet(table, path)
+            if columns is not None:
+                table = table[list(columns)]
+            return table
+        return pd.read_parquet(
+            path, columns=None if columns is None else list(columns)
+        )
+
+    def columns(self, confounds_file: str | Path) -> list[str]:
+        """Column names of the confounds table, without reading the data."""
+        import pyarrow.parquet as pq
+
+        path = self._table_path(confounds_file)
+        if not path.exists():
+            return self.read_table(confounds_file).columns.tolist()
+        return list(pq.read_schema(path).names)
+
+    def cached_function(
+        self,
+        function: Callable[..., Any],
+        get_confounds_file: Callable[[str], str | Path],
+    ) -> Callable[..., tuple[pd.DataFrame, np.ndarray[Any, Any] | None]]:
+        """Wrap a confounds loading function with the cache.
+
+        Parameters
+        ----------
+        function : Callable
+            ``load_confounds`` or ``load_confounds_strategy``.
+
+        get_confounds_file : Callable
+            Returns the confounds TSV of a BOLD image.
+
+        Returns
+        -------
+        Callable
+            Same signature and outputs as ``function``.
+        """
+
+        def cached(
+            img: str, **kwargs: Any
+        ) -> tuple[pd.DataFrame, np.ndarray[Any, Any] | None]:
+            confounds_file = get_confounds_file(img)
+            parameters = json.dumps(
+                {"function": function.__name__, **kwargs},
+                sort_keys=True,
+                default=str,
+            )
+            path = self._path(confounds_file, "strategy", parameters)
+            if path.exists():
+                return _read_strategy(path)
+            confounds, sample_mask = function(img, **kwargs)
+            _write_parquet(confounds, path, sample_mask)
+            return confounds, sample_mask
+
+        return cached
+
+    def _table_path(self, confounds_file: str | Path) -> Path:
+        return self._path(confounds_file, "table")
+
+    def _path(self, confounds_file: str | Path, *extra: str) -> Path:
+        """Cache file keyed on the confounds files and ``extra``."""
+        confounds_file = Path(confounds_file)
+        sidecar = Path(str(confounds_file).replace(".tsv", ".json"))
+        key = hashlib.sha1(usedforsecurity=False)
+        key.update(nilearn.__version__.encode())
+        for path in (confounds_file, sidecar):
+            key.update(utils.file_signature(path).encode())
+        for value in extra:
+            key.update(value.encode())
+        name = confounds_file.name.replace(".tsv", "")
+        return self.cache_dir / f"{name}_{key.hexdigest()[:16]}.parquet"
+
+
+def _write_parquet(
+    table: pd.DataFrame,
+    path: Path,
+    sample_mask: np.ndarray[Any, Any] | None = None,
+) -> None:
+    """Write atomically, so concurrent readers never see a partial file."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    arrow_table = pa.Table.from_pandas(table, preserve_index=False)
+    sample_mask_json = json.dumps(
+        None if sample_mask is None else np.asarray(sample_mask).tolist()
+    )
+    arrow_table = arrow_table.replace_schema_metadata(
+        {
+            **(arrow_table.schema.metadata or {}),
+            SAMPLE_MASK_KEY: sample_mask_json.encode(),
+        }
+    )
+    with utils.atomic_path(path) as tmp_path:
+        pq.write_table(arrow_table, tmp_path)
+    gc_log.debug(f"Cached confounds: {path.name}")
+
+
+def _read_strategy(
+    path: Path,
+) -> tuple[pd.DataFrame, np.ndarray[Any, Any] | None]:
+    import pyarrow.parquet as pq
+
+    arrow_table = pq.read_table(path)
+    sample_mask = json.loads(arrow_table.schema.metadata[SAMPLE_MASK_KEY])
+    confounds = arrow_table.to_pandas()
+    if sample_mask is None:
+        return confounds, None
+    return confounds, np.asarray(sample_mask, dtype=int)
@@ -1,13 +1,22 @@
 from __future__ import annotations
 
 from pathlib import Path
-from typing import Any
+from typing import TYPE_CHECKING, Any
 
 import numpy as np
 from nibabel import Nifti1Image
 from nilearn.connectome import ConnectivityMeasure
-from nilearn.image import load_img
-from nilearn.maskers import NiftiLabelsMasker, NiftiMasker
+from nilearn.image import get_data, load_img
+from nilearn.maskers import NiftiLabelsMasker, NiftiMapsMasker, NiftiMasker
+
+from giga_connectome.timing import StageTimer, timed
+
+if TYPE_CHECKING:
+    from giga_connectome.context import AtlasContext
+    from giga_connectome.denoise import PARCEL_CLEANER_TYPE
+
+# number of voxels of the maps multiplied at once for the Gram matrix
+GRAM_CHUNK_SIZE = 65536
 
 
 def build_size_roi(
@@ -15,6 +24,8 @@ def build_size_roi(
 ) -> np.ndarray[Any, np.dtype[Any]]:
     """Extract labels and sizes of ROIs given an atlas.
     The atlas parcels must be discrete segmentations.
+    All sizes are counted in one pass over the labels with
+    :func:`numpy.bincount`.
 
     Adapted from:
     https://github.com/SIMEXP/niak/blob/master/commands/SI_processing/niak_build_size_roi.m
@@ -35,15 +46,48 @@ def build_size_roi(
     np.ndarray
         An array containing the sizes of the ROIs.
     """
-    nb_roi = len(region_ids)
-    size_roi = np.zeros([nb_roi, 1])
+    labels = np.asarray(mask).ravel().astype(int)
+    counts = np.bincount(labels[labels >= 0])
+    positions = np.array([int(num_r) for num_r in region_ids], dtype=int)
+    region_labels = np.array(
+        [int(region_ids[num_r]) for num_r in region_ids], dtype=int
+    )
+    valid = (region_labels >= 0) & (region_labels < counts.shape[0])
 
-    for num_r in region_ids:
-        size_roi[int(num_r)] = np.count_nonzero(mask == int(region_ids[num_r]))
+    size_roi = np.zeros([len(region_ids), 1])
+    size_roi[positions[valid], 0] = counts[region_labels[valid]]
 
     return size_roi
 
 
+def maps_gram(maps: np.ndarray[Any, Any]) -> np.ndarray[Any, Any]:
+    """Gram matrix of probabilistic maps, voxel chunk by voxel chunk.
+
+    Each chunk is multiplied in float32 and only the small parcels by
+    parcels product is accumulated in float64, so the maps are never
+    copied as a whole field of view.
+
+    Parameters
+    ----------
+    maps : np.ndarray
+        Voxels by parcels array of the map weights.
+
+    Returns
+    -------
+    np.ndarray
+        Parcels by parcels Gram matrix, in float64.
+    """
+    gram = np.zeros((maps.shape[1], maps.shape[1]))
+    for start in range(0, maps.shape[0], GRAM_CHUNK_SIZE):
+        chunk = np.asarray(
+            maps[start : start + GRAM_CHUNK_SIZE], dtype=np.float32
+        )
+        # most of the field of view is outside every map
+        chunk = chunk[chunk.any(axis=1)]
+        gram += chunk.T @ chunk
+    return gram
+
+
 def calculate_intranetwork_correlation(
     correlation_matrix: np.ndarray[Any, Any],
     region_ids: dict[str | int, int | float],
@@ -52,7 +96,8 @@ def calculate_intranetwork_correlation(
     atlas_image: str | Path | Nifti1Image,
 ) -> tuple[np.ndarray[Any, Any], np.ndarray[Any, Any]]:
     """Calculate the average functional correlation within each parcel.
-    Currently we only support discrete segmentations.
+    For probabilistic maps, the correlations are weighted by the map
+    values, see :func:`weighted_intranetwork_correlation`.
 
     Parameters
     ----------
@@ -69,7 +114,7 @@ def calculate_intranetwork_correlation(
         The group grey matter mask.
 
     atlas_image : str | Path | Nifti1Image
-        3D atlas image.
+        3D discrete segmentation or 4D probabilistic maps.
 
     Returns
     -------
@@ -83,25 +128,117 @@ def calculate_intranetwork_correlation(
         atlas_image = load_img(atlas_image)
 
     if len(atlas_image.shape) > 3:
-        raise NotImplementedError("Only support 3D discrete segmentations.")
+        # the maps masker fits the maps over the whole field of view, so
+        # the weighted sums within the mask are recovered from the time
+        # series through the Gram matrix of the maps
+        atlas_data = get_data(atlas_image)
+        gram = maps_gram(atlas_data.reshape(-1, atlas_data.shape[-1]))
+        weights = NiftiMasker(
+            standardize=None, mask_img=group_mask
+        ).fit_transform(atlas_image)
+        return weighted_intranetwork_correlation(
+            correlation_matrix,
+            time_series_atlas @ gram,
+            weight_sum=weights.sum(axis=1),
+            weight_sum_squares=(weights**2).sum(axis=1),
+        )
 
     # flatten the atlas label image to a vertical vector
     atlas_voxel_flatten = NiftiMasker(
         standardize=None, mask_img=group_mask
     ).fit_transform(atlas_image)
     size_parcels = build_size_roi(atlas_voxel_flatten, region_ids)
-    # calculate the standard deviation of time series in each parcel
-    var_parcels = time_series_atlas.var(axis=0)
-    var_parcels = np.reshape(var_parcels, (var_parcels.shape[0], 1))
-    # detect invalid parcels
-    mask_empty = (size_parcels == 0) | (size_parcels == 1)
+    return average_intranetwork_correlation(
+        correlation_matrix, time_series_atlas, size_parcels
+    )
+
+
+def average_intranetwork_correlation(
+    correlation_matrix: np.ndarray[Any, Any],
+    time_series_atlas: np.ndarray[Any, Any],
+    size_parcels: np.ndarray[Any, Any],
+) -> tuple[np.ndarray[Any, Any], np.ndarray[Any, Any]]:
+    """Average functional correlation within each parcel from parcel sizes.
+
+    See :func:`calculate_intranetwork_correlation`.
+
+    Parameters
+    ----------
+    correlation_matrix : np.array
+        N by N Pearson's correlation matrix.
+
+    time_series_atlas : np.array
+        Time series extracted from each parcel.
+
+    size_parcels : np.array
+        Number of voxels of each parcel within the group mask, as a
+        column vector.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        The correlation matrix with the diagonal replaced by the average
+        correlation within each parcel, and the average correlations.
+    """
+    # the parcel average of n voxels is a sum of n unit weights
+    weighted_sums = time_series_atlas * size_parcels.reshape(1, -1)
+    return weighted_intranetwork_correlation(
+        correlation_matrix,
+        weighted_sums,
+        weight_sum=size_parcels,
+        weight_sum_squares=size_parcels,
+    )
+
+
+def weighted_intranetwork_correlation(
+    correlation_matrix: np.ndarray[Any, Any],
+    weighted_sums: np.ndarray[Any, Any],
+    weight_sum: np.ndarray[Any, Any],
+    weight_sum_squares: np.ndarray[Any, Any],
+) -> tuple[np.ndarray[Any, Any], np.ndarray[Any, Any]]:
+    """Weighted average functional correlation within each parcel.
+
+    For a parcel with voxel weights w_i and standardised voxel time
+    series x_i, var(sum_i w_i x_i) = sum_i w_i^2 + sum_(i!=j) w_i w_j r_ij.
+    The average of r_ij weighted by w_i w_j is therefore
+    (var - sum_i w_i^2) / ((sum_i w_i)^2 - sum_i w_i^2), which only needs
+    the parcel level variance and two statistics of the weights, never a
+    voxel by voxel correlation. With unit weights this is the discrete
+    segmentation case of :func:`calculate_intranetwork_correlation`.
+
+    Parameters
+    ----------
+    correlation_matrix : np.array
+        N by N Pearson's correlation matrix.
+
+    weighted_sums : np.array
+        Time by N array of the weighted sums of the voxel time series.
+
+    weight_sum : np.array
+        Sum of the weights of each parcel.
+
+    weight_sum_squares : np.array
+        Sum of the squared weights of each parcel.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        The correlation matrix with the diagonal replaced by the average
+        correlation within each parcel, and the average correlations.
+    """
+    weight_sum = np.reshape(weight_sum, -1)
+    weight_sum_squares = np.reshape(weight_sum_squares, -1)
+    # calculate the variance of the weighted sums in each parcel
+    var_parcels = weighted_sums.var(axis=0)
+    denominator = weight_sum * weight_sum - weight_sum_squares
+    # detect invalid parcels: empty or single voxel
+    mask_empty = ~(denominator > 0)
 
     # calculate average functional correlation within each parcel
-    avg_intranetwork_correlation = (
-        (size_parcels * size_parcels) * var_parcels - size_parcels
-    ) / (size_parcels * (size_parcels - 1))
-    avg_intranetwork_correlation[mask_empty] = 0
-    avg_intranetwork_correlation = avg_intranetwork_correlation.reshape(-1)
+    avg_intranetwork_correlation = np.zeros(var_parcels.shape[0])
+    avg_intranetwork_correlation[~mask_empty] = (
+        var_parcels[~mask_empty] - weight_sum_squares[~mask_empty]
+    ) / denominator[~mask_empty]
     # replace the diagonal with average functional correlation
     idx_diag = np.diag_indices(correlation_matrix.shape[0])
     correlation_matrix[idx_diag] = avg_intranetwork_correlation
@@ -109,12 +246,16 @@ def calculate_intranetwork_correlation(
 
 
 def generate_timeseries_connectomes(
-    masker: NiftiLabelsMasker,
+    masker: NiftiLabelsMasker | NiftiMapsMasker,
     denoised_img: Nifti1Image,
-    group_mask: str | Path,
+    group_mask: str | Path | Nifti1Image,
     correlation_measure: ConnectivityMeasure,
     calculate_average_correlation: bool,
-) -> tuple[np.ndarray[Any, Any], np.ndarray[Any, Any], NiftiLabelsMasker]:
+) -> tuple[
+    np.ndarray[Any, Any],
+    np.ndarray[Any, Any],
+    NiftiLabelsMasker | NiftiMapsMasker,
+]:
     """Generate timeseries-based connectomes from functional data.
 
     Parameters
@@ -125,8 +266,8 @@ def generate_timeseries_connectomes(
     denoised_img : Nifti1Image
         Denoised functional image.
 
-    group_mask : str | Path
-        Path to the group grey matter mask.
+    group_mask : str | Path | Nifti1Image
+        Group grey matter mask or its path.
 
     correlation_measure : ConnectivityMeasure
         Connectivity measure for computing correlations.
@@ -143,9 +284,16 @@ def generate_timeseries_connectomes(
     correlation_matrix = correlation_measure.fit_transform(
         [time_series_atlas]
     )[0]
-    region_ids = masker.region_ids_
-    if "background" in region_ids:
-        region_ids.pop("background")
+    if isinstance(masker, NiftiMapsMasker):
+        atlas_image = masker.maps_img_
+        region_ids: dict[str | int, int | float] = {
+            i: i + 1 for i in range(time_series_atlas.shape[1])
+        }
+    else:
+        atlas_image = masker.labels_img_
+        region_ids = masker.region_ids_
+        if "background" in region_ids:
+            region_ids.pop("background")
     # average correlation within each parcel
     if calculate_average_correlation:
         (
@@ -156,9 +304,79 @@ def generate_timeseries_connectomes(
             region_ids,
             time_series_atlas,
             group_mask,
-            masker.labels_img_,
+            atlas_image,
         )
     # convert to float 32 instead of 64
     time_series_atlas = time_series_atlas.astype(np.float32)
     correlation_matrix = correlation_matrix.astype(np.float32)
     return correlation_matrix, time_series_atlas, masker
+
+
+def extract_timeseries_connectomes(
+    atlas_context: AtlasContext,
+    time_series_voxel: np.ndarray[Any, Any],
+    correlation_measure: ConnectivityMeasure,
+    calculate_average_correlation: bool,
+    parcel_cleaner: PARCEL_CLEANER_TYPE | None = None,
+    timer: StageTimer | None = None,
+) -> tuple[np.ndarray[Any, Any], np.ndarray[Any, Any]]:
+    """Generate timeseries-based connectomes from denoised voxel data.
+
+    Same outputs as :func:`generate_timeseries_connectomes`, using the
+    atlas matrices precompiled for the subject instead of refitting a
+    masker on a denoised image.
+
+    Parameters
+    ----------
+    atlas_context : AtlasContext
+        Atlas precompiled on the subject mask. \
+        See :func:`giga_connectome.context.build_subject_context`.
+
+    time_series_voxel : np.ndarray
+        Denoised voxel time series (time by voxels in the subject mask).
+
+    correlation_measure : ConnectivityMeasure
+        Connectivity measure for computing correlations.
+
+    calculate_average_correlation : bool
+        Flag indicating whether to calculate average parcel correlations.
+
+    parcel_cleaner : Callable or None
+        When denoising after extraction, cleaning step applied to the \
+        parcel time series extracted from the raw voxel time series. \
+        See :func:`giga_connectome.denoise.prepare_parcel_denoising`.
+
+    timer : StageTimer or None
+        Records the ``extraction`` and ``correlation`` stages.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        A tuple containing the correlation matrix and time series atlas.
+    """
+    if parcel_cleaner is not None and calculate_average_correlation:
+        raise ValueError(
+            "The average intranetwork correlation needs voxel level denoising."
+        )
+    with timed(timer, "extraction"):
+        weighted_sums = atlas_context.weighted_sums(time_series_voxel)
+        time_series_atlas = atlas_context.project(weighted_sums)
+        if parcel_cleaner is not None:
+            time_series_atlas = parcel_cleaner(time_series_atlas)
+    with timed(timer, "correlation"):
+        correlation_matrix = correlation_measure.fit_transform(
+            [time_series_atlas]
+        )[0]
+        if calculate_average_correlation:
+            # the weighted sums cover the voxels of each parcel within the
+            # mask, no other pass over the voxels is needed
+            correlation_matrix, _ = weighted_intranetwork_correlation(
+                correlation_matrix,
+                weighted_sums,
+                atlas_context.weight_sum,
+                atlas_context.weight_sum_squares,
+            )
+    # convert to float 32 instead of 64
+    time_series_atlas = time_series_atlas.astype(np.float32)
+    correlation_matrix = correlation_matrix.astype(np.float32)
+    return correlation_matrix, time_series_atlas
@@ -0,0 +1,304 @@
+"""Per-subject extraction context shared by all runs of a subject."""
+
+from __future__ import annotations
+
+from collections.abc import Sequence
+from dataclasses import dataclass, field
+from functools import cached_property
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+from nibabel import Nifti1Image
+from nilearn.image import get_data, load_img
+from nilearn.maskers import NiftiLabelsMasker, NiftiMapsMasker
+from scipy.sparse import csr_matrix
+
+from giga_connectome.connectome import build_size_roi, maps_gram
+from giga_connectome.logger import gc_logger
+
+gc_log = gc_logger()
+
+
+@dataclass
+class AtlasContext:
+    """Precompiled atlas matrices on the voxels of the subject mask.
+
+    Parcel signals are computed from the masked voxel time series
+    ``X`` (time by voxels) as ``(X @ weights) * scale`` for discrete
+    segmentations and ``(X @ weights) @ projector`` for probabilistic
+    maps. Both reproduce the nilearn label and maps maskers applied to
+    a denoised image that is zero outside of the subject mask.
+
+    Attributes
+    ----------
+    seg : str
+        Value of the ``seg`` entity of the resampled atlas file.
+
+    atlas_type : str
+        ``"dseg"`` or ``"probseg"``.
+
+    masker : NiftiLabelsMasker or NiftiMapsMasker
+        Masker fitted once on the subject mask. Only used for reports.
+
+    region_ids : dict[str | int, int | float]
+        Parcel index to atlas label. Background is not included.
+
+    weights : scipy.sparse.csr_matrix
+        Voxels in the subject mask by parcels. Membership for discrete
+        segmentations, map values for probabilistic atlases.
+
+    scale : np.ndarray or None
+        Discrete segmentations only: one over the number of voxels of
+        each parcel in the atlas field of view.
+
+    projector : np.ndarray or None
+        Probabilistic atlases only: pseudo-inverse of the Gram matrix of
+        the maps over the atlas field of view.
+
+    size_parcels : np.ndarray or None
+        Discrete segmentations only: number of voxels of each parcel
+        within the subject mask, as a column vector.
+
+    weight_sum : np.ndarray
+        Sum of the weights of each parcel within the subject mask.
+
+    weight_sum_squares : np.ndarray
+        Sum of the squared weights of each parcel within the subject mask.
+    """
+
+    seg: str
+    atlas_type: str
+    masker: NiftiLabelsMasker | NiftiMapsMasker
+    region_ids: dict[str | int, int | float]
+    weights: csr_matrix
+    scale: np.ndarray[Any, Any] | None = None
+    projector: np.ndarray[Any, Any] | None = None
+    size_parcels: np.ndarray[Any, Any] | None = None
+    weight_sum: np.ndarray[Any, Any] = field(init=False)
+    weight_sum_squares: np.ndarray[Any, Any] = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.weight_sum = np.asarray(self.weights.sum(axis=0)).ravel()
+        self.weight_sum_squares = np.asarray(
+            self.weights.multiply(self.weights).sum(axis=0)
+        ).ravel()
+
+    @property
+    def n_parcels(self) -> int:
+        return int(self.weights.shape[1])
+
+    def transform(
+        self, time_series_voxel: np.ndarray[Any, Any]
+    ) -> np.ndarray[Any, Any]:
+        """Extract parcel time series from masked voxel time series.
+
+        Parameters
+        ----------
+        time_series_voxel : np.ndarray
+            Time by voxels array, voxels ordered as in the subject mask.
+
+        Returns
+        -------
+        np.ndarray
+            Time by parcels array.
+        """
+        return self.project(self.weighted_sums(time_series_voxel))
+
+    def weighted_sums(
+        self, time_series_voxel: np.ndarray[Any, Any]
+    ) -> np.ndarray[Any, Any]:
+        """Sum the voxel time series of each parcel, weighted by the atlas.
+
+        This is the only step touching voxel level data.
+        """
+        return np.asarray(
+            self.weights.T.dot(
+                np.asarray(time_series_voxel, dtype=np.float64).T
+            ).T
+        )
+
+    def project(
+        self, weighted_sums: np.ndarray[Any, Any]
+    ) -> np.ndarray[Any, Any]:
+        """Turn weighted sums into the parcel signals of nilearn maskers."""
+        if self.projector is not None:
+            return weighted_sums @ self.projector
+        return weighted_sums * self.scale
+
+
+@dataclass
+class SubjectContext:
+    """Subject level data loaded once and reused for every run.
+
+    Attributes
+    ----------
+    mask_img : Nifti1Image
+        Subject grey matter mask.
+
+    mask_array : np.ndarray
+        Boolean array of the subject grey matter mask.
+
+    voxel_indices : np.ndarray
+        Flat (C order) indices of the voxels in the subject mask.
+
+    atlases : dict[str, AtlasContext]
+        Precompiled atlases, keyed by the ``seg`` entity.
+    """
+
+    mask_img: Nifti1Image
+    mask_array: np.ndarray[Any, Any]
+    voxel_indices: np.ndarray[Any, Any]
+    atlases: dict[str, AtlasContext] = field(default_factory=dict)
+    _box_indices: dict[tuple[int, ...], np.ndarray[Any, Any]] = field(
+        default_factory=dict, init=False, repr=False
+    )
+
+    @property
+    def n_voxels(self) -> int:
+        return int(self.voxel_indices.shape[0])
+
+    def bounding_box(
+        self, margin: Sequence[int] = (0, 0, 0)
+    ) -> tuple[slice, ...]:
+        """Bounding box of the subject mask, padded by ``margin`` voxels
+        along each axis and clipped to the field of view.
+        """
+        return tuple(
+            slice(max(start - pad, 0), min(stop + pad, size))
+            for (start, stop), pad, size in zip(
+                self._mask_bounds, margin, self.mask_array.shape, strict=True
+            )
+        )
+
+    @cached_property
+    def _mask_bounds(self) -> list[tuple[int, int]]:
+        """Start and stop of the subject mask along each axis."""
+        bounds = []
+        for axis in range(self.mask_array.ndim):
+            other_axes = tuple(
+                i for i in range(self.mask_array.ndim) if i != axis
+            )
+            in_mask = np.flatnonzero(self.mask_array.any(axis=other_axes))
+            bounds.append((int(in_mask[0]), int(in_mask[-1]) + 1))
+        return bounds
+
+    def apply_mask(
+        self,
+        data: np.ndarray[Any, Any],
+        box: tuple[slice, ...] | None = None,
+    ) -> np.ndarray[Any, Any]:
+        """Mask 4D data to a time by voxels array.
+
+        Equivalent to :func:`nilearn.masking.apply_mask` with the subject
+        mask, without reloading or checking the mask. ``data`` is the
+        field of view, or its crop to ``box`` when given.
+        """
+        n_volumes = data.shape[-1]
+        if box is None:
+            indices = self.voxel_indices
+        else:
+            key = tuple(bound for s in box for bound in (s.start, s.stop))
+            if key not in self._box_indices:
+                self._box_indices[key] = np.flatnonzero(self.mask_array[box])
+            indices = self._box_indices[key]
+        return data.reshape(-1, n_volumes)[indices].T
+
+
+def build_subject_context(
+    group_mask: str | Path | Nifti1Image,
+    resampled_atlases: Sequence[str | Path],
+) -> SubjectContext:
+    """Load the subject mask and precompile all atlases on it.
+
+    Parameters
+    ----------
+    group_mask : str or pathlib.Path or Nifti1Image
+        Subject grey matter mask.
+
+    resampled_atlases : list of str or pathlib.Path
+        Atlas niftis resampled to the subject grey matter mask.
+
+    Returns
+    -------
+    SubjectContext
+        Context to pass to the denoising and extraction steps.
+    """
+    mask_img = load_img(group_mask)
+    mask_array = get_data(mask_img).astype(bool)
+    context = SubjectContext(
+        mask_img=mask_img,
+        mask_array=mask_array,
+        voxel_indices=np.flatnonzero(mask_array),
+    )
+    for atlas_path in resampled_atlases:
+        atlas_path = Path(atlas_path)
+        seg = atlas_path.name.split("seg-")[-1].split("_")[0]
+        context.atlases[seg] = _build_atlas_context(seg, atlas_path, context)
+    gc_log.debug(
+        f"Subject context: {context.n_voxels} voxels, "
+        f"{len(context.atlases)} atlases."
+    )
+    return context
+
+
+def _build_atlas_context(
+    seg: str, atlas_path: Path, context: SubjectContext
+) -> AtlasContext:
+    """Fit the masker once and compute the extraction matrices."""
+    atlas_type = atlas_path.name.split("_")[-1].split(".nii")[0]
+    atlas_img = load_img(atlas_path)
+    atlas_data = get_data(atlas_img)
+    if atlas_type == "dseg":
+        masker = NiftiLabelsMasker(
+            labels_img=atlas_img,
+            standardize=False,
+            cmap="gray",
+        ).fit(context.mask_img)
+        region_ids = dict(masker.region_ids_)
+        region_ids.pop("background", None)
+        labels = np.array(list(region_ids.values()))
+        # voxels per parcel across the atlas field of view; the masker
+        # averages over these, outside of the mask included
+        labels_fov, count_fov = np.unique(atlas_data, return_counts=True)
+        scale = 1.0 / count_fov[np.searchsorted(labels_fov, labels)]
+
+        labels_voxel = atlas_data.ravel()[context.voxel_indices]
+        in_parcel = np.isin(labels_voxel, labels)
+        rows = np.flatnonzero(in_parcel)
+        order = np.argsort(labels)
+        cols = order[np.searchsorted(labels[order], labels_voxel[in_parcel])]
+        weights = csr_matrix(
+            (np.ones(rows.shape[0]), (rows, cols)),
+            shape=(context.n_voxels, labels.shape[0]),
+        )
+        # computed once per subject and atlas, reused by every run
+        size_parcels = build_size_roi(labels_voxel, region_ids)
+        return AtlasContext(
+            seg=seg,
+            atlas_type=atlas_type,
+            masker=masker,
+            region_ids=region_ids,
+            weights=weights,
+            scale=scale,
+            size_parcels=size_parcels,
+        )
+
+    masker = NiftiMapsMasker(
+        maps_img=atlas_img,
+        standardize=False,
+        cmap="gray",
+    ).fit(context.mask_img)
+    maps = atlas_data.reshape(-1, atlas_data.shape[-1])
+    region_ids = {i: i + 1 for i in range(maps.shape[1])}
+    # the maps masker solves a least square problem over the whole field
+    # of view, which reduces to the Gram matrix of the maps
+    gram = maps_gram(maps)
+    return AtlasContext(
+        seg=seg,
+        atlas_type=atlas_type,
+        masker=masker,
+        region_ids=region_ids,
+        weights=csr_matrix(maps[context.voxel_indices]),
+        projector=np.linalg.pinv(gram, hermitian=True),
+    )
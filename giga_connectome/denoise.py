@@ -2,17 +2,34 @@ from __future__ import annotations
 
 import json
 from collections.abc import Callable
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, TypedDict
+from typing import TYPE_CHECKING, Any, TypedDict
 
 import numpy as np
 import pandas as pd
 from nibabel import Nifti1Image
+from nilearn.image import resample_img
 from nilearn.interfaces import fmriprep
 from nilearn.interfaces.fmriprep import load_confounds_utils as lc_utils
 from nilearn.maskers import NiftiMasker
+from nilearn.signal import clean
 
 from giga_connectome.data import DATA_DIR
+from giga_connectome.loader import open_bold, read_bold_box, same_grid
+from giga_connectome.logger import gc_logger
+from giga_connectome.smoothing import (
+    fwhm_to_sigma,
+    kernel_radius,
+    smooth_volumes,
+)
+from giga_connectome.timing import StageTimer, timed
+
+if TYPE_CHECKING:
+    from giga_connectome.confounds import ConfoundsCache
+    from giga_connectome.context import SubjectContext
+
+gc_log = gc_logger()
 
 PRESET_STRATEGIES = [
     "simple",
@@ -43,6 +60,35 @@ class STRATEGY_TYPE(TypedDict):
     parameters: dict[str, str | list[str]]
 
 
+PARCEL_CLEANER_TYPE = Callable[[np.ndarray[Any, Any]], np.ndarray[Any, Any]]
+
+
+@dataclass
+class LoadedRun:
+    """BOLD data and confounds of a run, read by :func:`load_run`.
+
+    Attributes
+    ----------
+    data : np.ndarray
+        Bounding box of the subject mask, padded by the radius of the
+        smoothing kernel, of the volumes kept by the sample mask.
+
+    box : tuple of slice
+        Position of ``data`` in the field of view of the subject mask.
+
+    sigma : np.ndarray or None
+        Width of the smoothing kernel in voxels, None without smoothing.
+
+    confounds : pd.DataFrame
+        Confounds of the volumes kept by the sample mask.
+    """
+
+    data: np.ndarray[Any, Any]
+    box: tuple[slice, ...]
+    sigma: np.ndarray[Any, Any] | None
+    confounds: pd.DataFrame
+
+
 class METADATA_TYPE(TypedDict):
     ConfoundRegressors: list[str]
     ICAAROMANoiseComponents: list[str]
@@ -112,7 +158,50 @@ def is_ica_aroma(strategy: STRATEGY_TYPE) -> bool:
         raise ValueError(f"Invalid input dictionary. {strategy['parameters']}")
 
 
-def denoise_meta_data(strategy: STRATEGY_TYPE, img: str) -> METADATA_TYPE:
+def get_confounds_file(strategy: STRATEGY_TYPE, img: str) -> Path:
+    """Path of the fMRIPrep confounds TSV of an image for a strategy."""
+    return Path(
+        lc_utils.get_confounds_file(
+            img, flag_full_aroma=is_ica_aroma(strategy), flag_tedana=False
+        )
+    )
+
+
+def cache_strategy(
+    strategy: STRATEGY_TYPE, confounds_cache: ConfoundsCache
+) -> STRATEGY_TYPE:
+    """Load the confounds of a strategy through the confounds cache.
+
+    Parameters
+    ----------
+    strategy : dict
+        Denoising strategy dictionary. See :func:`get_denoise_strategy`.
+    confounds_cache : ConfoundsCache
+        See :class:`giga_connectome.confounds.ConfoundsCache`.
+
+    Returns
+    -------
+    dict
+        Denoising strategy with a cached confounds loading function.
+    """
+
+    def confounds_file(img: str) -> str:
+        return str(get_confounds_file(strategy, img))
+
+    return {
+        "name": strategy["name"],
+        "function": confounds_cache.cached_function(
+            strategy["function"], confounds_file
+        ),
+        "parameters": strategy["parameters"],
+    }
+
+
+def denoise_meta_data(
+    strategy: STRATEGY_TYPE,
+    img: str,
+    confounds_cache: ConfoundsCache | None = None,
+) -> METADATA_TYPE:
     """Get metadata of the denoising process.
 
     Including: column names of the confound regressors, number of
@@ -127,6 +216,9 @@ def denoise_meta_data(strategy: STRATEGY_TYPE, img: str) -> METADATA_TYPE:
         or load_confounds.
     img : str
         Path to the nifti image to denoise.
+    confounds_cache : ConfoundsCache or None
+        Read the full confounds table from the cache, only the framewise
+        displacement column is loaded.
 
     Returns
     -------
@@ -140,7 +232,13 @@ def denoise_meta_data(strategy: STRATEGY_TYPE, img: str) -> METADATA_TYPE:
         # TODO adapt for tedana?
         flag_tedana=False,
     )
-    cf_full = pd.read_csv(cf_file, sep="\t")
+    if confounds_cache is None:
+        cf_full = pd.read_csv(cf_file, sep="\t")
+    else:
+        # other columns are only needed by name
+        cf_full = confounds_cache.read_table(
+            cf_file, ["framewise_displacement"]
+        ).reindex(columns=confounds_cache.columns(cf_file))
     framewise_displacement = cf_full["framewise_displacement"]
     mean_fd = np.mean(framewise_displacement)
     # get non steady state volumes
@@ -170,7 +268,7 @@ def denoise_meta_data(strategy: STRATEGY_TYPE, img: str) -> METADATA_TYPE:
 
 def denoise_nifti_voxel(
     strategy: STRATEGY_TYPE,
-    group_mask: str | Path,
+    group_mask: str | Path | Nifti1Image,
     standardize: bool,
     smoothing_fwhm: float,
     img: str,
@@ -181,8 +279,8 @@ def denoise_nifti_voxel(
     ----------
     strategy : dict
         Denoising strategy parameter to pass to load_confounds_strategy.
-    group_mask : str | Path
-        Path to the group mask.
+    group_mask : str | Path | Nifti1Image
+        Group mask or its path.
     standardize : bool
         Standardize the data. If True, zscore the data. If False, do \
             not standardize.
@@ -216,6 +314,333 @@ def denoise_nifti_voxel(
     return denoised_img
 
 
+def denoise_voxel_timeseries(
+    strategy: STRATEGY_TYPE,
+    context: SubjectContext,
+    standardize: bool,
+    smoothing_fwhm: float,
+    img: str,
+    n_jobs: int = 1,
+) -> np.ndarray[Any, Any] | None:
+    """Denoise voxel level data per nifti image with a subject context.
+
+    Same processing as :func:`denoise_nifti_voxel`, but the subject mask
+    is taken from the precompiled context and the denoised data are
+    returned as a time by voxels array, without creating a masker or
+    an image for every run.
+
+    Parameters
+    ----------
+    strategy : dict
+        Denoising strategy parameter to pass to load_confounds_strategy.
+    context : SubjectContext
+        Subject context. \
+            See :func:`giga_connectome.context.build_subject_context`.
+    standardize : bool
+        Standardize the data. If True, zscore the data. If False, do \
+            not standardize.
+    smoothing_fwhm : float
+        Smoothing kernel size in mm.
+    img : str
+        Path to the nifti image to denoise.
+    n_jobs : int
+        Number of threads used for spatial smoothing.
+
+    Returns
+    -------
+    np.ndarray
+        Denoised time series of the voxels in the subject mask.
+    """
+    run = load_run(strategy, context, smoothing_fwhm, img)
+    if run is None:
+        return None
+    return denoise_loaded_run(run, context, standardize, n_jobs)
+
+
+def load_run(
+    strategy: STRATEGY_TYPE,
+    context: SubjectContext,
+    smoothing_fwhm: float,
+    img: str,
+    timer: StageTimer | None = None,
+) -> LoadedRun | None:
+    """Read the confounds and the BOLD data of a run, before denoising.
+
+    Only input and decompression, so the next run can be loaded in a
+    background thread while the current one is denoised. Censored
+    volumes are never read.
+
+    Parameters
+    ----------
+    strategy : dict
+        Denoising strategy parameter to pass to load_confounds_strategy.
+    context : SubjectContext
+        Subject context. \
+            See :func:`giga_connectome.context.build_subject_context`.
+    smoothing_fwhm : float
+        Smoothing kernel size in mm, to pad the bounding box of the mask.
+    img : str
+        Path to the nifti image.
+    timer : StageTimer or None
+        Records the ``confounds`` and ``bold_load`` stages.
+
+    Returns
+    -------
+    LoadedRun or None
+        None if the image cannot be denoised.
+    """
+    with timed(timer, "confounds"):
+        cf, sm = strategy["function"](img, **strategy["parameters"])
+    if _check_exclusion(cf, sm):
+        return None
+    with timed(timer, "bold_load"):
+        data, box, sigma = _read_box(context, smoothing_fwhm, img, sm)
+    return LoadedRun(data, box, sigma, censor_confounds(cf, sm))
+
+
+def denoise_loaded_run(
+    run: LoadedRun,
+    context: SubjectContext,
+    standardize: bool,
+    n_jobs: int = 1,
+    timer: StageTimer | None = None,
+) -> np.ndarray[Any, Any]:
+    """Smooth, mask and clean a run from :func:`load_run`.
+
+    The data of the run are smoothed in place.
+
+    Parameters
+    ----------
+    run : LoadedRun
+        BOLD data and confounds of the run.
+    context : SubjectContext
+        Subject context. \
+            See :func:`giga_connectome.context.build_subject_context`.
+    standardize : bool
+        Standardize the data. If True, zscore the data.
+    n_jobs : int
+        Number of threads used for spatial smoothing.
+    timer : StageTimer or None
+        Records the ``smoothing`` (and masking) and ``cleaning`` stages.
+
+    Returns
+    -------
+    np.ndarray
+        Denoised time series of the voxels in the subject mask.
+    """
+    with timed(timer, "smoothing"):
+        time_series_voxel = _mask_box(
+            context, run.data, run.box, run.sigma, n_jobs
+        )
+    with timed(timer, "cleaning"):
+        return clean_timeseries(
+            time_series_voxel, run.confounds, None, standardize
+        )
+
+
+def prepare_parcel_denoising(
+    strategy: STRATEGY_TYPE,
+    context: SubjectContext,
+    standardize: bool,
+    img: str,
+) -> tuple[np.ndarray[Any, Any], PARCEL_CLEANER_TYPE] | None:
+    """Load raw voxel data and the cleaning step to run after extraction.
+
+    Detrending, confound regression and standardization are linear in
+    the signal, so without spatial smoothing they commute with parcel
+    averaging, up to the final standardization. Cleaning the parcel
+    time series instead of the voxels replaces a regression on every
+    voxel by a regression on a few hundred parcels.
+
+    Parameters
+    ----------
+    strategy : dict
+        Denoising strategy parameter to pass to load_confounds_strategy.
+    context : SubjectContext
+        Subject context. \
+            See :func:`giga_connectome.context.build_subject_context`.
+    standardize : bool
+        Standardize the parcel time series.
+    img : str
+        Path to the nifti image to denoise.
+
+    Returns
+    -------
+    tuple[np.ndarray, Callable] or None
+        Raw time series of the voxels in the subject mask, and the
+        function to clean the parcel time series extracted from them.
+        None if the image cannot be denoised.
+    """
+    run = load_run(strategy, context, 0.0, img)
+    if run is None:
+        return None
+    return prepare_parcel_cleaner(run, context, standardize)
+
+
+def prepare_parcel_cleaner(
+    run: LoadedRun, context: SubjectContext, standardize: bool
+) -> tuple[np.ndarray[Any, Any], PARCEL_CLEANER_TYPE]:
+    """Raw voxel time series and parcel cleaning step of a run from
+    :func:`load_run`, loaded without smoothing.
+    See :func:`prepare_parcel_denoising`.
+    """
+    time_series_voxel = _mask_box(context, run.data, run.box, None)
+    cf = run.confounds
+
+    def parcel_cleaner(
+        time_series_atlas: np.ndarray[Any, Any],
+    ) -> np.ndarray[Any, Any]:
+        return clean_timeseries(time_series_atlas, cf, None, standardize)
+
+    return time_series_voxel, parcel_cleaner
+
+
+def load_voxel_timeseries(
+    context: SubjectContext,
+    smoothing_fwhm: float,
+    img: str,
+    n_jobs: int = 1,
+    volumes: np.ndarray[Any, Any] | None = None,
+) -> np.ndarray[Any, Any]:
+    """Load a nifti image as time series of the voxels in the subject mask.
+
+    Only the bounding box of the subject mask is read. With smoothing,
+    the box is padded by the radius of the kernel so that the values in
+    the mask are the same as smoothing the whole field of view.
+
+    Smoothing is spatial only and the cleaning steps censor the volumes
+    before detrending, so reading only the volumes kept by the sample
+    mask gives the same denoised time series.
+
+    Parameters
+    ----------
+    context : SubjectContext
+        Subject context. \
+            See :func:`giga_connectome.context.build_subject_context`.
+    smoothing_fwhm : float
+        Smoothing kernel size in mm.
+    img : str
+        Path to the nifti image.
+    n_jobs : int
+        Number of threads used for spatial smoothing.
+    volumes : np.ndarray or None
+        Sample mask of the denoising strategy. Only these volumes are
+        read. None reads all volumes.
+
+    Returns
+    -------
+    np.ndarray
+        Time by voxels array.
+    """
+    data, box, sigma = _read_box(context, smoothing_fwhm, img, volumes)
+    return _mask_box(context, data, box, sigma, n_jobs)
+
+
+def _read_box(
+    context: SubjectContext,
+    smoothing_fwhm: float,
+    img: str,
+    volumes: np.ndarray[Any, Any] | None,
+) -> tuple[
+    np.ndarray[Any, Any], tuple[slice, ...], np.ndarray[Any, Any] | None
+]:
+    """Read the bounding box of the subject mask, padded by the radius of
+    the smoothing kernel. Returns the data, the box and the kernel width.
+
+    A BOLD image not in the grid of the mask is resampled to it in
+    memory first, as by the nilearn maskers.
+    """
+    with open_bold(img) as bold:
+        mask_shape = context.mask_array.shape
+        if not same_grid(bold, mask_shape, context.mask_img.affine):
+            gc_log.warning(
+                f"{img} is not in the grid of the subject mask, it is "
+                "resampled to the mask in memory."
+            )
+            bold = resample_img(
+                bold,
+                interpolation="continuous",
+                target_shape=mask_shape,
+                target_affine=context.mask_img.affine,
+            )
+        sigma = None
+        margin: tuple[int, ...] = (0, 0, 0)
+        if smoothing_fwhm:
+            sigma = fwhm_to_sigma(smoothing_fwhm, bold.affine)
+            margin = kernel_radius(sigma)
+        box = context.bounding_box(margin=margin)
+        data = read_bold_box(
+            bold, box, mask_shape, volumes, context.mask_img.affine
+        )
+    return data, box, sigma
+
+
+def _mask_box(
+    context: SubjectContext,
+    data: np.ndarray[Any, Any],
+    box: tuple[slice, ...],
+    sigma: np.ndarray[Any, Any] | None,
+    n_jobs: int = 1,
+) -> np.ndarray[Any, Any]:
+    if sigma is not None:
+        smooth_volumes(data, sigma, n_jobs)
+    return context.apply_mask(data, box)
+
+
+def clean_timeseries(
+    time_series: np.ndarray[Any, Any],
+    confounds: pd.DataFrame,
+    sample_mask: np.ndarray[Any, Any] | None,
+    standardize: bool,
+) -> np.ndarray[Any, Any]:
+    """Detrend, regress out confounds and standardize time series.
+
+    Same cleaning as the nilearn maskers used in
+    :func:`denoise_nifti_voxel`.
+
+    Parameters
+    ----------
+    time_series : np.ndarray
+        Time by features array (voxels or parcels).
+    confounds : pd.DataFrame
+        Confound regressors from the denoising strategy.
+    sample_mask : np.ndarray or None
+        Volumes to keep from the denoising strategy.
+    standardize : bool
+        Standardize the data. If True, zscore the data.
+
+    Returns
+    -------
+    np.ndarray
+        Cleaned time series.
+    """
+    # if high pass filter is not applied through cosines regressors,
+    # then detrend
+    detrend = "cosine00" not in confounds.columns
+    return clean(
+        time_series,
+        detrend=detrend,
+        standardize=standardize,
+        standardize_confounds=True,
+        t_r=None,
+        confounds=confounds,
+        sample_mask=sample_mask,
+    )
+
+
+def censor_confounds(
+    confounds: pd.DataFrame, sample_mask: np.ndarray[Any, Any] | None
+) -> pd.DataFrame:
+    """Keep the confounds of the volumes in the sample mask.
+
+    Use with time series that were already censored at load time, see
+    :func:`load_voxel_timeseries`.
+    """
+    if sample_mask is None:
+        return confounds
+    return confounds.iloc[sample_mask].reset_index(drop=True)
+
+
 def _check_exclusion(
     reduced_confounds: pd.DataFrame,
     sample_mask: np.ndarray[Any, Any] | None,
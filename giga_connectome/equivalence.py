@@ -0,0 +1,198 @@
+"""Numerical equivalence of the processing path with the nilearn one."""
+
+from __future__ import annotations
+
+import time
+from typing import Any
+
+import numpy as np
+import pandas as pd
+from nilearn.connectome import ConnectivityMeasure
+from nilearn.maskers import NiftiLabelsMasker, NiftiMapsMasker
+
+from giga_connectome import utils
+from giga_connectome.connectome import (
+    extract_timeseries_connectomes,
+    generate_timeseries_connectomes,
+)
+from giga_connectome.context import SubjectContext
+from giga_connectome.denoise import (
+    STRATEGY_TYPE,
+    denoise_loaded_run,
+    denoise_nifti_voxel,
+    load_run,
+)
+
+EQUIVALENCE_COLUMNS = [
+    "run",
+    "strategy",
+    "seg",
+    "output",
+    "max_abs_error",
+    "max_rel_error",
+    "reference_seconds",
+    "fast_seconds",
+    "speedup",
+    "passed",
+]
+
+
+def compare_run(
+    strategy: STRATEGY_TYPE,
+    context: SubjectContext,
+    img: str,
+    standardize: bool = True,
+    smoothing_fwhm: float = 5.0,
+    n_jobs: int = 1,
+    atol: float = 1e-4,
+    rtol: float = 1e-4,
+) -> pd.DataFrame:
+    """Process a run with the nilearn path and the fast path and compare.
+
+    The reference denoises the image with
+    :func:`giga_connectome.denoise.denoise_nifti_voxel` and extracts the
+    parcel signals with nilearn maskers fitted on the denoised image, as
+    :func:`giga_connectome.connectome.generate_timeseries_connectomes`.
+    The fast path is the one of the participant level: the run is read
+    with :func:`giga_connectome.denoise.load_run`, denoised with
+    :func:`giga_connectome.denoise.denoise_loaded_run` and extracted with
+    the atlases precompiled in the context. The context is built once
+    per subject, its time is not counted.
+
+    The relative error is the maximum absolute error over the maximum
+    absolute value of the reference, as elementwise ratios are unstable
+    for values close to zero. The diagonal of the connectomes is not
+    compared: both paths set it to one.
+
+    Parameters
+    ----------
+    strategy : dict
+        Denoising strategy parameter to pass to load_confounds_strategy.
+
+    context : SubjectContext
+        Subject context with the atlases to compare. \
+            See :func:`giga_connectome.context.build_subject_context`.
+
+    img : str
+        Path to the nifti image.
+
+    standardize : bool
+        Standardize the voxel time series.
+
+    smoothing_fwhm : float
+        Smoothing kernel size in mm.
+
+    n_jobs : int
+        Number of threads used for spatial smoothing by the fast path.
+
+    atol, rtol : float
+        Tolerated absolute and relative errors. Both must hold.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per atlas and output, ``timeseries`` and ``relmat``, see
+        :data:`EQUIVALENCE_COLUMNS`. The speedup covers the denoising and
+        the extraction of the atlas. Empty if the run is excluded by the
+        denoising strategy.
+    """
+    start = time.perf_counter()
+    denoised_img = denoise_nifti_voxel(
+        strategy, context.mask_img, standardize, smoothing_fwhm, img
+    )
+    reference_denoise = time.perf_counter() - start
+    start = time.perf_counter()
+    loaded_run = load_run(strategy, context, smoothing_fwhm, img)
+    time_series_voxel = (
+        None
+        if loaded_run is None
+        else denoise_loaded_run(loaded_run, context, standardize, n_jobs)
+    )
+    fast_denoise = time.perf_counter() - start
+    if denoised_img is None or time_series_voxel is None:
+        return pd.DataFrame(columns=EQUIVALENCE_COLUMNS)
+
+    correlation_measure = ConnectivityMeasure(
+        kind="correlation", vectorize=False, discard_diagonal=False
+    )
+    run = utils.parse_bids_name(img)[2]
+    rows = []
+    for seg, atlas_context in context.atlases.items():
+        start = time.perf_counter()
+        reference = _reference_extraction(
+            atlas_context.masker, denoised_img, context, correlation_measure
+        )
+        reference_seconds = reference_denoise + time.perf_counter() - start
+        start = time.perf_counter()
+        fast = extract_timeseries_connectomes(
+            atlas_context, time_series_voxel, correlation_measure, False
+        )
+        fast_seconds = fast_denoise + time.perf_counter() - start
+        off_diagonal = ~np.eye(fast[0].shape[0], dtype=bool)
+        for output, expected, actual in (
+            ("timeseries", reference[1], fast[1]),
+            ("relmat", reference[0][off_diagonal], fast[0][off_diagonal]),
+        ):
+            abs_error, rel_error = _errors(expected, actual)
+            rows.append(
+                [
+                    run,
+                    strategy["name"],
+                    seg,
+                    output,
+                    abs_error,
+                    rel_error,
+                    reference_seconds,
+                    fast_seconds,
+                    reference_seconds / fast_seconds,
+                    abs_error <= atol and rel_error <= rtol,
+                ]
+            )
+    return pd.DataFrame(rows, columns=EQUIVALENCE_COLUMNS)
+
+
+def _reference_extraction(
+    masker: NiftiLabelsMasker | NiftiMapsMasker,
+    denoised_img: Any,
+    context: SubjectContext,
+    correlation_measure: ConnectivityMeasure,
+) -> tuple[np.ndarray[Any, Any], np.ndarray[Any, Any]]:
+    """Connectome and time series of nilearn maskers, refitted on the
+    denoised image as before the subject contexts.
+    """
+    if isinstance(masker, NiftiLabelsMasker):
+        correlation_matrix, time_series_atlas, _ = (
+            generate_timeseries_connectomes(
+                NiftiLabelsMasker(
+                    labels_img=masker.labels_img, standardize=False
+                ),
+                denoised_img,
+                context.mask_img,
+                correlation_measure,
+                False,
+            )
+        )
+        return correlation_matrix, time_series_atlas
+    time_series_atlas = NiftiMapsMasker(
+        maps_img=masker.maps_img, standardize=False
+    ).fit_transform(denoised_img)
+    correlation_matrix = correlation_measure.fit_transform(
+        [time_series_atlas]
+    )[0]
+    return (
+        correlation_matrix.astype(np.float32),
+        time_series_atlas.astype(np.float32),
+    )
+
+
+def _errors(
+    expected: np.ndarray[Any, Any], actual: np.ndarray[Any, Any]
+) -> tuple[float, float]:
+    """Maximum absolute error, and relative to the largest value."""
+    if expected.shape != actual.shape:
+        return np.inf, np.inf
+    abs_error = float(
+        np.max(np.abs(actual.astype(np.float64) - expected), initial=0)
+    )
+    scale = float(np.max(np.abs(expected), initial=0))
+    return abs_error, abs_error / scale if scale else abs_error
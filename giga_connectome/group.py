@@ -0,0 +1,320 @@
+"""Gather the participant level connectomes in one array per atlas."""
+
+from __future__ import annotations
+
+import json
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import pandas as pd
+from nilearn.interfaces.bids import parse_bids_filename
+
+from giga_connectome import utils
+from giga_connectome.logger import gc_logger
+from giga_connectome.outputs import unpack_relmat
+
+gc_log = gc_logger()
+
+GROUP_DIR = "group"
+INDEX_COLUMNS = ["sub", "ses", "task", "run", "source"]
+# number of connectomes read in parallel before they are appended
+BATCH_SIZE = 64
+
+
+def find_connectomes(
+    output_dir: Path, participant_label: Sequence[str] | None = None
+) -> pd.DataFrame:
+    """List the participant level connectomes of an output directory.
+
+    Both the TSV and the HDF5 outputs are found.
+
+    Parameters
+    ----------
+    output_dir : pathlib.Path
+        Output directory of the participant level analysis.
+
+    participant_label : list of str or None
+        Only list these participants, without the ``sub-`` prefix.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per connectome, with the ``seg`` and ``desc`` entities,
+        the entities of :data:`INDEX_COLUMNS` and the ``source`` of the
+        connectome relative to ``output_dir``.
+    """
+    subjects = (
+        [f"sub-{label}" for label in participant_label]
+        if participant_label
+        else ["sub-*"]
+    )
+    entries = []
+    for subject in subjects:
+        for path in sorted(output_dir.glob(f"{subject}/**/*_relmat.tsv")):
+            entities = parse_bids_filename(str(path))["entities"]
+            entries.append(
+                {
+                    **entities,
+                    "source": str(path.relative_to(output_dir)),
+                }
+            )
+        for path in sorted(output_dir.glob(f"{subject}/**/*_connectome.h5")):
+            entries.extend(_find_hdf5_connectomes(output_dir, path))
+    connectomes = pd.DataFrame(
+        entries, columns=["seg", "desc", *INDEX_COLUMNS]
+    )
+    return connectomes.fillna("")
+
+
+def _find_hdf5_connectomes(
+    output_dir: Path, path: Path
+) -> list[dict[str, str]]:
+    """Connectomes of a subject HDF5 file, see
+    :class:`giga_connectome.outputs.HDF5Writer`.
+    """
+    import h5py
+
+    desc = parse_bids_filename(str(path))["entities"]["desc"]
+    entries = []
+    # saved with --no-dense-relmat
+    sparse_only = []
+    with h5py.File(path, "r") as h5_file:
+        for run_name, run_group in h5_file.items():
+            entities = {
+                key: str(run_group.attrs[key])
+                for key in INDEX_COLUMNS
+                if key in run_group.attrs
+            }
+            for seg_name in run_group:
+                if "relmat" not in run_group[seg_name]:
+                    sparse_only.append(f"{run_name}/{seg_name}")
+                    continue
+                entries.append(
+                    {
+                        **entities,
+                        "seg": seg_name.replace("seg-", "", 1),
+                        "desc": desc,
+                        "source": (
+                            f"{path.relative_to(output_dir)}:"
+                            f"{run_name}/{seg_name}/relmat"
+                        ),
+                    }
+                )
+    if sparse_only:
+        gc_log.warning(
+            f"{path.relative_to(output_dir)}: skipped {len(sparse_only)} "
+            "connectomes without dense relmat, saved with "
+            "--no-dense-relmat."
+        )
+    return entries
+
+
+def read_connectome(output_dir: Path, source: str) -> np.ndarray[Any, Any]:
+    """Read a participant level connectome listed by
+    :func:`find_connectomes`.
+    """
+    if ".h5:" in source:
+        import h5py
+
+        path, dataset = source.split(".h5:")
+        with h5py.File(output_dir / f"{path}.h5", "r") as h5_file:
+            relmat = np.asarray(h5_file[dataset][()], dtype=np.float32)
+    else:
+        relmat = pd.read_csv(output_dir / source, sep="\t").to_numpy(
+            np.float32
+        )
+    # upper triangle storage
+    if relmat.ndim == 1 or (relmat.shape[1] == 1 and relmat.shape[0] > 1):
+        return unpack_relmat(relmat)
+    return relmat
+
+
+def group_connectome_paths(
+    output_dir: Path, seg: str, desc: str
+) -> tuple[Path, Path, Path]:
+    """Data, index and sidecar files of the group connectomes of an
+    atlas and a denoising strategy.
+    """
+    stem = (
+        output_dir
+        / GROUP_DIR
+        / f"seg-{seg}_meas-PearsonCorrelation_desc-{desc}_relmat"
+    )
+    return (
+        stem.with_suffix(".dat"),
+        stem.with_name(f"{stem.name}_index.tsv"),
+        stem.with_suffix(".json"),
+    )
+
+
+def load_group_connectomes(
+    output_dir: Path, seg: str, desc: str
+) -> tuple[np.memmap[Any, Any], pd.DataFrame]:
+    """Memory-map the group connectomes of an atlas and a strategy.
+
+    Parameters
+    ----------
+    output_dir : pathlib.Path
+        Output directory of the analysis.
+
+    seg : str
+        ``seg`` entity of the atlas, for example
+        ``"Schaefer2018100Parcels7Networks"``.
+
+    desc : str
+        ``desc`` entity of the denoising strategy, for example
+        ``"denoiseSimple"``.
+
+    Returns
+    -------
+    np.memmap
+        Read only connectomes by upper triangle edges (diagonal
+        included, row major), one row per entry of the index.
+
+    pd.DataFrame
+        Index of the rows: BIDS entities and source of each connectome.
+    """
+    data_path, index_path, sidecar_path = group_connectome_paths(
+        output_dir, seg, desc
+    )
+    index = pd.read_csv(index_path, sep="\t", dtype=str, na_filter=False)
+    with open(sidecar_path) as f:
+        n_edges = json.load(f)["NumberOfEdges"]
+    data = np.memmap(
+        data_path, dtype=np.float32, mode="r", shape=(len(index), n_edges)
+    )
+    return data, index
+
+
+def build_group_connectomes(
+    output_dir: Path,
+    participant_label: Sequence[str] | None = None,
+    n_jobs: int = 1,
+) -> list[Path]:
+    """Gather the participant level connectomes in one array per atlas
+    and denoising strategy.
+
+    The upper triangles of the connectomes are appended as float32 rows
+    of a raw binary file that can be memory-mapped, see
+    :func:`load_group_connectomes`. An index table lists the BIDS
+    entities of each row. Connectomes already in the index are skipped,
+    so new participants are added without reading the others again.
+
+    Parameters
+    ----------
+    output_dir : pathlib.Path
+        Output directory of the participant level analysis.
+
+    participant_label : list of str or None
+        Only gather these participants, without the ``sub-`` prefix.
+
+    n_jobs : int
+        Number of threads reading the participant level outputs, at
+        least one.
+
+    Returns
+    -------
+    list of pathlib.Path
+        Data files of the group connectomes.
+    """
+    connectomes = find_connectomes(output_dir, participant_label)
+    data_paths = []
+    for (seg, desc), entries in connectomes.groupby(["seg", "desc"]):
+        data_path = _update_group_connectomes(
+            output_dir, str(seg), str(desc), entries, n_jobs
+        )
+        data_paths.append(data_path)
+    return data_paths
+
+
+def _update_group_connectomes(
+    output_dir: Path,
+    seg: str,
+    desc: str,
+    entries: pd.DataFrame,
+    n_jobs: int,
+) -> Path:
+    data_path, index_path, sidecar_path = group_connectome_paths(
+        output_dir, seg, desc
+    )
+    data_path.parent.mkdir(parents=True, exist_ok=True)
+    index = pd.DataFrame(columns=INDEX_COLUMNS)
+    n_edges = None
+    if index_path.exists():
+        index = pd.read_csv(index_path, sep="\t", dtype=str, na_filter=False)
+        with open(sidecar_path) as f:
+            n_edges = json.load(f)["NumberOfEdges"]
+    new_entries = entries.loc[
+        ~entries["source"].isin(index["source"]), INDEX_COLUMNS
+    ]
+    gc_log.info(
+        f"seg-{seg} desc-{desc}: {len(index)} connectomes gathered, "
+        f"{len(new_entries)} new."
+    )
+    if new_entries.empty:
+        return data_path
+
+    # drop rows written after the last update of the index
+    if data_path.exists() and n_edges is not None:
+        with open(data_path, "r+b") as f:
+            f.truncate(len(index) * n_edges * np.dtype(np.float32).itemsize)
+
+    with ThreadPoolExecutor(max_workers=max(1, n_jobs)) as executor:
+        for start in range(0, len(new_entries), BATCH_SIZE):
+            batch = new_entries.iloc[start : start + BATCH_SIZE]
+            matrices = list(
+                executor.map(
+                    lambda source: read_connectome(output_dir, source),
+                    batch["source"],
+                )
+            )
+            rows = _upper_triangles(matrices, batch["source"])
+            if n_edges is None:
+                n_edges = rows.shape[1]
+            elif rows.shape[1] != n_edges:
+                raise ValueError(
+                    f"Connectomes of seg-{seg} have {rows.shape[1]} edges, "
+                    f"{n_edges} expected."
+                )
+            with open(data_path, "ab") as f:
+                rows.tofile(f)
+            index = pd.concat([index, batch], ignore_index=True)
+            _write_atomic(
+                index_path,
+                index.to_csv(sep="\t", index=False),
+            )
+            _write_atomic(
+                sidecar_path,
+                json.dumps(
+                    {
+                        "NumberOfConnectomes": len(index),
+                        "NumberOfEdges": n_edges,
+                        "DataType": "float32",
+                        "StorageFormat": "UpperTriangular",
+                        "Measure": "Pearson correlation",
+                    },
+                    indent=4,
+                ),
+            )
+    return data_path
+
+
+def _upper_triangles(
+    matrices: list[np.ndarray[Any, Any]], sources: pd.Series
+) -> np.ndarray[Any, Any]:
+    """Stack the upper triangles, diagonal included, of square matrices."""
+    n_parcels = {matrix.shape[0] for matrix in matrices}
+    if len(n_parcels) > 1:
+        raise ValueError(
+            f"Connectomes of different sizes {n_parcels} in {list(sources)}."
+        )
+    triu = np.triu_indices(n_parcels.pop())
+    return np.stack([matrix[triu] for matrix in matrices]).astype(np.float32)
+
+
+def _write_atomic(path: Path, content: str) -> None:
+    with utils.atomic_path(path) as tmp_path:
+        tmp_path.write_text(content)
@@ -0,0 +1,270 @@
+"""Read BOLD data restricted to the region covered by the subject mask."""
+
+from __future__ import annotations
+
+import gzip
+from collections import deque
+from collections.abc import Callable, Generator, Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from importlib.util import find_spec
+from pathlib import Path
+from typing import Any, TypeVar
+
+import nibabel as nib
+import numpy as np
+from nibabel.spatialimages import SpatialImage
+
+# in order of preference
+GZIP_BACKENDS = ("isal", "indexed_gzip", "zlib")
+
+Item = TypeVar("Item")
+Result = TypeVar("Result")
+
+
+def available_gzip_backends() -> list[str]:
+    """List the gzip decompression backends installed, fastest first.
+
+    ``isal`` (python-isal, ISA-L igzip) and ``indexed_gzip`` are
+    optional dependencies, see the ``fast`` extra. ``zlib`` is always
+    available.
+    """
+    return [
+        backend
+        for backend in GZIP_BACKENDS
+        if backend == "zlib" or find_spec(backend) is not None
+    ]
+
+
+@contextmanager
+def open_bold(
+    img: str | Path, gzip_backend: str | None = None
+) -> Iterator[SpatialImage]:
+    """Load the header and the data proxy of a BOLD image.
+
+    No voxel data is read. The file handle is kept open within the
+    ``with`` block so that reading several blocks of volumes seeks
+    forward in compressed files instead of decompressing them from the
+    start for every block, and closed on exit.
+
+    Parameters
+    ----------
+    img : str or pathlib.Path
+        Path to the BOLD image.
+
+    gzip_backend : str or None
+        Decompression backend for ``.nii.gz`` files, one of
+        :data:`GZIP_BACKENDS`. None picks the fastest one available.
+
+    Yields
+    ------
+    SpatialImage
+        Image with a data proxy reading from the open file.
+    """
+    img = Path(img)
+    if gzip_backend is None:
+        gzip_backend = available_gzip_backends()[0]
+    elif gzip_backend not in available_gzip_backends():
+        raise ValueError(
+            f"Gzip backend '{gzip_backend}' is not available. Choose from "
+            f"{available_gzip_backends()}."
+        )
+
+    bold: nib.filebasedimages.FileBasedImage
+    stream = None
+    if img.name.endswith(".nii.gz") and gzip_backend != "indexed_gzip":
+        stream = _open_gzip(img, gzip_backend)
+    try:
+        if stream is not None:
+            bold = nib.Nifti1Image.from_stream(stream)
+        else:
+            # nibabel uses indexed_gzip by itself whenever it is
+            # installed, and closes the file with the data proxy
+            bold = nib.load(img, keep_file_open=True)
+        if not isinstance(bold, SpatialImage):
+            raise TypeError(f"{img} is not a spatial image.")
+        yield bold
+    finally:
+        if stream is not None:
+            stream.close()
+
+
+def _open_gzip(path: Path, gzip_backend: str) -> Any:
+    """Open a gzip file for reading with the chosen backend."""
+    if gzip_backend == "isal":
+        from isal import igzip
+
+        return igzip.open(path, "rb")
+    return gzip.open(path, "rb")
+
+
+def read_bold_box(
+    img: str | Path | SpatialImage,
+    box: tuple[slice, ...],
+    mask_shape: tuple[int, ...],
+    volumes: np.ndarray[Any, Any] | None = None,
+    mask_affine: np.ndarray[Any, Any] | None = None,
+) -> np.ndarray[Any, Any]:
+    """Read the voxels of a 4D BOLD image within a spatial box.
+
+    Only the box is sliced from the data proxy, so the full field of
+    view is never held in memory. Scaling factors of the header are
+    applied.
+
+    With ``volumes``, only the selected volumes are read, one block of
+    consecutive volumes at a time, directly into the output array.
+    Uncompressed files are read at the offsets of the blocks; compressed
+    files are decompressed forward and skip the blocks of censored
+    volumes without keeping them.
+
+    Parameters
+    ----------
+    img : str or pathlib.Path or SpatialImage
+        4D BOLD image.
+
+    box : tuple of slice
+        Spatial bounding box, see
+        :meth:`giga_connectome.context.SubjectContext.bounding_box`.
+
+    mask_shape : tuple of int
+        Shape of the subject mask the box was computed on.
+
+    volumes : np.ndarray or None
+        Indices of the volumes to read, in increasing order, such as the
+        sample mask of the denoising strategy. None reads all volumes.
+
+    mask_affine : np.ndarray or None
+        Affine of the subject mask. None only checks the shape.
+
+    Returns
+    -------
+    np.ndarray
+        4D float32 array of the cropped data.
+
+    Raises
+    ------
+    ValueError
+        The BOLD image is not in the grid of the subject mask, see
+        :func:`same_grid`.
+    """
+    if isinstance(img, str | Path):
+        with open_bold(img) as bold:
+            return read_bold_box(bold, box, mask_shape, volumes, mask_affine)
+    bold = img
+    if not same_grid(bold, mask_shape, mask_affine):
+        raise ValueError(
+            f"The BOLD image {bold.get_filename()} of shape {bold.shape[:3]} "
+            f"is not in the grid of the subject mask of shape {mask_shape}."
+        )
+    if volumes is None:
+        return np.asarray(bold.dataobj[(*box, slice(None))], dtype=np.float32)
+
+    box_shape = tuple(
+        len(range(*s.indices(n))) for s, n in zip(box, mask_shape, strict=True)
+    )
+    data = np.empty((*box_shape, len(volumes)), dtype=np.float32)
+    position = 0
+    for start, stop in _consecutive_blocks(volumes):
+        data[..., position : position + stop - start] = bold.dataobj[
+            (*box, slice(start, stop))
+        ]
+        position += stop - start
+    return data
+
+
+def same_grid(
+    bold: SpatialImage,
+    mask_shape: tuple[int, ...],
+    mask_affine: np.ndarray[Any, Any] | None = None,
+) -> bool:
+    """Whether the voxels of a BOLD image are those of the subject mask.
+
+    Parameters
+    ----------
+    bold : SpatialImage
+        BOLD image, only its header is used.
+
+    mask_shape : tuple of int
+        Shape of the subject mask.
+
+    mask_affine : np.ndarray or None
+        Affine of the subject mask. None only compares the shapes.
+
+    Returns
+    -------
+    bool
+        True if the shapes match and the affines are close.
+    """
+    if bold.shape[:3] != tuple(mask_shape):
+        return False
+    return mask_affine is None or bool(
+        np.allclose(bold.affine, mask_affine)
+    )
+
+
+def _consecutive_blocks(
+    volumes: np.ndarray[Any, Any],
+) -> list[tuple[int, int]]:
+    """Split increasing indices into (start, stop) blocks of consecutive
+    indices.
+    """
+    volumes = np.asarray(volumes, dtype=int)
+    if volumes.size == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(volumes) != 1) + 1
+    starts = np.concatenate([[0], breaks])
+    stops = np.concatenate([breaks, [volumes.size]])
+    return [
+        (int(volumes[i]), int(volumes[j - 1]) + 1)
+        for i, j in zip(starts, stops, strict=True)
+    ]
+
+
+def prefetch(
+    function: Callable[[Item], Result],
+    items: Iterable[Item],
+    depth: int = 1,
+) -> Generator[tuple[Item, Result], None, None]:
+    """Apply ``function`` to the items in a background thread, ahead of
+    their use.
+
+    While an item is used, the next ``depth`` items are loaded, so input
+    overlaps with computation. At most ``depth + 1`` results are held in
+    memory. Errors are raised when the item is reached. Close the
+    generator to stop loading when the items are not all used.
+
+    Parameters
+    ----------
+    function : Callable
+        Loading function, called with each item.
+    items : iterable
+        Items to load, in order.
+    depth : int
+        Number of items loaded ahead. 0 loads each item when it is used,
+        in the calling thread.
+
+    Yields
+    ------
+    tuple
+        Each item and the result of ``function``.
+    """
+    if depth < 1:
+        for item in items:
+            yield item, function(item)
+        return
+
+    executor = ThreadPoolExecutor(
+        max_workers=1, thread_name_prefix="giga_connectome_prefetch"
+    )
+    pending: deque[tuple[Item, Future[Result]]] = deque()
+    try:
+        for item in items:
+            pending.append((item, executor.submit(function, item)))
+            if len(pending) > depth:
+                current, future = pending.popleft()
+                yield current, future.result()
+        while pending:
+            current, future = pending.popleft()
+            yield current, future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
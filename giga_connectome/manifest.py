@@ -0,0 +1,133 @@
+"""Record the completed runs of a subject to resume interrupted jobs."""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import threading
+from collections.abc import Sequence
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any
+
+from giga_connectome import utils
+from giga_connectome._version import __version__
+from giga_connectome.logger import gc_logger
+
+gc_log = gc_logger()
+
+MANIFEST_DIR = Path("logs") / "manifest"
+
+
+def input_hash(paths: Sequence[str | Path]) -> str:
+    """Hash of the path, modification time and size of the inputs.
+
+    The inputs are not read, so hashing large BOLD images is free.
+    """
+    key = hashlib.sha1(usedforsecurity=False)
+    for path in paths:
+        key.update(utils.file_signature(path).encode())
+    return key.hexdigest()
+
+
+def parameter_hash(parameters: dict[str, Any]) -> str:
+    """Hash of the processing parameters and the giga_connectome version."""
+    content = json.dumps(
+        {**parameters, "version": __version__}, sort_keys=True, default=str
+    )
+    return hashlib.sha1(content.encode(), usedforsecurity=False).hexdigest()
+
+
+class Manifest:
+    """Outputs of the completed runs of a subject, with the hashes of their
+    inputs and of the processing parameters.
+
+    The manifest is a JSON file rewritten atomically each time a run is
+    recorded, so an interrupted job leaves the runs completed so far. A
+    run is complete if it was recorded with the same hashes and all its
+    outputs still exist.
+
+    Parameters
+    ----------
+    output_dir : pathlib.Path
+        Output directory of the participant level analysis. The output
+        paths are stored relative to it.
+
+    name : str
+        Name of the manifest file, without extension.
+    """
+
+    def __init__(self, output_dir: Path, name: str) -> None:
+        self.output_dir = output_dir
+        self.path = output_dir / MANIFEST_DIR / f"{name}.json"
+        self._lock = threading.Lock()
+        self.runs: dict[str, dict[str, Any]] = {}
+        if self.path.exists():
+            with open(self.path) as f:
+                self.runs = json.load(f)["runs"]
+
+    def is_complete(self, run: str, inputs: str, parameters: str) -> bool:
+        """Whether a run was completed with the same inputs and
+        parameters, and its outputs still exist.
+
+        Parameters
+        ----------
+        run : str
+            Name of the run, usually the BOLD file name.
+
+        inputs : str
+            Hash of the inputs of the run, see :func:`input_hash`.
+
+        parameters : str
+            Hash of the parameters, see :func:`parameter_hash`.
+        """
+        entry = self.runs.get(run)
+        if entry is None:
+            return False
+        if entry["inputs"] != inputs:
+            gc_log.info(f"{run}: inputs changed since the last run.")
+            return False
+        if entry["parameters"] != parameters:
+            gc_log.info(f"{run}: parameters changed since the last run.")
+            return False
+        missing = [
+            output
+            for output in entry["outputs"]
+            if not (self.output_dir / output).exists()
+        ]
+        if missing:
+            gc_log.info(f"{run}: missing outputs {missing}.")
+            return False
+        return True
+
+    def record(
+        self,
+        run: str,
+        inputs: str,
+        parameters: str,
+        outputs: Sequence[Path],
+    ) -> None:
+        """Record a completed run and rewrite the manifest.
+
+        Safe to call from the writing threads.
+        """
+        entry = {
+            "inputs": inputs,
+            "parameters": parameters,
+            "outputs": sorted(
+                {
+                    str(Path(output).relative_to(self.output_dir))
+                    for output in outputs
+                }
+            ),
+            "completed": datetime.now(timezone.utc).isoformat(),
+        }
+        with self._lock:
+            self.runs[run] = entry
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with utils.atomic_path(self.path) as tmp_path:
+                tmp_path.write_text(
+                    json.dumps(
+                        {"version": __version__, "runs": self.runs}, indent=4
+                    )
+                )
@@ -23,6 +23,7 @@ from scipy.ndimage import binary_closing
 from giga_connectome import utils
 from giga_connectome.atlas import ATLAS_SETTING_TYPE, resample_atlas_collection
 from giga_connectome.logger import gc_logger
+from giga_connectome.timing import StageTimer, timed
 
 gc_log = gc_logger()
 
@@ -32,6 +33,7 @@ def generate_gm_mask_atlas(
     atlas: ATLAS_SETTING_TYPE,
     template: str,
     masks: list[BIDSImageFile],
+    timer: StageTimer | None = None,
 ) -> tuple[Path, list[Path]]:
     # check masks; isolate this part and make sure to make it a validate
     # templateflow template with a config file
@@ -65,12 +67,14 @@ def generate_gm_mask_atlas(
 
     if not target_subject_mask:
         # grey matter group mask is only supplied in MNI152NLin2009c(A)sym
-        subject_mask_nii = generate_subject_gm_mask(
-            [m.path for m in masks], "MNI152NLin2009cAsym"
-        )
-        nib.save(
-            subject_mask_nii, subject_mask_dir / target_subject_mask_file_name
-        )
+        with timed(timer, "mask"):
+            subject_mask_nii = generate_subject_gm_mask(
+                [m.path for m in masks], "MNI152NLin2009cAsym"
+            )
+            nib.save(
+                subject_mask_nii,
+                subject_mask_dir / target_subject_mask_file_name,
+            )
     else:
         subject_mask_nii = load_img(
             subject_mask_dir / target_subject_mask_file_name
@@ -79,12 +83,13 @@ def generate_gm_mask_atlas(
     if not target_subject_seg or not target_subject_mask:
         # resample if the grey matter mask was not generated
         # or the atlas was not present
-        subject_seg_niis = resample_atlas_collection(
-            target_subject_seg_file_names,
-            atlas,
-            subject_mask_dir,
-            subject_mask_nii,
-        )
+        with timed(timer, "atlas_resampling"):
+            subject_seg_niis = resample_atlas_collection(
+                target_subject_seg_file_names,
+                atlas,
+                subject_mask_dir,
+                subject_mask_nii,
+            )
     else:
         subject_seg_niis = [
             subject_mask_dir / i for i in target_subject_seg_file_names
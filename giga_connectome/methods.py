@@ -17,6 +17,7 @@ def generate_method_section(
     standardize: str,
     mni_space: str,
     average_correlation: bool,
+    denoise_level: str = "voxel",
 ) -> None:
     env = Environment(
         loader=FileSystemLoader(Path(__file__).parent),
@@ -42,6 +43,7 @@ def generate_method_section(
         ),
         "mni_space": mni_space,
         "average_correlation": average_correlation,
+        "denoise_level": denoise_level,
     }
 
     with open(output_file, "w") as f:
@@ -0,0 +1,906 @@
+"""Writers of the participant level outputs."""
+
+from __future__ import annotations
+
+import json
+import os
+import threading
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from importlib.util import find_spec
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+import numpy as np
+import pandas as pd
+from nilearn.interfaces.bids import parse_bids_filename
+from scipy.sparse import coo_matrix, save_npz
+
+from giga_connectome import utils
+from giga_connectome.logger import gc_logger
+
+if TYPE_CHECKING:
+    from nilearn.reporting import HTMLReport
+
+gc_log = gc_logger()
+
+OUTPUT_FORMATS = ["tsv", "hdf5"]
+# --relmat-storage option to the BEP017 StorageFormat of the sidecar
+RELMAT_STORAGE = {"full": "Full", "upper": "UpperTriangular"}
+TIMESERIES_ENCODINGS = ["float32", "float16", "int16"]
+# source entities that are the same for all the runs of an HDF5 file
+HDF5_FILE_ENTITIES = ("sub", "space", "res", "desc")
+INT16_MAX = np.iinfo(np.int16).max
+
+
+def pack_relmat(matrix: np.ndarray[Any, Any]) -> np.ndarray[Any, Any]:
+    """Upper triangle of a symmetric matrix, diagonal included, row major.
+
+    Parameters
+    ----------
+    matrix : np.ndarray
+        N by N symmetric matrix.
+
+    Returns
+    -------
+    np.ndarray
+        Vector of N * (N + 1) / 2 values.
+    """
+    return matrix[np.triu_indices(matrix.shape[0])]
+
+
+def unpack_relmat(vector: np.ndarray[Any, Any]) -> np.ndarray[Any, Any]:
+    """Restore the full symmetric matrix from :func:`pack_relmat`.
+
+    Parameters
+    ----------
+    vector : np.ndarray
+        Vector of N * (N + 1) / 2 values.
+
+    Returns
+    -------
+    np.ndarray
+        N by N symmetric matrix.
+    """
+    vector = np.asarray(vector).ravel()
+    n_parcels = int((np.sqrt(8 * vector.shape[0] + 1) - 1) / 2)
+    if n_parcels * (n_parcels + 1) // 2 != vector.shape[0]:
+        raise ValueError(
+            f"{vector.shape[0]} values are not the upper triangle of a "
+            "square matrix."
+        )
+    matrix = np.empty((n_parcels, n_parcels), dtype=vector.dtype)
+    rows, cols = np.triu_indices(n_parcels)
+    matrix[rows, cols] = vector
+    matrix[cols, rows] = vector
+    return matrix
+
+
+def encode_timeseries(
+    time_series: np.ndarray[Any, Any], encoding: str
+) -> tuple[np.ndarray[Any, Any], dict[str, Any]]:
+    """Quantise time series for compact storage.
+
+    "int16" maps the range of the values to the full int16 range with a
+    scale factor and an offset: ``value = stored * scale + offset``.
+
+    Parameters
+    ----------
+    time_series : np.ndarray
+        Time series by parcels.
+
+    encoding : str
+        One of :data:`TIMESERIES_ENCODINGS`.
+
+    Returns
+    -------
+    np.ndarray
+        Encoded time series.
+
+    dict
+        ``Encoding``, ``ScaleFactor`` and ``Offset`` of the encoded values,
+        and ``MaxQuantizationError``, the maximum absolute difference
+        between the decoded and the original values.
+    """
+    if encoding not in TIMESERIES_ENCODINGS:
+        raise ValueError(
+            f"Unknown time series encoding '{encoding}'. "
+            f"Choose from {TIMESERIES_ENCODINGS}."
+        )
+    time_series = np.asarray(time_series, dtype=np.float64)
+    scale, offset = 1.0, 0.0
+    if encoding == "int16" and time_series.size:
+        low, high = float(time_series.min()), float(time_series.max())
+        offset = (high + low) / 2
+        scale = (high - low) / (2 * INT16_MAX) or 1.0
+        encoded = np.rint((time_series - offset) / scale)
+        encoded = np.clip(encoded, -INT16_MAX, INT16_MAX).astype(np.int16)
+    else:
+        encoded = time_series.astype(encoding)
+    encoding_info = {
+        "Encoding": encoding,
+        "ScaleFactor": scale,
+        "Offset": offset,
+    }
+    decoded = decode_timeseries(encoded, encoding_info)
+    encoding_info["MaxQuantizationError"] = (
+        float(np.max(np.abs(decoded - time_series)))
+        if time_series.size
+        else 0.0
+    )
+    return encoded, encoding_info
+
+
+def decode_timeseries(
+    encoded: np.ndarray[Any, Any], encoding_info: dict[str, Any]
+) -> np.ndarray[Any, Any]:
+    """Restore the time series from :func:`encode_timeseries`.
+
+    Parameters
+    ----------
+    encoded : np.ndarray
+        Encoded time series.
+
+    encoding_info : dict
+        ``ScaleFactor`` and ``Offset`` of the encoded values, from the
+        sidecar or the attributes of the HDF5 dataset.
+
+    Returns
+    -------
+    np.ndarray
+        Time series in float64.
+    """
+    return (
+        np.asarray(encoded, dtype=np.float64) * encoding_info["ScaleFactor"]
+        + encoding_info["Offset"]
+    )
+
+
+def sparsify_relmat(
+    matrix: np.ndarray[Any, Any],
+    top_k: int | None = None,
+    threshold: float | None = None,
+) -> coo_matrix:
+    """Keep the strongest edges of a connectome.
+
+    Parameters
+    ----------
+    matrix : np.ndarray
+        N by N symmetric matrix.
+
+    top_k : int or None
+        Keep the ``top_k`` edges of largest absolute value of each node.
+        An edge is kept if it is in the top ``top_k`` of either node.
+
+    threshold : float or None
+        Keep the edges of absolute value above or equal to ``threshold``.
+        With ``top_k``, the edges must satisfy both.
+
+    Returns
+    -------
+    scipy.sparse.coo_matrix
+        Upper triangle of the kept edges, diagonal excluded.
+    """
+    if top_k is None and threshold is None:
+        raise ValueError("Set top_k, threshold or both.")
+    if top_k is not None and top_k < 1:
+        raise ValueError(f"top_k must be at least 1, got {top_k}.")
+    if threshold is not None and not 0 <= threshold <= 1:
+        raise ValueError(
+            f"threshold must be between 0 and 1, got {threshold}."
+        )
+    n_parcels = matrix.shape[0]
+    strength = np.abs(matrix)
+    np.fill_diagonal(strength, -np.inf)
+    keep = np.ones(matrix.shape, dtype=bool)
+    if top_k is not None and top_k < n_parcels - 1:
+        top = np.argpartition(-strength, top_k, axis=1)[:, :top_k]
+        keep = np.zeros(matrix.shape, dtype=bool)
+        keep[np.arange(n_parcels)[:, np.newaxis], top] = True
+        keep |= keep.T
+    if threshold is not None:
+        keep &= strength >= threshold
+    rows, cols = np.nonzero(np.triu(keep, k=1))
+    return coo_matrix(
+        (matrix[rows, cols].astype(np.float32), (rows, cols)),
+        shape=matrix.shape,
+    )
+
+
+class TSVWriter:
+    """One TSV file per run and atlas for the time series and the
+    connectome, and one JSON sidecar per run, following BEP017.
+
+    Each file is written under a temporary name and renamed once
+    complete.
+
+    Parameters
+    ----------
+    output_path : pathlib.Path
+        Root of the output dataset.
+
+    atlas : str
+        Name of the atlas.
+
+    strategy : str
+        Name of the denoising strategy.
+
+    relmat_storage : str
+        "full" for the N by N connectomes, "upper" for their upper
+        triangles, see :func:`pack_relmat`. Packed connectomes are saved
+        in a single column.
+
+    timeseries_encoding : str
+        "float32" for TSV time series. "float16" and "int16" save the
+        time series as ``.npy`` binary files, see
+        :func:`encode_timeseries`, with a JSON sidecar of the same name
+        holding the encoding.
+
+    relmat_top_k : int or None
+        Also save the connectomes as sparse matrices with the strongest
+        edges of each node, see :func:`sparsify_relmat`.
+
+    relmat_threshold : float or None
+        Also save the connectomes as sparse matrices with the edges
+        above this absolute value, see :func:`sparsify_relmat`.
+
+    dense_relmat : bool
+        Save the dense connectomes. Can only be skipped when the sparse
+        connectomes are saved. Sparse connectomes are saved as
+        ``.npz`` files of :func:`scipy.sparse.save_npz`.
+    """
+
+    # files of different runs and atlases can be written concurrently
+    thread_safe = True
+    # runs can be written again without rewriting the others
+    resumable = True
+
+    def __init__(
+        self,
+        output_path: Path,
+        atlas: str,
+        strategy: str,
+        relmat_storage: str = "full",
+        timeseries_encoding: str = "float32",
+        relmat_top_k: int | None = None,
+        relmat_threshold: float | None = None,
+        dense_relmat: bool = True,
+    ) -> None:
+        if relmat_storage not in RELMAT_STORAGE:
+            raise ValueError(
+                f"Unknown connectome storage '{relmat_storage}'. "
+                f"Choose from {list(RELMAT_STORAGE)}."
+            )
+        if timeseries_encoding not in TIMESERIES_ENCODINGS:
+            raise ValueError(
+                f"Unknown time series encoding '{timeseries_encoding}'. "
+                f"Choose from {TIMESERIES_ENCODINGS}."
+            )
+        self.sparse_relmat = (
+            relmat_top_k is not None or relmat_threshold is not None
+        )
+        if not (dense_relmat or self.sparse_relmat):
+            raise ValueError(
+                "The dense connectomes can only be skipped when the sparse "
+                "connectomes are saved."
+            )
+        self.output_path = output_path
+        self.atlas = atlas
+        self.strategy = strategy
+        self.relmat_storage = relmat_storage
+        self.timeseries_encoding = timeseries_encoding
+        self.relmat_top_k = relmat_top_k
+        self.relmat_threshold = relmat_threshold
+        self.dense_relmat = dense_relmat
+        # files written for each source file, see run_done
+        self._outputs: dict[str, list[Path]] = {}
+
+    def _add_output(self, source_file: str, path: Path) -> None:
+        self._outputs.setdefault(source_file, []).append(path)
+
+    def run_done(
+        self, source_file: str, callback: Callable[[list[Path]], None]
+    ) -> None:
+        """Call ``callback`` with the files of a run once they are saved.
+
+        Called after the last output of the run is queued.
+        """
+        callback(self._outputs.pop(source_file, []))
+
+    def _sparse_relmat(
+        self, correlation_matrix: np.ndarray[Any, Any]
+    ) -> coo_matrix:
+        return sparsify_relmat(
+            correlation_matrix, self.relmat_top_k, self.relmat_threshold
+        )
+
+    def _relmat(
+        self, correlation_matrix: np.ndarray[Any, Any]
+    ) -> np.ndarray[Any, Any]:
+        if self.relmat_storage == "upper":
+            return pack_relmat(correlation_matrix)
+        return correlation_matrix
+
+    def run_path(self, source_file: str) -> Path:
+        """Output folder of a run."""
+        subject, session, _ = utils.parse_bids_name(source_file)
+        connectome_path = self.output_path / subject
+        if session:
+            connectome_path = connectome_path / session
+        return connectome_path / "func"
+
+    def write_metadata(
+        self, source_file: str, metadata: dict[str, Any]
+    ) -> None:
+        """Save the metadata of the denoising of a run.
+
+        All timeseries derivatives of the same scan have the same
+        metadata so one json file for them all.
+        See https://bids.neuroimaging.io/bep012
+        """
+        json_filename = self.run_path(source_file) / utils.output_filename(
+            source_file=Path(source_file).stem,
+            atlas=self.atlas,
+            atlas_desc="",
+            strategy=self.strategy,
+            suffix="timeseries",
+            extension="json",
+        )
+        utils.check_path(json_filename)
+        _dump_json(json_filename, metadata)
+        self._add_output(source_file, json_filename)
+
+    def write(
+        self,
+        source_file: str,
+        atlas_desc: str,
+        correlation_matrix: np.ndarray[Any, Any],
+        time_series_atlas: np.ndarray[Any, Any],
+    ) -> None:
+        """Save the connectome and the time series of a run and atlas."""
+
+        def filename(suffix: str, extension: str) -> Path:
+            path = self.run_path(source_file) / utils.output_filename(
+                source_file=Path(source_file).stem,
+                atlas=self.atlas,
+                suffix=suffix,
+                extension=extension,
+                strategy=self.strategy,
+                atlas_desc=atlas_desc,
+            )
+            utils.check_path(path)
+            self._add_output(source_file, path)
+            return path
+
+        if self.dense_relmat:
+            _write_tsv(
+                filename("relmat", "tsv"), self._relmat(correlation_matrix)
+            )
+        if self.sparse_relmat:
+            with utils.atomic_path(filename("relmat", "npz")) as tmp_path:
+                save_npz(tmp_path, self._sparse_relmat(correlation_matrix))
+        if self.timeseries_encoding == "float32":
+            _write_tsv(filename("timeseries", "tsv"), time_series_atlas)
+            return
+        data, encoding_info = encode_timeseries(
+            time_series_atlas, self.timeseries_encoding
+        )
+        npy_filename = filename("timeseries", "npy")
+        with utils.atomic_path(npy_filename) as tmp_path:
+            np.save(tmp_path, data)
+        _dump_json(npy_filename.with_suffix(".json"), encoding_info)
+        self._add_output(source_file, npy_filename.with_suffix(".json"))
+
+    def subject_report_path(self, subject: str) -> Path:
+        """Path of the report of a subject."""
+        return (
+            self.output_path
+            / subject
+            / "func"
+            / (
+                f"{subject}_seg-{self.atlas}_desc-denoise"
+                f"{self.strategy.capitalize()}_report.html"
+            )
+        )
+
+    def _timeseries_path(self, source_file: str, atlas_desc: str) -> Path:
+        """Saved time series of a run and atlas, TSV or encoded."""
+        for extension in ("tsv", "npy"):
+            path = self.run_path(source_file) / utils.output_filename(
+                source_file=Path(source_file).stem,
+                atlas=self.atlas,
+                suffix="timeseries",
+                extension=extension,
+                strategy=self.strategy,
+                atlas_desc=atlas_desc,
+            )
+            if path.exists():
+                break
+        return path
+
+    def has_outputs(self, source_file: str, atlas_desc: str) -> bool:
+        """Whether the time series of a run and atlas are saved."""
+        return self._timeseries_path(source_file, atlas_desc).exists()
+
+    def read_timeseries(
+        self, source_file: str, atlas_desc: str
+    ) -> np.ndarray[Any, Any]:
+        """Read the saved time series of a run and atlas."""
+        path = self._timeseries_path(source_file, atlas_desc)
+        if path.suffix == ".tsv":
+            return pd.read_csv(path, sep="\t").to_numpy()
+        with open(path.with_suffix(".json")) as f:
+            encoding_info = json.load(f)
+        return decode_timeseries(np.load(path), encoding_info)
+
+    def read_metadata(self, source_file: str) -> dict[str, Any] | None:
+        """Read the saved metadata of a run, None if not saved."""
+        json_filename = self.run_path(source_file) / utils.output_filename(
+            source_file=Path(source_file).stem,
+            atlas=self.atlas,
+            atlas_desc="",
+            strategy=self.strategy,
+            suffix="timeseries",
+            extension="json",
+        )
+        if not json_filename.exists():
+            return None
+        with open(json_filename) as f:
+            metadata: dict[str, Any] = json.load(f)
+        return metadata
+
+    def write_subject_report(self, subject: str, html: str) -> None:
+        """Save the report of a subject, see
+        :class:`giga_connectome.reports.SubjectReport`.
+        """
+        path = self.subject_report_path(subject)
+        utils.check_path(path)
+        with utils.atomic_path(path) as tmp_path:
+            tmp_path.write_text(html)
+
+    def write_report(
+        self, source_file: str, atlas_desc: str, report: HTMLReport
+    ) -> None:
+        """Save the report of the masker of a run and atlas."""
+        report_filename = self.run_path(source_file) / utils.output_filename(
+            source_file=Path(source_file).stem,
+            atlas=self.atlas,
+            suffix="report",
+            extension="html",
+            strategy=self.strategy,
+            atlas_desc=atlas_desc,
+        )
+        utils.check_path(report_filename)
+        with utils.atomic_path(report_filename) as tmp_path:
+            report.save_as_html(tmp_path)
+        self._add_output(source_file, report_filename)
+
+    def close(self) -> None:
+        """Nothing to flush, files are written as they come."""
+
+
+def _write_tsv(path: Path, data: np.ndarray[Any, Any]) -> None:
+    with utils.atomic_path(path) as tmp_path:
+        pd.DataFrame(data).to_csv(tmp_path, sep="\t", index=False)
+
+
+def _dump_json(path: Path, content: dict[str, Any]) -> None:
+    with utils.atomic_path(path) as tmp_path:
+        with open(tmp_path, "w") as f:
+            json.dump(content, f, indent=4)
+
+
+class HDF5Writer(TSVWriter):
+    """One HDF5 file per subject, with one group per run.
+
+    Each run group holds the BIDS entities and the denoising metadata
+    as attributes, and one subgroup per atlas with chunked, compressed
+    float32 ``timeseries`` and ``relmat`` datasets, in
+    ``sub-<label>/func/``::
+
+        sub-<label>_seg-<atlas>_desc-denoise<strategy>_connectome.h5
+        └── [ses-<label>_]task-<label>[_acq-<label>]..[_run-<index>]
+            └── seg-<atlas><atlas_description>
+                ├── timeseries
+                └── relmat
+
+    With the "upper" ``relmat_storage``, ``relmat`` is a vector and the
+    ``StorageFormat`` attribute of the atlas subgroup says so. Encoded
+    ``timeseries`` datasets hold the encoding of
+    :func:`encode_timeseries` as attributes. Sparse connectomes are
+    saved in a ``relmat_sparse`` subgroup of ``row``, ``col`` and
+    ``data`` datasets, with the ``shape`` as attribute. Reports and the
+    dataset level sidecars are unchanged.
+
+    Run groups are named after the entities of the source file, except
+    those of :data:`HDF5_FILE_ENTITIES`, so runs differing by any other
+    entity (``acq``, ``echo``, ``dir``, ``rec``...) have their own group.
+
+    The files are written under a temporary name and renamed when the
+    writer is closed. Writes to the same file are not thread safe.
+    """
+
+    thread_safe = False
+    resumable = False
+
+    def __init__(
+        self,
+        output_path: Path,
+        atlas: str,
+        strategy: str,
+        relmat_storage: str = "full",
+        timeseries_encoding: str = "float32",
+        relmat_top_k: int | None = None,
+        relmat_threshold: float | None = None,
+        dense_relmat: bool = True,
+    ) -> None:
+        if find_spec("h5py") is None:
+            raise ImportError(
+                "HDF5 outputs need h5py. Install it with `pip install h5py`."
+            )
+        super().__init__(
+            output_path,
+            atlas,
+            strategy,
+            relmat_storage,
+            timeseries_encoding,
+            relmat_top_k,
+            relmat_threshold,
+            dense_relmat,
+        )
+        # subject: (open file, final path)
+        self._files: dict[str, tuple[Any, Path]] = {}
+        # run_done callbacks, called once the files are renamed
+        self._done: list[tuple[str, Callable[[list[Path]], None]]] = []
+
+    def subject_file(self, subject: str) -> Path:
+        """Path of the HDF5 file of a subject."""
+        return (
+            self.output_path
+            / subject
+            / "func"
+            / (
+                f"{subject}_seg-{self.atlas}_desc-denoise"
+                f"{self.strategy.capitalize()}_connectome.h5"
+            )
+        )
+
+    @staticmethod
+    def run_group_name(source_file: str) -> str:
+        """Name of the group of a run in the subject file."""
+        stem = Path(source_file).name.split(".")[0]
+        # the last part is the suffix
+        return "_".join(
+            part
+            for part in stem.split("_")[:-1]
+            if part.split("-")[0] not in HDF5_FILE_ENTITIES
+        )
+
+    def _run_group(self, source_file: str) -> Any:
+        import h5py
+
+        subject, _, _ = utils.parse_bids_name(source_file)
+        specifier = self.run_group_name(source_file)
+        if subject not in self._files:
+            path = self.subject_file(subject)
+            utils.check_path(path)
+            tmp_path = path.with_name(f"{path.stem}.{os.getpid()}.tmp.h5")
+            self._files[subject] = (h5py.File(tmp_path, "w"), path)
+        h5_file = self._files[subject][0]
+        if specifier not in h5_file:
+            group = h5_file.create_group(specifier)
+            entities = parse_bids_filename(source_file)["entities"]
+            for entity, value in entities.items():
+                group.attrs[entity] = value
+            group.attrs["source_file"] = Path(source_file).name
+        return h5_file[specifier]
+
+    def write_metadata(
+        self, source_file: str, metadata: dict[str, Any]
+    ) -> None:
+        self._run_group(source_file).attrs["metadata"] = json.dumps(metadata)
+
+    def _read(self, source_file: str, name: str) -> Any:
+        """Read a dataset or the attributes of a group of a run, None if
+        it is not saved.
+        """
+        import h5py
+
+        subject, _, _ = utils.parse_bids_name(source_file)
+        specifier = self.run_group_name(source_file)
+        path = self.subject_file(subject)
+        if not path.exists():
+            return None
+        with h5py.File(path, "r") as h5_file:
+            name = f"{specifier}/{name}".rstrip("/")
+            if name not in h5_file:
+                return None
+            item = h5_file[name]
+            if isinstance(item, h5py.Group):
+                return dict(item.attrs)
+            return item[()], dict(item.attrs)
+
+    def has_outputs(self, source_file: str, atlas_desc: str) -> bool:
+        name = f"seg-{self.atlas}{atlas_desc}/timeseries"
+        return self._read(source_file, name) is not None
+
+    def read_timeseries(
+        self, source_file: str, atlas_desc: str
+    ) -> np.ndarray[Any, Any]:
+        data, encoding_info = self._read(
+            source_file, f"seg-{self.atlas}{atlas_desc}/timeseries"
+        )
+        if "Encoding" in encoding_info:
+            return decode_timeseries(data, encoding_info)
+        return np.asarray(data)
+
+    def read_metadata(self, source_file: str) -> dict[str, Any] | None:
+        attributes = self._read(source_file, "")
+        if attributes is None or "metadata" not in attributes:
+            return None
+        metadata: dict[str, Any] = json.loads(attributes["metadata"])
+        return metadata
+
+    def write(
+        self,
+        source_file: str,
+        atlas_desc: str,
+        correlation_matrix: np.ndarray[Any, Any],
+        time_series_atlas: np.ndarray[Any, Any],
+    ) -> None:
+        group = self._run_group(source_file).require_group(
+            f"seg-{self.atlas}{atlas_desc}"
+        )
+        timeseries, encoding_info = encode_timeseries(
+            time_series_atlas, self.timeseries_encoding
+        )
+        datasets = {"timeseries": timeseries}
+        if self.dense_relmat:
+            datasets["relmat"] = np.asarray(
+                self._relmat(correlation_matrix), dtype=np.float32
+            )
+        if self.sparse_relmat:
+            sparse = self._sparse_relmat(correlation_matrix)
+            if "relmat_sparse" in group:
+                del group["relmat_sparse"]
+            group.create_group("relmat_sparse").attrs["shape"] = sparse.shape
+            datasets.update(
+                {
+                    "relmat_sparse/row": sparse.row.astype(np.int32),
+                    "relmat_sparse/col": sparse.col.astype(np.int32),
+                    "relmat_sparse/data": sparse.data,
+                }
+            )
+        for name, data in datasets.items():
+            if name in group:
+                del group[name]
+            # empty datasets cannot be chunked
+            compression = (
+                {"compression": "gzip", "compression_opts": 4, "shuffle": True}
+                if data.size
+                else {}
+            )
+            group.create_dataset(name, data=data, **compression)
+        if self.timeseries_encoding != "float32":
+            group["timeseries"].attrs.update(encoding_info)
+        group.attrs["meas"] = "PearsonCorrelation"
+        group.attrs["StorageFormat"] = RELMAT_STORAGE[self.relmat_storage]
+
+    def run_done(
+        self, source_file: str, callback: Callable[[list[Path]], None]
+    ) -> None:
+        self._done.append((source_file, callback))
+
+    def close(self) -> None:
+        for h5_file, path in self._files.values():
+            tmp_path = h5_file.filename
+            h5_file.close()
+            os.replace(tmp_path, path)
+        self._files = {}
+        done, self._done = self._done, []
+        for source_file, callback in done:
+            subject, _, _ = utils.parse_bids_name(source_file)
+            callback(
+                [
+                    *self._outputs.pop(source_file, []),
+                    self.subject_file(subject),
+                ]
+            )
+
+
+class BackgroundWriter:
+    """Write the outputs of a writer in background threads.
+
+    The compute loop only queues the outputs, so the next image is
+    processed while the previous outputs are written. At most
+    ``max_pending`` outputs are queued, to bound the memory held by the
+    queue. Writing errors are raised by :meth:`close`.
+
+    Parameters
+    ----------
+    writer : TSVWriter or HDF5Writer
+        Writer of the outputs. Writers that are not thread safe get a
+        single thread.
+
+    n_threads : int
+        Number of writing threads.
+
+    max_pending : int or None
+        Maximum number of queued outputs. Defaults to 4 per thread.
+    """
+
+    def __init__(
+        self,
+        writer: TSVWriter,
+        n_threads: int = 1,
+        max_pending: int | None = None,
+    ) -> None:
+        if not writer.thread_safe:
+            n_threads = 1
+        self.writer = writer
+        self._executor = ThreadPoolExecutor(
+            max_workers=n_threads, thread_name_prefix="giga_connectome_writer"
+        )
+        self._pending = threading.BoundedSemaphore(
+            max_pending or 4 * n_threads
+        )
+        self._errors: list[BaseException] = []
+        # queued outputs of each source file, see run_done
+        self._run_futures: dict[str, list[Future[None]]] = {}
+
+    def run_path(self, source_file: str) -> Path:
+        """Output folder of a run."""
+        return self.writer.run_path(source_file)
+
+    def _submit(
+        self,
+        function: Callable[..., None],
+        *args: Any,
+        source_file: str | None = None,
+    ) -> None:
+        self._pending.acquire()
+        future = self._executor.submit(function, *args)
+        future.add_done_callback(self._done)
+        if source_file is not None:
+            self._run_futures.setdefault(source_file, []).append(future)
+
+    def _done(self, future: Future[None]) -> None:
+        self._pending.release()
+        error = future.exception()
+        if error is not None:
+            self._errors.append(error)
+
+    def write_metadata(
+        self, source_file: str, metadata: dict[str, Any]
+    ) -> None:
+        """Queue the metadata of the denoising of a run."""
+        self._submit(
+            self.writer.write_metadata,
+            source_file,
+            metadata,
+            source_file=source_file,
+        )
+
+    def write(
+        self,
+        source_file: str,
+        atlas_desc: str,
+        correlation_matrix: np.ndarray[Any, Any],
+        time_series_atlas: np.ndarray[Any, Any],
+    ) -> None:
+        """Queue the connectome and the time series of a run and atlas."""
+        self._submit(
+            self.writer.write,
+            source_file,
+            atlas_desc,
+            correlation_matrix,
+            time_series_atlas,
+            source_file=source_file,
+        )
+
+    def write_report(
+        self, source_file: str, atlas_desc: str, report: HTMLReport
+    ) -> None:
+        """Queue the report of the masker of a run and atlas."""
+        self._submit(
+            self.writer.write_report,
+            source_file,
+            atlas_desc,
+            report,
+            source_file=source_file,
+        )
+
+    def run_done(
+        self, source_file: str, callback: Callable[[list[Path]], None]
+    ) -> None:
+        """Call ``callback`` with the files of a run once they are saved.
+
+        Not called if any output of the run failed.
+        """
+        futures = self._run_futures.pop(source_file, [])
+
+        def done() -> None:
+            # queued after the outputs of the run, which are already
+            # running or done
+            wait(futures)
+            if all(future.exception() is None for future in futures):
+                self.writer.run_done(source_file, callback)
+
+        self._submit(done)
+
+    def write_subject_report(self, subject: str, html: str) -> None:
+        """Queue the report of a subject."""
+        self._submit(self.writer.write_subject_report, subject, html)
+
+    def close(self) -> None:
+        """Wait for the queued outputs, close the writer and raise the
+        first writing error, if any.
+        """
+        self._executor.shutdown(wait=True)
+        self.writer.close()
+        errors, self._errors = self._errors, []
+        for error in errors[1:]:
+            gc_log.error(f"Failed to write outputs: {error!r}")
+        if errors:
+            raise errors[0]
+
+
+def get_output_writer(
+    output_format: str,
+    output_path: Path,
+    atlas: str,
+    strategy: str,
+    relmat_storage: str = "full",
+    timeseries_encoding: str = "float32",
+    relmat_top_k: int | None = None,
+    relmat_threshold: float | None = None,
+    dense_relmat: bool = True,
+) -> TSVWriter:
+    """Create the writer of an output format.
+
+    Parameters
+    ----------
+    output_format : str
+        One of :data:`OUTPUT_FORMATS`.
+
+    output_path : pathlib.Path
+        Root of the output dataset.
+
+    atlas : str
+        Name of the atlas.
+
+    strategy : str
+        Name of the denoising strategy.
+
+    relmat_storage : str
+        One of the keys of :data:`RELMAT_STORAGE`.
+
+    timeseries_encoding : str
+        One of :data:`TIMESERIES_ENCODINGS`.
+
+    relmat_top_k, relmat_threshold : int or float or None
+        Save sparse connectomes, see :func:`sparsify_relmat`.
+
+    dense_relmat : bool
+        Save the dense connectomes.
+
+    Returns
+    -------
+    TSVWriter or HDF5Writer
+        Writer of the participant level outputs.
+    """
+    options = (
+        relmat_storage,
+        timeseries_encoding,
+        relmat_top_k,
+        relmat_threshold,
+        dense_relmat,
+    )
+    if output_format == "tsv":
+        return TSVWriter(output_path, atlas, strategy, *options)
+    if output_format == "hdf5":
+        return HDF5Writer(output_path, atlas, strategy, *options)
+    raise ValueError(
+        f"Unknown output format '{output_format}'. "
+        f"Choose from {OUTPUT_FORMATS}."
+    )
@@ -0,0 +1,450 @@
+"""Resources of the participant level, estimated before processing."""
+
+from __future__ import annotations
+
+from collections.abc import Callable, Sequence
+from functools import partial
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+from bids.layout import BIDSImageFile
+from nibabel.spatialimages import SpatialImage
+
+from giga_connectome import utils
+from giga_connectome.denoise import STRATEGY_TYPE, get_confounds_file
+from giga_connectome.logger import gc_logger
+from giga_connectome.timing import TIMING_COLUMNS
+
+gc_log = gc_logger()
+
+# Seconds per unit of each stage, see STAGE_UNITS. Measured with one
+# thread on the synthetic dataset of tools/benchmarks (2 mm, 200 volumes,
+# a 400 parcels atlas, 5 mm smoothing). bids_index, mask and
+# atlas_resampling need templateflow and are rough guesses.
+COST_MODEL = {
+    "bids_index": 1.0,
+    "mask": 2e-6,
+    "atlas_resampling": 1e-6,
+    "context": 6e-7,
+    "confounds": 6e-4,
+    "bold_load": 2.2e-8,
+    "smoothing": 1.7e-8,
+    "cleaning": 6.7e-9,
+    "extraction": 1.3e-9,
+    "correlation": 2.7e-10,
+    "report": 3.3,
+    "write": 1.1e-7,
+}
+STAGE_UNITS = {
+    "bids_index": "subject",
+    "mask": "voxel of the field of view",
+    "atlas_resampling": "voxel of the field of view, by atlas description",
+    "context": "voxel of the field of view, by atlas description",
+    "confounds": "volume",
+    "bold_load": "voxel of the field of view by volume",
+    "smoothing": "voxel of the field of view by volume",
+    "cleaning": "voxel of the field of view by volume",
+    "extraction": "voxel of the field of view by volume, by description",
+    "correlation": "pair of parcels by volume",
+    "report": "atlas description",
+    "write": "byte of output",
+}
+# resident memory of the imports and the subject context, in MB
+MEMORY_BASE_MB = 400.0
+# peak memory in bytes per voxel of the field of view and volume of the
+# largest run, without prefetching, and for each image prefetched
+MEMORY_PER_VOXEL_VOLUME = 10.1
+PREFETCH_PER_VOXEL_VOLUME = 1.5
+# sizes of the outputs in bytes
+TSV_BYTES_PER_VALUE = 11
+SPARSE_BYTES_PER_EDGE = 12
+METADATA_BYTES = 1500
+REPORT_BYTES = 600_000
+# assumed when the atlas configuration does not give it
+UNKNOWN_N_PARCELS = 1000
+PLAN_COLUMNS = [
+    "subject",
+    "runs",
+    "volumes",
+    "peak_memory_mb",
+    "cpu_seconds",
+    "output_bytes",
+]
+
+
+def count_rows(path: str | Path) -> int:
+    """Number of rows of a TSV file, without the header."""
+    with open(path, "rb") as file:
+        return max(sum(1 for _ in file) - 1, 0)
+
+
+def run_output_bytes(
+    n_parcels: int,
+    n_volumes: int,
+    output_format: str = "tsv",
+    relmat_storage: str = "full",
+    timeseries_encoding: str = "float32",
+    relmat_top_k: int | None = None,
+    relmat_threshold: float | None = None,
+    dense_relmat: bool = True,
+) -> int:
+    """Size of the time series and connectomes of a run and atlas.
+
+    Upper bound of the size: HDF5 datasets are counted uncompressed, and
+    all the volumes are kept. See
+    :func:`giga_connectome.outputs.get_output_writer` for the
+    parameters.
+    """
+    value_bytes = TSV_BYTES_PER_VALUE if output_format == "tsv" else 4
+    encoded_bytes = 2 if timeseries_encoding != "float32" else value_bytes
+    size = n_parcels * n_volumes * encoded_bytes
+    if dense_relmat:
+        n_values = (
+            n_parcels * (n_parcels + 1) // 2
+            if relmat_storage == "upper"
+            else n_parcels * n_parcels
+        )
+        size += n_values * value_bytes
+    if relmat_top_k is not None or relmat_threshold is not None:
+        n_edges = n_parcels * (n_parcels - 1) // 2
+        if relmat_top_k is not None:
+            n_edges = min(n_edges, n_parcels * relmat_top_k)
+        size += n_edges * SPARSE_BYTES_PER_EDGE
+    return size
+
+
+def subject_units(
+    strategy: STRATEGY_TYPE,
+    images: Sequence[BIDSImageFile],
+    n_parcels: dict[str, int],
+    output_bytes: Callable[[int, int], int] = run_output_bytes,
+    denoise_level: str = "voxel",
+    report_level: str = "run",
+) -> pd.Series:
+    """Amount of work of each stage for a subject, from the headers.
+
+    Only the header of the BOLD images and the number of rows of the
+    confounds tables are read.
+
+    Parameters
+    ----------
+    strategy : dict
+        Denoising strategy parameter to pass to load_confounds_strategy.
+
+    images : list of BIDSImageFile
+        BOLD images of the subject.
+
+    n_parcels : dict
+        Number of parcels of each atlas description.
+
+    output_bytes : Callable
+        Size of the outputs of a run and atlas, from the number of
+        parcels and volumes. See :func:`run_output_bytes`.
+
+    denoise_level : str
+        "voxel" or "parcel".
+
+    report_level : str
+        "run", "subject" or "none".
+
+    Returns
+    -------
+    pandas.Series
+        Units of each stage, see :data:`STAGE_UNITS`, with the number of
+        ``runs`` and ``volumes``, and ``max_voxel_volumes`` of the
+        largest run.
+    """
+    units = pd.Series(0.0, index=[*COST_MODEL, "runs", "volumes"])
+    max_voxel_volumes = 0
+    n_desc = len(n_parcels)
+    reports = 0 if report_level == "none" else n_desc
+    for img in images:
+        # header only, the data are not read
+        bold = nib.load(img.path)
+        if not isinstance(bold, SpatialImage):
+            raise TypeError(f"{img.path} is not a spatial image.")
+        n_voxels = int(np.prod(bold.shape[:3]))
+        n_volumes = count_rows(get_confounds_file(strategy, img.path))
+        voxel_volumes = n_voxels * n_volumes
+        max_voxel_volumes = max(max_voxel_volumes, voxel_volumes)
+        units["runs"] += 1
+        units["volumes"] += n_volumes
+        units["confounds"] += n_volumes
+        units["bold_load"] += voxel_volumes
+        if denoise_level == "voxel":
+            units["smoothing"] += voxel_volumes
+            units["cleaning"] += voxel_volumes
+        units["extraction"] += voxel_volumes * n_desc
+        units["correlation"] += n_volumes * sum(
+            parcels**2 for parcels in n_parcels.values()
+        )
+        units["write"] += METADATA_BYTES + sum(
+            output_bytes(parcels, n_volumes) for parcels in n_parcels.values()
+        )
+        if report_level == "run":
+            units["write"] += REPORT_BYTES * n_desc
+        if units["runs"] == 1:
+            units["bids_index"] = 1
+            units["mask"] = n_voxels
+            units["atlas_resampling"] = n_voxels * n_desc
+            units["context"] = n_voxels * n_desc
+            units["report"] = reports
+            if report_level == "subject":
+                units["write"] += REPORT_BYTES * n_desc
+    units["max_voxel_volumes"] = max_voxel_volumes
+    return units
+
+
+def calibrate(
+    units: pd.DataFrame, timing: pd.DataFrame, prefetch_depth: int = 0
+) -> tuple[dict[str, float], float]:
+    """Fit the cost model to the timing tables of previous runs.
+
+    Parameters
+    ----------
+    units : pandas.DataFrame
+        Units of each subject, from :func:`subject_units`, indexed by
+        subject with the ``sub-`` prefix.
+
+    timing : pandas.DataFrame
+        Timing tables of previous runs with the same atlas and strategy.
+        See :class:`giga_connectome.timing.StageTimer`. Only the subjects
+        in ``units`` are used. Without any, the default cost model is
+        returned with a warning.
+
+    prefetch_depth : int
+        Number of images read ahead in the previous runs.
+
+    Returns
+    -------
+    tuple[dict, float]
+        Seconds per unit of each stage, the stages absent from the
+        timing tables keep :data:`COST_MODEL`, and peak memory in bytes
+        per voxel of the field of view and volume of the largest run.
+    """
+    costs = dict(COST_MODEL)
+    memory_per_voxel_volume = MEMORY_PER_VOXEL_VOLUME
+    timing = timing[timing["subject"].isin(units.index)]
+    if timing.empty:
+        gc_log.warning(
+            "No subject processed before with the same atlas and strategy: "
+            "the estimates use the default cost model, measured on a "
+            "synthetic dataset, and can be far from this machine and data."
+        )
+        return costs, memory_per_voxel_volume
+    seconds = timing.pivot_table(
+        index="subject", columns="stage", values="seconds", aggfunc="sum"
+    )
+    for stage in costs:
+        if stage not in seconds:
+            continue
+        stage_seconds = seconds[stage].dropna()
+        stage_units = units.loc[stage_seconds.index, stage]
+        if stage_units.sum() > 0:
+            costs[stage] = stage_seconds.sum() / stage_units.sum()
+    peak = timing.groupby("subject")["peak_rss_mb"].max()
+    per_voxel_volume = (peak - MEMORY_BASE_MB) * 1e6 / units.loc[
+        peak.index, "max_voxel_volumes"
+    ] - prefetch_depth * PREFETCH_PER_VOXEL_VOLUME
+    if (per_voxel_volume > 0).any():
+        memory_per_voxel_volume = float(
+            per_voxel_volume[per_voxel_volume > 0].median()
+        )
+    gc_log.info(
+        f"Cost model calibrated on the timing tables of {len(seconds)} "
+        f"subjects processed before: {', '.join(seconds.index)}."
+    )
+    return costs, memory_per_voxel_volume
+
+
+def estimate(
+    units: pd.DataFrame,
+    costs: dict[str, float] = COST_MODEL,
+    memory_per_voxel_volume: float = MEMORY_PER_VOXEL_VOLUME,
+    prefetch_depth: int = 0,
+) -> pd.DataFrame:
+    """Peak memory, CPU time and size of the outputs of each subject.
+
+    Parameters
+    ----------
+    units : pandas.DataFrame
+        Units of each subject, from :func:`subject_units`, indexed by
+        subject.
+
+    costs : dict
+        Seconds per unit of each stage.
+
+    memory_per_voxel_volume : float
+        Peak memory in bytes per voxel of the field of view and volume
+        of the largest run.
+
+    prefetch_depth : int
+        Number of images read ahead.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per subject, see :data:`PLAN_COLUMNS`.
+    """
+    stages = list(costs)
+    per_voxel_volume = (
+        memory_per_voxel_volume
+        + prefetch_depth * PREFETCH_PER_VOXEL_VOLUME
+    )
+    return pd.DataFrame(
+        {
+            "subject": units.index,
+            "runs": units["runs"].astype(int).to_numpy(),
+            "volumes": units["volumes"].astype(int).to_numpy(),
+            "peak_memory_mb": (
+                MEMORY_BASE_MB
+                + units["max_voxel_volumes"] * per_voxel_volume / 1e6
+            ).to_numpy(),
+            "cpu_seconds": (units[stages] * pd.Series(costs))
+            .sum(axis=1)
+            .to_numpy(),
+            "output_bytes": units["write"].astype(np.int64).to_numpy(),
+        },
+        columns=PLAN_COLUMNS,
+    )
+
+
+def plan_dataset(
+    subjects: Sequence[str],
+    template: str,
+    bids_dir: Path,
+    reindex_bids: bool,
+    bids_filters: None | dict[str, dict[str, str]],
+    strategy: STRATEGY_TYPE,
+    atlas_name: str,
+    n_parcels: dict[str, int | None],
+    output_dir: Path,
+    denoise_level: str = "voxel",
+    output_format: str = "tsv",
+    relmat_storage: str = "full",
+    timeseries_encoding: str = "float32",
+    relmat_top_k: int | None = None,
+    relmat_threshold: float | None = None,
+    dense_relmat: bool = True,
+    prefetch_depth: int = 0,
+    report_level: str = "run",
+) -> pd.DataFrame:
+    """Estimate the resources of each subject without loading any image.
+
+    The dataset is indexed, and only the headers of the BOLD images and
+    the number of rows of the confounds tables are read. The cost model
+    is calibrated on the timing tables in ``output_dir/logs`` of the
+    subjects already processed with the same atlas and strategy, planned
+    or not. Without any, the default cost model is used, see
+    :func:`calibrate`.
+
+    Parameters
+    ----------
+    subjects : list of str
+        Subjects, without the ``sub-`` prefix.
+
+    atlas_name : str
+        Name of the atlas, in the timing tables.
+
+    n_parcels : dict
+        Number of parcels of each atlas description, None if unknown.
+        See :func:`giga_connectome.atlas.get_atlas_n_parcels`.
+
+    output_dir : pathlib.Path
+        Output directory of the participant level.
+
+    The other parameters are the ones of
+    :func:`giga_connectome.utils.get_bids_images` and
+    :func:`giga_connectome.postprocess.run_postprocessing_dataset`.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per subject, see :data:`PLAN_COLUMNS`.
+    """
+    known_parcels = {}
+    for desc, parcels in n_parcels.items():
+        if parcels is None:
+            gc_log.warning(
+                f"Number of parcels of {atlas_name} {desc} unknown, "
+                f"assuming {UNKNOWN_N_PARCELS}."
+            )
+            parcels = UNKNOWN_N_PARCELS
+        known_parcels[desc] = parcels
+    output_bytes = partial(
+        run_output_bytes,
+        output_format=output_format,
+        relmat_storage=relmat_storage,
+        timeseries_encoding=timeseries_encoding,
+        relmat_top_k=relmat_top_k,
+        relmat_threshold=relmat_threshold,
+        dense_relmat=dense_relmat,
+    )
+    timing_files = sorted(
+        (output_dir / "logs").glob(
+            f"sub-*_seg-{atlas_name}_desc-denoise"
+            f"{strategy['name'].capitalize()}_timing.tsv"
+        )
+    )
+    timing = pd.DataFrame(columns=TIMING_COLUMNS)
+    if timing_files:
+        timing = pd.concat(
+            pd.read_csv(path, sep="\t", dtype={"run": str, "seg": str})
+            for path in timing_files
+        )
+    # the subjects processed before calibrate the estimates of the others
+    processed = [
+        subject.removeprefix("sub-")
+        for subject in timing["subject"].unique()
+        if subject.removeprefix("sub-") not in subjects
+    ]
+    units = {}
+    for subject in [*subjects, *processed]:
+        subj_data, _ = utils.get_bids_images(
+            [subject], template, bids_dir, reindex_bids, bids_filters
+        )
+        units[f"sub-{subject}"] = subject_units(
+            strategy,
+            subj_data["bold"],
+            known_parcels,
+            output_bytes,
+            denoise_level,
+            report_level,
+        )
+    units_table = pd.DataFrame(units).T
+    costs, memory_per_voxel_volume = calibrate(
+        units_table[units_table["runs"] > 0], timing, prefetch_depth
+    )
+    return estimate(
+        units_table.loc[[f"sub-{subject}" for subject in subjects]],
+        costs,
+        memory_per_voxel_volume,
+        prefetch_depth,
+    )
+
+
+def format_plan(plan: pd.DataFrame) -> str:
+    """Table of the plan with a total row, in GB, minutes and MB."""
+    table = pd.DataFrame(
+        {
+            "subject": plan["subject"],
+            "runs": plan["runs"],
+            "volumes": plan["volumes"],
+            "peak memory (GB)": plan["peak_memory_mb"] / 1e3,
+            "CPU time (min)": plan["cpu_seconds"] / 60,
+            "outputs (MB)": plan["output_bytes"] / 1e6,
+        }
+    )
+    # subjects are processed one after the other
+    total = {
+        "subject": "total",
+        "runs": plan["runs"].sum(),
+        "volumes": plan["volumes"].sum(),
+        "peak memory (GB)": table["peak memory (GB)"].max(),
+        "CPU time (min)": table["CPU time (min)"].sum(),
+        "outputs (MB)": table["outputs (MB)"].sum(),
+    }
+    table = pd.concat([table, pd.DataFrame([total])], ignore_index=True)
+    return table.to_string(index=False, float_format="%.1f")
@@ -1,25 +1,42 @@
 from __future__ import annotations
 
-import json
-from collections.abc import Sequence
+from collections.abc import Iterator, Sequence
+from contextlib import closing, contextmanager
+from functools import partial
 from pathlib import Path
 from typing import Any
 
 import numpy as np
-import pandas as pd
 from bids.layout import BIDSImageFile
 from nilearn.connectome import ConnectivityMeasure
-from nilearn.maskers import NiftiLabelsMasker, NiftiMapsMasker
 
 from giga_connectome import utils
 from giga_connectome.atlas import ATLAS_SETTING_TYPE
-from giga_connectome.connectome import generate_timeseries_connectomes
+from giga_connectome.cache import VoxelCache
+from giga_connectome.confounds import ConfoundsCache
+from giga_connectome.connectome import extract_timeseries_connectomes
+from giga_connectome.context import SubjectContext, build_subject_context
 from giga_connectome.denoise import (
+    METADATA_TYPE,
+    PARCEL_CLEANER_TYPE,
     STRATEGY_TYPE,
+    LoadedRun,
+    denoise_loaded_run,
     denoise_meta_data,
-    denoise_nifti_voxel,
+    get_confounds_file,
+    load_run,
+    prepare_parcel_cleaner,
 )
+from giga_connectome.loader import prefetch
 from giga_connectome.logger import gc_logger
+from giga_connectome.manifest import Manifest, input_hash, parameter_hash
+from giga_connectome.outputs import (
+    BackgroundWriter,
+    TSVWriter,
+    get_output_writer,
+)
+from giga_connectome.reports import AtlasReports, SubjectReport
+from giga_connectome.timing import StageTimer, timed
 from giga_connectome.utils import progress_bar
 
 gc_log = gc_logger()
@@ -35,17 +52,32 @@ def run_postprocessing_dataset(
     smoothing_fwhm: float,
     output_path: Path,
     calculate_average_correlation: bool = False,
+    denoise_level: str = "voxel",
+    n_jobs: int = 1,
+    confounds_cache: ConfoundsCache | None = None,
+    output_format: str = "tsv",
+    relmat_storage: str = "full",
+    timeseries_encoding: str = "float32",
+    relmat_top_k: int | None = None,
+    relmat_threshold: float | None = None,
+    dense_relmat: bool = True,
+    n_writers: int = 0,
+    prefetch_depth: int = 0,
+    report_level: str = "run",
+    resume: bool = False,
+    voxel_cache: VoxelCache | None = None,
+    timer: StageTimer | None = None,
 ) -> None:
     """
     Generate subject and group level timeseries and connectomes.
 
     The time series data is denoised as follow:
 
-    - Time series extractions through label or map maskers are performed \
-        on the denoised nifti file. Denoising steps are performed on the \
-        voxel level:
+    - The subject mask and the atlases are loaded once and shared by all \
+        runs of the subject. Denoising steps are performed on the voxel \
+        level:
 
-        - spatial smoothing
+        - spatial smoothing, on the bounding box of the subject mask
 
         - detrend, only if high pass filter is not applied through confounds
 
@@ -59,7 +91,13 @@ def run_postprocessing_dataset(
 
     - Optional: average correlation within each parcel.
 
-    - Save timeseries and correlation matrix to h5 file
+    - Optional: with ``denoise_level="parcel"``, the time series are \
+        extracted from the raw data and the denoising steps are performed \
+        on the parcel level. The deviation from the voxel level results \
+        is measured on the first run of the subject.
+
+    - Save timeseries and correlation matrix to tsv files, or to one \
+        h5 file per subject
 
     - Optional: Create average correlation matrix across subjects when using \
         group level analysis.
@@ -96,15 +134,90 @@ def run_postprocessing_dataset(
 
     calculate_average_correlation : bool
         Whether to calculate average correlation within each parcel.
+
+    denoise_level : str
+        "voxel" to denoise before extraction, "parcel" to denoise the \
+            parcel time series after extraction. "parcel" requires no \
+            smoothing.
+
+    n_jobs : int
+        Number of threads used for spatial smoothing.
+
+    confounds_cache : ConfoundsCache or None
+        Cache of the confounds tables, used for the metadata. Pass a \
+            strategy from :func:`giga_connectome.denoise.cache_strategy` \
+            to also cache the confounds of the strategy.
+
+    output_format : str
+        "tsv" for one file per run and atlas, "hdf5" for one file per \
+            subject. See :mod:`giga_connectome.outputs`.
+
+    relmat_storage : str
+        "full" for the N by N connectomes, "upper" for their upper \
+            triangles with the diagonal.
+
+    timeseries_encoding : str
+        "float32" for full precision time series, "float16" or "int16" \
+            to quantise them. See \
+            :func:`giga_connectome.outputs.encode_timeseries`.
+
+    relmat_top_k : int or None
+        Also save sparse connectomes with the ``relmat_top_k`` strongest \
+            edges of each node.
+
+    relmat_threshold : float or None
+        Also save sparse connectomes with the edges above this absolute \
+            value. See :func:`giga_connectome.outputs.sparsify_relmat`.
+
+    dense_relmat : bool
+        Save the dense connectomes. Can only be skipped with sparse \
+            connectomes.
+
+    n_writers : int
+        Number of background threads writing the outputs, so the next \
+            image is processed while the outputs are written. 0 writes \
+            the outputs before processing the next image.
+
+    prefetch_depth : int
+        Number of images read and decompressed in a background thread \
+            while the current image is processed. Each holds the data of \
+            a run in memory. 0 reads each image when it is processed.
+
+    report_level : str
+        "run" for one report per run and atlas, "subject" for a single \
+            report per subject, "none" to skip the reports. See \
+            :mod:`giga_connectome.reports`.
+
+    resume : bool
+        Skip the images completed by a previous run with the same inputs \
+            and parameters, according to the manifest of the subject in \
+            ``output_path/logs/manifest``. See \
+            :class:`giga_connectome.manifest.Manifest`. The manifest is \
+            updated either way.
+
+    voxel_cache : VoxelCache or None
+        Cache of the denoised voxel time series, reused by later runs \
+            with other atlases. Only used at the voxel denoising level. \
+            See :class:`giga_connectome.cache.VoxelCache`.
+
+    timer : StageTimer or None
+        Records the time and peak memory of each stage, by run and \
+            atlas. See :class:`giga_connectome.timing.StageTimer`.
     """
-    atlas_maskers: dict[str, (NiftiLabelsMasker | NiftiMapsMasker)] = {}
-    connectomes: dict[str, list[np.ndarray[Any, Any]]] = {}
-    for atlas_path in resampled_atlases:
-        if isinstance(atlas_path, str):
-            atlas_path = Path(atlas_path)
-        seg = atlas_path.name.split("seg-")[-1].split("_")[0]
-        atlas_maskers[seg] = _get_masker(atlas_path)
-        connectomes[seg] = []
+    if denoise_level == "parcel" and smoothing_fwhm:
+        raise ValueError(
+            "Parcel level denoising is only available without spatial "
+            "smoothing."
+        )
+    with timed(timer, "context"):
+        context = build_subject_context(group_mask, resampled_atlases)
+    # rendered once per subject and atlas
+    reports = AtlasReports(context) if report_level == "run" else None
+    subject_report = None
+    if report_level == "subject":
+        subject_report = SubjectReport(
+            context, atlas["name"], strategy["name"]
+        )
 
     correlation_measure = ConnectivityMeasure(
         kind="correlation", vectorize=False, discard_diagonal=False
@@ -113,125 +226,321 @@ def run_postprocessing_dataset(
     # transform data
     gc_log.info("Processing subject")
 
-    with progress_bar(text="Processing subject") as progress:
+    output_writer = get_output_writer(
+        output_format,
+        output_path,
+        atlas["name"],
+        strategy["name"],
+        relmat_storage,
+        timeseries_encoding,
+        relmat_top_k,
+        relmat_threshold,
+        dense_relmat,
+    )
+    writer: TSVWriter | BackgroundWriter = output_writer
+    if n_writers > 0:
+        writer = BackgroundWriter(output_writer, n_writers)
+
+    subject = utils.parse_bids_name(images[0].path)[0] if images else ""
+    manifest = Manifest(
+        output_path,
+        f"{subject}_seg-{atlas['name']}_desc-denoise"
+        f"{strategy['name'].capitalize()}",
+    )
+    parameters = parameter_hash(
+        {
+            "strategy": strategy["name"],
+            "strategy_parameters": strategy["parameters"],
+            "atlas": atlas["name"],
+            "standardize": standardize,
+            "smoothing_fwhm": smoothing_fwhm,
+            "calculate_average_correlation": calculate_average_correlation,
+            "denoise_level": denoise_level,
+            "output_format": output_format,
+            "relmat_storage": relmat_storage,
+            "timeseries_encoding": timeseries_encoding,
+            "relmat_top_k": relmat_top_k,
+            "relmat_threshold": relmat_threshold,
+            "dense_relmat": dense_relmat,
+            "report_level": report_level,
+        }
+    )
+    run_inputs = {
+        img.path: _input_hash(
+            strategy, img.path, group_mask, resampled_atlases
+        )
+        for img in images
+    }
+    complete = [
+        resume
+        and manifest.is_complete(
+            Path(img.path).name, run_inputs[img.path], parameters
+        )
+        for img in images
+    ]
+    # the outputs of a subject are rewritten together
+    if not output_writer.resumable and not all(complete):
+        complete = [False] * len(images)
+    if any(complete):
+        gc_log.info(
+            f"Skipping {sum(complete)} of {len(images)} images completed "
+            "by a previous run."
+        )
+    if subject_report is not None:
+        for img, done in zip(images, complete, strict=True):
+            if done:
+                subject_report.add_saved_run(output_writer, img.path)
+    todo = [
+        img for img, done in zip(images, complete, strict=True) if not done
+    ]
+
+    def cache_path(img: BIDSImageFile) -> Path | None:
+        if voxel_cache is None or denoise_level != "voxel":
+            return None
+        return voxel_cache.run_path(
+            strategy, context, img.path, smoothing_fwhm, standardize
+        )
+
+    def load_image(
+        img: BIDSImageFile,
+    ) -> tuple[LoadedRun | np.ndarray[Any, Any] | None, METADATA_TYPE | None]:
+        run_timer = None if timer is None else timer.bind(img.path)
+        path = cache_path(img)
+        cached = None
+        if voxel_cache is not None and path is not None:
+            with timed(run_timer, "cache_read"):
+                cached = voxel_cache.read(path)
+        run: LoadedRun | np.ndarray[Any, Any] | None = cached
+        if cached is None:
+            run = load_run(
+                strategy,
+                context,
+                smoothing_fwhm,
+                img.path,
+                run_timer,
+            )
+            if run is None:
+                return None, None
+        with timed(run_timer, "confounds"):
+            meta_data = denoise_meta_data(strategy, img.path, confounds_cache)
+        return run, meta_data
+
+    # the next images are read while the current one is processed, and
+    # the outputs are saved even if processing fails
+    with (
+        _closing_writer(writer, timer),
+        closing(prefetch(load_image, todo, prefetch_depth)) as loaded,
+        progress_bar(text="Processing subject") as progress,
+    ):
         task = progress.add_task(
             description="processing subject", total=len(images)
         )
+        progress.update(task, advance=sum(complete))
 
-        for img in images:
+        check_deviation = denoise_level == "parcel"
+        for img, (run, meta_data) in loaded:
             print()
             gc_log.info(f"Processing image:\n{img.filename}")
+            run_timer = None if timer is None else timer.bind(img.path)
 
             # process timeseries
-            denoised_img = denoise_nifti_voxel(
-                strategy, group_mask, standardize, smoothing_fwhm, img.path
+            time_series_voxel, parcel_cleaner = _denoise_image(
+                run, context, standardize, denoise_level, n_jobs, run_timer
             )
+            path = cache_path(img)
+            if (
+                voxel_cache is not None
+                and path is not None
+                and isinstance(run, LoadedRun)
+                and time_series_voxel is not None
+            ):
+                with timed(run_timer, "cache_write"):
+                    voxel_cache.write(path, time_series_voxel)
+            deviation = None
+            if check_deviation and parcel_cleaner is not None:
+                deviation = _parcel_level_deviation(
+                    context,
+                    time_series_voxel,
+                    parcel_cleaner,
+                    correlation_measure,
+                )
+                check_deviation = False
 
-            # parse file name
-            subject, session, specifier = utils.parse_bids_name(img.path)
-
-            # folder for this subject output
-            connectome_path = output_path / subject
-            if session:
-                connectome_path = connectome_path / session
-            connectome_path = connectome_path / "func"
-
-            # All timeseries derivatives of the same scan have the same
-            # metadata so one json file for them all.
-            # see https://bids.neuroimaging.io/bep012
-            json_filename = connectome_path / utils.output_filename(
-                source_file=Path(img.filename).stem,
-                atlas=atlas["name"],
-                atlas_desc="",
-                strategy=strategy["name"],
-                suffix="timeseries",
-                extension="json",
-            )
-            utils.check_path(json_filename)
-            if denoised_img:
-                meta_data = denoise_meta_data(strategy, img.path)
+            sidecar: dict[str, Any] | None = None
+            if meta_data is not None:
                 meta_data["SamplingFrequency"] = (
                     1 / img.entities["RepetitionTime"]
                 )
-                with open(json_filename, "w") as f:
-                    json.dump(meta_data, f, indent=4)
-
-            for seg, masker in atlas_maskers.items():
-                if not denoised_img:
-                    time_series_atlas, correlation_matrix = None, None
+                sidecar = dict(meta_data)
+                if deviation is not None:
+                    sidecar["ParcelLevelDenoisingMaxDeviation"] = deviation
+                with timed(run_timer, "write"):
+                    writer.write_metadata(img.path, sidecar)
+            if subject_report is not None:
+                subject_report.add_run(img.path, sidecar)
+
+            for seg, atlas_context in context.atlases.items():
+                if time_series_voxel is None:
+                    _, _, specifier = utils.parse_bids_name(img.path)
                     attribute_name = f"{subject}_{specifier}_seg-{seg}"
                     gc_log.info(f"{attribute_name}: no volume after scrubbing")
                     progress.update(task, advance=1)
                     continue
 
+                seg_timer = (
+                    None if run_timer is None else run_timer.bind(seg=seg)
+                )
                 # extract timeseries and connectomes
-                correlation_matrix, time_series_atlas, masker = (
-                    generate_timeseries_connectomes(
-                        masker,
-                        denoised_img,
-                        group_mask,
+                correlation_matrix, time_series_atlas = (
+                    extract_timeseries_connectomes(
+                        atlas_context,
+                        time_series_voxel,
                         correlation_measure,
                         calculate_average_correlation,
+                        parcel_cleaner,
+                        seg_timer,
                     )
                 )
 
                 # reverse engineer atlas_desc
                 desc = seg.split(atlas["name"])[-1]
-                # dump correlation_matrix to tsv
-                relmat_filename = connectome_path / utils.output_filename(
-                    source_file=Path(img.filename).stem,
-                    atlas=atlas["name"],
-                    suffix="relmat",
-                    extension="tsv",
-                    strategy=strategy["name"],
-                    atlas_desc=desc,
-                )
-                utils.check_path(relmat_filename)
-                df = pd.DataFrame(correlation_matrix)
-                df.to_csv(relmat_filename, sep="\t", index=False)
-
-                # dump timeseries to tsv file
-                timeseries_filename = connectome_path / utils.output_filename(
-                    source_file=Path(img.filename).stem,
-                    atlas=atlas["name"],
-                    suffix="timeseries",
-                    extension="tsv",
-                    strategy=strategy["name"],
-                    atlas_desc=desc,
-                )
-                utils.check_path(timeseries_filename)
-                df = pd.DataFrame(time_series_atlas)
-                df.to_csv(timeseries_filename, sep="\t", index=False)
-
-                report = masker.generate_report()
-                report_filename = connectome_path / utils.output_filename(
-                    source_file=Path(img.filename).stem,
-                    atlas=atlas["name"],
-                    suffix="report",
-                    extension="html",
-                    strategy=strategy["name"],
-                    atlas_desc=desc,
-                )
-                report.save_as_html(report_filename)
+                with timed(seg_timer, "write"):
+                    writer.write(
+                        img.path, desc, correlation_matrix, time_series_atlas
+                    )
+
+                if reports is not None:
+                    with timed(seg_timer, "report"):
+                        report = reports[seg]
+                    with timed(seg_timer, "write"):
+                        writer.write_report(img.path, desc, report)
+                if subject_report is not None:
+                    subject_report.add_timeseries(
+                        img.path, seg, time_series_atlas
+                    )
 
+            # recorded once the outputs of the run are saved
+            writer.run_done(
+                img.path,
+                partial(
+                    manifest.record,
+                    Path(img.path).name,
+                    run_inputs[img.path],
+                    parameters,
+                ),
+            )
             progress.update(task, advance=1)
+        if subject_report is not None and images:
+            with timed(timer, "report"):
+                html = subject_report.render(subject)
+            writer.write_subject_report(subject, html)
+
+    gc_log.info(f"Saved to:\n{output_path / subject}")
+
 
-    gc_log.info(f"Saved to:\n{connectome_path}")
+@contextmanager
+def _closing_writer(
+    writer: TSVWriter | BackgroundWriter, timer: StageTimer | None = None
+) -> Iterator[None]:
+    """Close the writer on exit, waiting for the background writers.
+
+    After a processing error, the outputs already queued are saved and
+    writing errors are logged, so that they do not hide the first error.
+    """
+    try:
+        yield
+    except BaseException:
+        try:
+            writer.close()
+        except Exception as error:
+            gc_log.error(f"Failed to write outputs: {error!r}")
+        raise
+    with timed(timer, "write"):
+        writer.close()
+
+
+def _denoise_image(
+    run: LoadedRun | np.ndarray[Any, Any] | None,
+    context: SubjectContext,
+    standardize: bool,
+    denoise_level: str,
+    n_jobs: int = 1,
+    timer: StageTimer | None = None,
+) -> tuple[np.ndarray[Any, Any] | None, PARCEL_CLEANER_TYPE | None]:
+    """Denoise one loaded image at the voxel level, or prepare the parcel
+    level denoising. Returns the voxel time series and the parcel cleaning
+    step, if any. Time series from the voxel cache are returned as is.
+    """
+    if run is None:
+        return None, None
+    if isinstance(run, np.ndarray):
+        # denoised voxel time series from the cache
+        return run, None
+    if denoise_level == "parcel":
+        with timed(timer, "cleaning"):
+            return prepare_parcel_cleaner(run, context, standardize)
+    time_series_voxel = denoise_loaded_run(
+        run, context, standardize, n_jobs, timer
+    )
+    return time_series_voxel, None
 
 
-def _get_masker(atlas_path: Path) -> NiftiLabelsMasker | NiftiMapsMasker:
-    """Get the masker object based on the templateflow file name suffix."""
-    atlas_type = atlas_path.name.split("_")[-1].split(".nii")[0]
-    if atlas_type == "dseg":
-        atlas_masker = NiftiLabelsMasker(
-            labels_img=atlas_path,
-            standardize=False,
-            cmap="gray",
+def _parcel_level_deviation(
+    context: SubjectContext,
+    raw_voxel: np.ndarray[Any, Any] | None,
+    parcel_cleaner: PARCEL_CLEANER_TYPE,
+    correlation_measure: ConnectivityMeasure,
+) -> dict[str, dict[str, float]]:
+    """Compare parcel level denoising against voxel level denoising.
+
+    The cleaning step of the run applied to the raw voxels is the voxel
+    level denoising without smoothing.
+
+    Returns the maximum absolute difference of the time series and the
+    correlation matrices for each atlas.
+    """
+    deviation: dict[str, dict[str, float]] = {}
+    if raw_voxel is None:
+        return deviation
+    time_series_voxel = parcel_cleaner(raw_voxel)
+    for seg, atlas_context in context.atlases.items():
+        reference = extract_timeseries_connectomes(
+            atlas_context, time_series_voxel, correlation_measure, False
         )
-    elif atlas_type == "probseg":
-        atlas_masker = NiftiMapsMasker(
-            maps_img=atlas_path,
-            standardize=False,
-            cmap="gray",
+        shortcut = extract_timeseries_connectomes(
+            atlas_context,
+            raw_voxel,
+            correlation_measure,
+            False,
+            parcel_cleaner,
         )
-    return atlas_masker
+        deviation[seg] = {
+            "relmat": float(np.max(np.abs(shortcut[0] - reference[0]))),
+            "timeseries": float(np.max(np.abs(shortcut[1] - reference[1]))),
+        }
+        gc_log.info(
+            f"seg-{seg}: parcel level denoising deviates from voxel level "
+            f"denoising by at most {deviation[seg]['relmat']:.4f} "
+            "(correlation) and "
+            f"{deviation[seg]['timeseries']:.4f} (time series)."
+        )
+    return deviation
+
+
+def _input_hash(
+    strategy: STRATEGY_TYPE,
+    img: str,
+    group_mask: str | Path,
+    resampled_atlases: Sequence[str | Path],
+) -> str:
+    """Hash of the image, its confounds, the mask and the atlases."""
+    confounds_file = get_confounds_file(strategy, img)
+    return input_hash(
+        [
+            img,
+            confounds_file,
+            str(confounds_file).replace(".tsv", ".json"),
+            group_mask,
+            *resampled_atlases,
+        ]
+    )
@@ -0,0 +1,192 @@
+"""CPU and memory profiles of the processing of a subject."""
+
+from __future__ import annotations
+
+import cProfile
+import io
+import pstats
+import threading
+import tracemalloc
+from collections.abc import Iterator, Sequence
+from contextlib import contextmanager
+from pathlib import Path
+
+PROFILERS = ["cpu", "memory"]
+# frames kept for each traced allocation
+TRACEMALLOC_FRAMES = 10
+# functions and allocation sites listed in the text summaries
+N_TOP = 40
+
+
+class Profiler:
+    """cProfile and tracemalloc profiles of a subject.
+
+    Without ``stages``, the CPU profile covers the whole subject in the
+    calling thread, and the memory profile all the stages. With
+    ``stages``, only these stages of a
+    :class:`giga_connectome.timing.StageTimer` are profiled, in whichever
+    thread runs them, including the prefetch and writing threads.
+    One call is CPU profiled at a time: calls overlapping a profiled one
+    in another thread are skipped and counted in the summary.
+
+    The memory profile traces every Python and numpy allocation with
+    :mod:`tracemalloc`, so it slows the processing down. It records the
+    traced peak of each stage, and a snapshot of the live allocations at
+    the end of the stage holding the most memory.
+
+    Parameters
+    ----------
+    profilers : list of str
+        "cpu" and/or "memory".
+
+    stages : list of str
+        Stages to profile, see :data:`giga_connectome.timing.STAGES`.
+        Empty to profile the whole subject.
+    """
+
+    def __init__(
+        self, profilers: Sequence[str], stages: Sequence[str] = ()
+    ) -> None:
+        unknown = set(profilers) - set(PROFILERS)
+        if unknown:
+            raise ValueError(
+                f"Unknown profilers {sorted(unknown)}, use {PROFILERS}."
+            )
+        self.cpu = "cpu" in profilers
+        self.memory = "memory" in profilers
+        self.stages = set(stages)
+        self._lock = threading.Lock()
+        # held by the CPU profiled stage call
+        self._cpu_active = threading.Lock()
+        self._cpu_skipped = 0
+        self._stats: pstats.Stats | None = None
+        # stage: [traced peak in bytes, calls]
+        self._memory_peaks: dict[str, list[int]] = {}
+        self._largest: tuple[int, str, tracemalloc.Snapshot] | None = None
+
+    @contextmanager
+    def profile(self) -> Iterator[None]:
+        """Profile the processing of a subject."""
+        whole = self.cpu and not self.stages
+        profile = cProfile.Profile() if whole else None
+        if self.memory:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                self._add_stats(profile)
+            if self.memory:
+                tracemalloc.stop()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Profile a stage if it is selected."""
+        selected = not self.stages or name in self.stages
+        profile = None
+        if self.cpu and self.stages and selected:
+            if self._cpu_active.acquire(blocking=False):
+                profile = cProfile.Profile()
+            else:
+                with self._lock:
+                    self._cpu_skipped += 1
+        trace = self.memory and selected and tracemalloc.is_tracing()
+        if trace:
+            tracemalloc.reset_peak()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                self._cpu_active.release()
+                self._add_stats(profile)
+            if trace:
+                self._add_memory(name)
+
+    def _add_stats(self, profile: cProfile.Profile) -> None:
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+
+    def _add_memory(self, name: str) -> None:
+        current, peak = tracemalloc.get_traced_memory()
+        with self._lock:
+            row = self._memory_peaks.setdefault(name, [0, 0])
+            row[0] = max(row[0], peak)
+            row[1] += 1
+            if self._largest is not None and current <= self._largest[0]:
+                return
+        # outside the lock, snapshots are slow
+        snapshot = tracemalloc.take_snapshot()
+        with self._lock:
+            if self._largest is None or current > self._largest[0]:
+                self._largest = (current, name, snapshot)
+
+    def write(self, stem: Path) -> list[Path]:
+        """Write the profiles.
+
+        Parameters
+        ----------
+        stem : pathlib.Path
+            Path of the profiles, without suffix.
+
+        Returns
+        -------
+        list of pathlib.Path
+            ``{stem}_cpu.prof``, to open with :mod:`pstats` or snakeviz,
+            and its summary ``{stem}_cpu.txt``, and the memory summary
+            ``{stem}_memory.txt``, for the enabled profilers.
+        """
+        stem.parent.mkdir(parents=True, exist_ok=True)
+        paths = []
+        if self._stats is not None:
+            prof_path = stem.with_name(f"{stem.name}_cpu.prof")
+            self._stats.dump_stats(prof_path)
+            summary = io.StringIO()
+            if self._cpu_skipped:
+                summary.write(
+                    f"{self._cpu_skipped} stage calls overlapping a "
+                    "profiled call were not profiled.\n"
+                )
+            stats = pstats.Stats(str(prof_path), stream=summary)
+            stats.sort_stats("cumulative").print_stats(N_TOP)
+            stats.sort_stats("tottime").print_stats(N_TOP)
+            txt_path = stem.with_name(f"{stem.name}_cpu.txt")
+            txt_path.write_text(summary.getvalue())
+            paths += [prof_path, txt_path]
+        if self.memory:
+            txt_path = stem.with_name(f"{stem.name}_memory.txt")
+            txt_path.write_text(self._memory_summary())
+            paths.append(txt_path)
+        return paths
+
+    def _memory_summary(self) -> str:
+        lines = ["Traced peak by stage (MB, calls)"]
+        for name, (peak, calls) in sorted(
+            self._memory_peaks.items(), key=lambda item: -item[1][0]
+        ):
+            lines.append(f"{name:<20}{peak / 1e6:>12.1f}{calls:>8}")
+        if self._largest is not None:
+            current, name, snapshot = self._largest
+            lines += [
+                "",
+                f"Largest live allocations, {current / 1e6:.1f} MB at the "
+                f"end of the {name} stage",
+            ]
+            for statistic in snapshot.statistics("traceback")[:N_TOP]:
+                lines.append(
+                    f"{statistic.size / 1e6:.1f} MB in "
+                    f"{statistic.count} blocks"
+                )
+                lines += [
+                    f"    {line}"
+                    for line in statistic.traceback.format(limit=3)
+                ]
+        return "\n".join(lines) + "\n"
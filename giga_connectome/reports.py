@@ -0,0 +1,296 @@
+"""Reports of the atlases on the subject grey matter mask."""
+
+from __future__ import annotations
+
+import base64
+import io
+from collections.abc import Sequence
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+import numpy as np
+from bids.layout import BIDSImageFile
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+from giga_connectome import utils
+from giga_connectome._version import __version__
+from giga_connectome.atlas import ATLAS_SETTING_TYPE
+from giga_connectome.context import (
+    AtlasContext,
+    SubjectContext,
+    build_subject_context,
+)
+from giga_connectome.logger import gc_logger
+from giga_connectome.outputs import TSVWriter, get_output_writer
+
+if TYPE_CHECKING:
+    from nilearn.reporting import HTMLReport
+
+gc_log = gc_logger()
+
+# "run": one report per run and atlas, "subject": one report per subject,
+# "none": no report
+REPORT_LEVELS = ["run", "subject", "none"]
+
+
+class AtlasReports:
+    """Reports of the maskers of a subject context, rendered once.
+
+    The maskers are fitted on the subject mask only, so their reports
+    are the same for all runs of the subject. Each report is rendered
+    the first time it is needed and reused for the other runs.
+
+    Parameters
+    ----------
+    context : SubjectContext
+        Subject context. \
+            See :func:`giga_connectome.context.build_subject_context`.
+    """
+
+    def __init__(self, context: SubjectContext) -> None:
+        self.context = context
+        self._reports: dict[str, HTMLReport] = {}
+
+    def __getitem__(self, seg: str) -> HTMLReport:
+        if seg not in self._reports:
+            masker = self.context.atlases[seg].masker
+            self._reports[seg] = masker.generate_report()
+        return self._reports[seg]
+
+
+class SubjectReport:
+    """One HTML report per subject for all runs and atlases.
+
+    Each atlas is shown once on the subject grey matter mask, with the
+    average connectome across runs. Tables summarise the denoising of
+    each run and its parcel signals. Figures are embedded, so the report
+    is a single file.
+
+    Parameters
+    ----------
+    context : SubjectContext
+        Subject context. \
+            See :func:`giga_connectome.context.build_subject_context`.
+
+    atlas : str
+        Name of the atlas.
+
+    strategy : str
+        Name of the denoising strategy.
+    """
+
+    def __init__(
+        self, context: SubjectContext, atlas: str, strategy: str
+    ) -> None:
+        self.context = context
+        self.atlas = atlas
+        self.strategy = strategy
+        self._runs: dict[str, dict[str, Any]] = {}
+        self._atlas_runs: dict[str, list[dict[str, Any]]] = {
+            seg: [] for seg in context.atlases
+        }
+        self._connectome_sums: dict[str, np.ndarray[Any, Any]] = {}
+
+    def add_run(
+        self, source_file: str, metadata: dict[str, Any] | None
+    ) -> None:
+        """Add the denoising metadata of a run, None if it was excluded."""
+        _, _, specifier = utils.parse_bids_name(source_file)
+        self._runs[specifier] = {"name": specifier, "metadata": metadata}
+
+    def add_timeseries(
+        self,
+        source_file: str,
+        seg: str,
+        time_series: np.ndarray[Any, Any],
+    ) -> None:
+        """Add the parcel time series of a run and atlas."""
+        _, _, specifier = utils.parse_bids_name(source_file)
+        n_volumes, n_parcels = time_series.shape
+        # parcels without signal in the subject mask
+        kept = np.flatnonzero(np.std(time_series, axis=0) > 0)
+        connectome = np.zeros((n_parcels, n_parcels))
+        if kept.size > 1:
+            connectome[np.ix_(kept, kept)] = np.corrcoef(
+                time_series[:, kept], rowvar=False
+            )
+        edges = connectome[np.ix_(kept, kept)][np.triu_indices(kept.size, k=1)]
+        self._atlas_runs[seg].append(
+            {
+                "name": specifier,
+                "n_volumes": n_volumes,
+                "n_flat": n_parcels - kept.size,
+                "mean_correlation": np.mean(edges) if edges.size else 0.0,
+                "sd_correlation": np.std(edges) if edges.size else 0.0,
+            }
+        )
+        if seg in self._connectome_sums:
+            self._connectome_sums[seg] += connectome
+        else:
+            self._connectome_sums[seg] = connectome
+        if specifier in self._runs:
+            self._runs[specifier]["n_volumes"] = n_volumes
+
+    def add_saved_run(self, writer: TSVWriter, source_file: str) -> None:
+        """Add a run from its saved metadata and parcel time series."""
+        self.add_run(source_file, writer.read_metadata(source_file))
+        for seg in self.context.atlases:
+            desc = seg.split(self.atlas)[-1]
+            if writer.has_outputs(source_file, desc):
+                self.add_timeseries(
+                    source_file, seg, writer.read_timeseries(source_file, desc)
+                )
+
+    def render(self, subject: str) -> str:
+        """HTML of the report."""
+        env = Environment(
+            loader=FileSystemLoader(Path(__file__).parent),
+            autoescape=select_autoescape(),
+            lstrip_blocks=True,
+            trim_blocks=True,
+        )
+        template = env.get_template("data/reports/subject.html.jinja")
+        atlases = []
+        for seg, atlas_context in self.context.atlases.items():
+            runs = self._atlas_runs[seg]
+            connectome = None
+            if runs:
+                connectome = _plot_connectome(
+                    self._connectome_sums[seg] / len(runs)
+                )
+            atlases.append(
+                {
+                    "seg": seg,
+                    "n_parcels": atlas_context.n_parcels,
+                    "overlay": _plot_atlas(self.context, atlas_context),
+                    "connectome": connectome,
+                    "runs": runs,
+                }
+            )
+        data = {
+            "subject": subject,
+            "atlas": self.atlas,
+            "strategy": self.strategy,
+            "version": __version__,
+            "runs": list(self._runs.values()),
+            "atlases": atlases,
+        }
+        return template.render(data=data)
+
+
+def _figure_to_base64(figure: Any) -> str:
+    import matplotlib.pyplot as plt
+
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format="png", dpi=80, bbox_inches="tight")
+    plt.close(figure)
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def _plot_atlas(context: SubjectContext, atlas_context: AtlasContext) -> str:
+    import matplotlib.pyplot as plt
+    from nilearn import plotting
+
+    figure = plt.figure(figsize=(9, 3))
+    if atlas_context.atlas_type == "dseg":
+        plotting.plot_roi(
+            atlas_context.masker.labels_img,
+            bg_img=context.mask_img,
+            figure=figure,
+            black_bg=False,
+        )
+    else:
+        plotting.plot_prob_atlas(
+            atlas_context.masker.maps_img,
+            bg_img=context.mask_img,
+            figure=figure,
+            black_bg=False,
+        )
+    return _figure_to_base64(figure)
+
+
+def _plot_connectome(connectome: np.ndarray[Any, Any]) -> str:
+    import matplotlib.pyplot as plt
+    from nilearn import plotting
+
+    figure = plt.figure(figsize=(4, 4))
+    np.fill_diagonal(connectome, 0)
+    plotting.plot_matrix(
+        connectome, figure=figure, vmin=-1, vmax=1, colorbar=True
+    )
+    return _figure_to_base64(figure)
+
+
+def write_saved_reports(
+    strategy: str,
+    atlas: ATLAS_SETTING_TYPE,
+    resampled_atlases: Sequence[str | Path],
+    images: Sequence[BIDSImageFile],
+    group_mask: str | Path,
+    output_path: Path,
+    output_format: str = "tsv",
+    report_level: str = "run",
+) -> int:
+    """Write the reports of the runs already processed.
+
+    Use after a participant level run without reports. Runs without
+    saved time series are skipped.
+
+    Parameters
+    ----------
+    strategy : str
+        Name of the denoising strategy.
+
+    atlas : dict
+        Atlas settings.
+
+    resampled_atlases : list of str or pathlib.Path
+        Atlas niftis resampled to the common space of the dataset.
+
+    images : list of BIDSImageFile
+        Preprocessed Nifti images of the subject.
+
+    group_mask : str or pathlib.Path
+        Group level grey matter mask.
+
+    output_path : pathlib.Path
+        Full path to output directory.
+
+    output_format : str
+        Format of the saved outputs.
+
+    report_level : str
+        "run" for one report per run and atlas, "subject" for one
+        report per subject, read from the saved time series and metadata.
+
+    Returns
+    -------
+    int
+        Number of reports written.
+    """
+    context = build_subject_context(group_mask, resampled_atlases)
+    writer = get_output_writer(
+        output_format, output_path, atlas["name"], strategy
+    )
+    n_reports = 0
+    if report_level == "subject":
+        subject_report = SubjectReport(context, atlas["name"], strategy)
+        for img in images:
+            subject_report.add_saved_run(writer, img.path)
+        if images:
+            subject, _, _ = utils.parse_bids_name(images[0].path)
+            writer.write_subject_report(
+                subject, subject_report.render(subject)
+            )
+            n_reports = 1
+    else:
+        reports = AtlasReports(context)
+        for seg in context.atlases:
+            desc = seg.split(atlas["name"])[-1]
+            for img in images:
+                if writer.has_outputs(img.path, desc):
+                    writer.write_report(img.path, desc, reports[seg])
+                    n_reports += 1
+    writer.close()
+    gc_log.info(f"Saved {n_reports} reports.")
+    return n_reports
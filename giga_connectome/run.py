@@ -8,6 +8,8 @@ from typing import Any
 from giga_connectome._version import __version__
 from giga_connectome.atlas import get_atlas_labels
 from giga_connectome.logger import gc_logger
+from giga_connectome.profiling import PROFILERS
+from giga_connectome.timing import STAGES
 
 gc_log = gc_logger()
 
@@ -61,9 +63,13 @@ def global_parser() -> argparse.ArgumentParser:
     )
     parser.add_argument(
         "analysis_level",
-        help="Level of the analysis that will be performed. Only participant"
-        "level is available.",
-        choices=["participant"],
+        help="Level of the analysis that will be performed. 'participant' "
+        "generates the time series and connectomes of each participant. "
+        "'group' gathers the participant level connectomes found in "
+        "output_dir in one memory-mapped array per atlas and denoising "
+        "strategy, with an index table of the BIDS entities. Only new "
+        "connectomes are added when the group level is run again.",
+        choices=["participant", "group"],
     )
     parser.add_argument(
         "-v", "--version", action="version", version=__version__
@@ -118,6 +124,187 @@ def global_parser() -> argparse.ArgumentParser:
         type=float,
         default=5.0,
     )
+    parser.add_argument(
+        "--denoise-level",
+        help="Level at which the denoising steps are performed. 'voxel' "
+        "denoises the voxel time series before the extraction. 'parcel' "
+        "extracts the time series from the raw data and denoises the parcel "
+        "time series, which is much faster when screening many denoising "
+        "strategies. 'parcel' is only available without spatial smoothing "
+        "(--smoothing-fwhm 0) and without "
+        "--calculate-intranetwork-average-correlation. The deviation from "
+        "the voxel level results is measured on the first run of each "
+        "subject and saved in the time series metadata. The default is "
+        "'voxel'.",
+        choices=["voxel", "parcel"],
+        default="voxel",
+    )
+    parser.add_argument(
+        "--n-jobs",
+        help="Number of threads used for spatial smoothing, and to read the "
+        "participant level outputs at the group level. The default is 1.",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--n-writers",
+        help="Number of background threads writing the outputs, so the "
+        "next image is processed while the outputs of the previous one are "
+        "written. HDF5 outputs use a single thread. 0 writes the outputs "
+        "in the main thread. The default is 0.",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--prefetch",
+        help="Number of BOLD images read and decompressed in a background "
+        "thread, with their confounds, while the current image is "
+        "processed. Each prefetched image is held in memory. 0 reads each "
+        "image when it is processed. The default is 0.",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--reports",
+        help="Reports of the atlases on the subject grey matter mask. 'run' "
+        "saves one report per run and atlas, rendered once per subject and "
+        "atlas. 'subject' saves a single report per subject showing each "
+        "atlas once and summarising the denoising and the parcel signals "
+        "of every run. 'none' skips the reports, which can be generated "
+        "later with --reports-only. The default is 'run'.",
+        choices=["run", "subject", "none"],
+        default="run",
+    )
+    parser.add_argument(
+        "--reports-only",
+        help="Only generate the reports of the runs already processed in "
+        "the output directory, without denoising. Use the same options as "
+        "the participant level run.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--plan",
+        help="Index the dataset and print the estimated peak memory, CPU "
+        "time and size of the outputs of each subject and in total, "
+        "without processing. Only the headers of the BOLD images and the "
+        "number of rows of the confounds tables are read. The timing "
+        "tables of the subjects already processed in output_dir/logs with "
+        "the same atlas and strategy calibrate the estimates.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--resume",
+        help="Skip the runs completed by a previous participant level run "
+        "with the same inputs and options. Completed runs are recorded in "
+        "output_dir/logs/manifest. With --output-format hdf5, the outputs "
+        "of a subject are written again unless all its runs are complete.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--output-format",
+        help="Format of the time series and connectomes. 'tsv' writes one "
+        "file per run and atlas, following BEP017. 'hdf5' writes one file "
+        "per subject with compressed datasets for each run and atlas, and "
+        "the BIDS entities and metadata as attributes (requires h5py). The "
+        "default is 'tsv'.",
+        choices=["tsv", "hdf5"],
+        default="tsv",
+    )
+    parser.add_argument(
+        "--relmat-storage",
+        help="Storage of the connectomes. 'full' saves the N by N matrices. "
+        "'upper' saves their upper triangle, diagonal included, as a single "
+        "column (row major), about half the size. The StorageFormat of "
+        "meas-PearsonCorrelation_relmat.json is set accordingly. The "
+        "default is 'full'.",
+        choices=["full", "upper"],
+        default="full",
+    )
+    parser.add_argument(
+        "--timeseries-encoding",
+        help="Encoding of the time series. 'float32' keeps the full "
+        "precision. 'float16' and 'int16' (with a scale factor and an "
+        "offset per file) are 2 to 4 times smaller; with the TSV output "
+        "format the time series are then saved as .npy binary files with "
+        "a JSON sidecar recording the encoding and the maximum "
+        "quantization error. The default is 'float32'.",
+        choices=["float32", "float16", "int16"],
+        default="float32",
+    )
+    parser.add_argument(
+        "--relmat-top-k",
+        help="Also save each connectome as a sparse matrix keeping, for "
+        "each parcel, the edges of the K largest absolute correlations, "
+        "with K at least 1. Sparse connectomes are saved as scipy .npz "
+        "files (TSV output format) or as row, col and data datasets (HDF5 "
+        "output format).",
+        type=int,
+        metavar="K",
+    )
+    parser.add_argument(
+        "--relmat-threshold",
+        help="Also save each connectome as a sparse matrix keeping the "
+        "edges of absolute correlation above or equal to this value, "
+        "between 0 and 1. Combined with --relmat-top-k, edges must satisfy "
+        "both.",
+        type=float,
+    )
+    parser.add_argument(
+        "--no-dense-relmat",
+        help="Do not save the dense connectomes, only the sparse ones. "
+        "The group level analysis needs the dense connectomes.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        action="store",
+        type=Path,
+        help="Directory to cache the confounds tables as parquet files "
+        "(requires pyarrow). The tables are converted once and reused "
+        "across denoising strategies and reruns. By default, no cache is "
+        "used.",
+    )
+    parser.add_argument(
+        "--voxel-cache-dir",
+        action="store",
+        type=Path,
+        help="Directory to cache the denoised voxel time series of each run "
+        "as memory-mapped float32 arrays. A later run with the same "
+        "denoising options and another atlas reads them instead of "
+        "denoising the BOLD images again. Only used with --denoise-level "
+        "voxel. By default, no cache is used.",
+    )
+    parser.add_argument(
+        "--voxel-cache-max-size",
+        help="Maximum size of the voxel cache in GB. The least recently "
+        "used runs are removed first. By default, no limit.",
+        type=float,
+    )
+    parser.add_argument(
+        "--voxel-cache-max-age",
+        help="Remove the runs of the voxel cache unused for this number of "
+        "days. By default, no limit.",
+        type=float,
+    )
+    parser.add_argument(
+        "--profile",
+        help="Profile the participant level and save the profiles of each "
+        "subject in output_dir/logs/profile. 'cpu' runs cProfile and saves "
+        "a .prof file with a text summary. 'memory' traces the allocations "
+        "with tracemalloc, which slows the processing down, and saves the "
+        "peak of each stage and the largest live allocations.",
+        nargs="+",
+        choices=PROFILERS,
+    )
+    parser.add_argument(
+        "--profile-stages",
+        help="Only profile these stages, in any thread. By default, the "
+        "whole subject is profiled in the main thread, which does not "
+        "include the loading with --prefetch and the writing with "
+        "--n-writers.",
+        nargs="+",
+        choices=STAGES,
+    )
     parser.add_argument(
         "--reindex-bids",
         help="Reindex BIDS data set, even if layout has already been created.",
@@ -136,7 +323,8 @@ def global_parser() -> argparse.ArgumentParser:
         "--calculate-intranetwork-average-correlation",
         help="Calculate average correlation within each network. This is a "
         "python implementation of the matlab code from the NIAK connectome "
-        "pipeline (option A). The default is False.",
+        "pipeline (option A). For probabilistic atlases, the correlations "
+        "between voxels are weighted by the map values. The default is False.",
         action="store_true",
     )
     parser.add_argument(
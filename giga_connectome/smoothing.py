@@ -0,0 +1,94 @@
+"""Spatial smoothing restricted to the bounding box of the subject mask."""
+
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+import numpy as np
+from scipy.ndimage import gaussian_filter1d
+
+# scipy.ndimage default, kernels are cut at 4 standard deviations
+TRUNCATE = 4.0
+
+
+def fwhm_to_sigma(
+    fwhm: float, affine: np.ndarray[Any, Any]
+) -> np.ndarray[Any, Any]:
+    """Convert a FWHM in mm to a standard deviation in voxels per axis.
+
+    Same conversion as :func:`nilearn.image.smooth_img`.
+
+    Parameters
+    ----------
+    fwhm : float
+        Smoothing kernel size in mm.
+
+    affine : np.ndarray
+        Affine of the image.
+
+    Returns
+    -------
+    np.ndarray
+        Standard deviation of the Gaussian kernel along each spatial axis.
+    """
+    vox_size = np.sqrt(np.sum(affine[:3, :3] ** 2, axis=0))
+    return np.asarray(fwhm / (np.sqrt(8 * np.log(2)) * vox_size))
+
+
+def kernel_radius(sigma: np.ndarray[Any, Any]) -> tuple[int, ...]:
+    """Number of voxels reached by the truncated kernel along each axis."""
+    return tuple(int(TRUNCATE * s + 0.5) if s > 0 else 0 for s in sigma)
+
+
+def smooth_volumes(
+    data: np.ndarray[Any, Any],
+    sigma: np.ndarray[Any, Any],
+    n_jobs: int = 1,
+) -> np.ndarray[Any, Any]:
+    """Smooth a 4D array in place with separable Gaussian kernels.
+
+    Each spatial axis is filtered on all the volumes at once. With
+    ``n_jobs > 1`` the volumes are split in chunks filtered by a pool
+    of threads.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        4D float32 array, typically cropped to the bounding box of the
+        subject mask padded with :func:`kernel_radius`.
+
+    sigma : np.ndarray
+        Standard deviation of the kernel in voxels along each spatial axis.
+
+    n_jobs : int
+        Number of threads.
+
+    Returns
+    -------
+    np.ndarray
+        The smoothed array.
+    """
+    data[~np.isfinite(data)] = 0
+
+    def _smooth_chunk(chunk: np.ndarray[Any, Any]) -> None:
+        for axis, s in enumerate(sigma):
+            if s > 0:
+                gaussian_filter1d(
+                    chunk, s, axis=axis, output=chunk, truncate=TRUNCATE
+                )
+
+    n_volumes = data.shape[-1]
+    n_chunks = max(1, min(n_jobs, n_volumes))
+    if n_chunks == 1:
+        _smooth_chunk(data)
+        return data
+
+    bounds = np.linspace(0, n_volumes, n_chunks + 1).astype(int)
+    chunks = [
+        data[..., start:stop]
+        for start, stop in zip(bounds[:-1], bounds[1:], strict=True)
+    ]
+    with ThreadPoolExecutor(max_workers=n_chunks) as executor:
+        list(executor.map(_smooth_chunk, chunks))
+    return data
@@ -0,0 +1,181 @@
+"""Time and peak memory of the processing stages of a subject."""
+
+from __future__ import annotations
+
+import copy
+import sys
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import AbstractContextManager, contextmanager, nullcontext
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import pandas as pd
+
+if TYPE_CHECKING:
+    from giga_connectome.profiling import Profiler
+
+# stages recorded by the participant level
+STAGES = [
+    "bids_index",
+    "mask",
+    "atlas_resampling",
+    "context",
+    "cache_read",
+    "confounds",
+    "bold_load",
+    "smoothing",
+    "cleaning",
+    "cache_write",
+    "extraction",
+    "correlation",
+    "report",
+    "write",
+]
+TIMING_COLUMNS = [
+    "subject",
+    "run",
+    "seg",
+    "stage",
+    "seconds",
+    "calls",
+    "peak_rss_mb",
+]
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of the process so far, in MB. NaN where
+    the ``resource`` module is not available.
+    """
+    try:
+        import resource
+    except ImportError:
+        return float("nan")
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform == "darwin":
+        return peak / 1e6
+    return peak / 1e3
+
+
+class StageTimer:
+    """Wall time and peak memory of the processing stages of a subject.
+
+    Each call of :meth:`stage` adds its duration to the row of the stage,
+    run and atlas, and records the peak resident set size of the process
+    at the end of the stage. The peak only grows, so the stage where it
+    increases is the one that needed the memory. Views from :meth:`bind`
+    share the rows and can be used from other threads.
+
+    Parameters
+    ----------
+    subject : str
+        Subject of the rows, with the ``sub-`` prefix.
+
+    profiler : Profiler or None
+        Also profile the stages. \
+            See :class:`giga_connectome.profiling.Profiler`.
+    """
+
+    def __init__(self, subject: str, profiler: Profiler | None = None) -> None:
+        self.subject = subject
+        self.profiler = profiler
+        self.run = ""
+        self.seg = ""
+        self._lock = threading.Lock()
+        # (run, seg, stage): [seconds, calls, peak RSS]
+        self._rows: dict[tuple[str, str, str], list[float]] = {}
+
+    def bind(
+        self, source_file: str | None = None, seg: str = ""
+    ) -> StageTimer:
+        """View of the timer recording the stages of a run and atlas.
+
+        Parameters
+        ----------
+        source_file : str or None
+            BOLD image of the run. None keeps the run of the timer.
+
+        seg : str
+            ``seg`` entity of the atlas.
+
+        Returns
+        -------
+        StageTimer
+            Timer sharing the rows of this one.
+        """
+        # utils imports the timed denoising functions
+        from giga_connectome import utils
+
+        # shallow copy, the lock and the rows are shared
+        view = copy.copy(self)
+        if source_file is not None:
+            view.run = utils.parse_bids_name(source_file)[2]
+        view.seg = seg or self.seg
+        return view
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Time the enclosed block as the stage ``name``."""
+        profile = (
+            nullcontext()
+            if self.profiler is None
+            else self.profiler.stage(name)
+        )
+        start = time.perf_counter()
+        try:
+            with profile:
+                yield
+        finally:
+            seconds = time.perf_counter() - start
+            peak = peak_rss_mb()
+            key = (self.run, self.seg, name)
+            with self._lock:
+                row = self._rows.setdefault(key, [0.0, 0, 0.0])
+                row[0] += seconds
+                row[1] += 1
+                row[2] = max(row[2], peak)
+
+    def to_frame(self) -> pd.DataFrame:
+        """One row per run, atlas and stage, see :data:`TIMING_COLUMNS`."""
+        with self._lock:
+            rows = [
+                [self.subject, *key, seconds, int(calls), peak]
+                for key, (seconds, calls, peak) in self._rows.items()
+            ]
+        return pd.DataFrame(rows, columns=TIMING_COLUMNS)
+
+    def summary(self) -> str:
+        """One line with the time summed over the stages, the peak memory
+        and the three longest stages. Stages run in background threads
+        overlap the others, so the sum exceeds the wall time.
+        """
+        table = self.to_frame()
+        stages = table.groupby("stage")["seconds"].sum()
+        longest = ", ".join(
+            f"{stage} {seconds:.1f} s"
+            for stage, seconds in stages.nlargest(3).items()
+        )
+        return (
+            f"{self.subject}: {table['seconds'].sum():.1f} s in "
+            f"{len(stages)} stages, peak RSS "
+            f"{table['peak_rss_mb'].max():.0f} MB; longest: {longest}."
+        )
+
+    def write(self, path: Path) -> None:
+        """Write the rows as a TSV file."""
+        from giga_connectome import utils
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with utils.atomic_path(path) as tmp_path:
+            self.to_frame().to_csv(
+                tmp_path, sep="\t", index=False, float_format="%.4f"
+            )
+
+
+def timed(timer: StageTimer | None, name: str) -> AbstractContextManager[None]:
+    """:meth:`StageTimer.stage`, or nothing without a timer."""
+    if timer is None:
+        return nullcontext()
+    return timer.stage(name)
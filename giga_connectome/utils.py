@@ -1,6 +1,10 @@
 from __future__ import annotations
 
 import json
+import os
+import threading
+from collections.abc import Iterator
+from contextlib import contextmanager
 from pathlib import Path
 from typing import Any
 
@@ -289,15 +293,19 @@ def create_ds_description(output_dir: Path) -> None:
         json.dump(ds_desc, f, indent=4)
 
 
-def create_sidecar(output_path: Path) -> None:
-    """Create a JSON sidecar for the connectivity data."""
+def create_sidecar(output_path: Path, storage_format: str = "Full") -> None:
+    """Create a JSON sidecar for the connectivity data.
+
+    ``storage_format`` is "Full" for N by N matrices, or
+    "UpperTriangular" for their upper triangles, diagonal included.
+    """
     metadata: dict[str, Any] = {
         "Measure": "Pearson correlation",
         "MeasureDescription": "Pearson correlation",
         "Weighted": False,
         "Directed": False,
         "ValidDiagonal": True,
-        "StorageFormat": "Full",
+        "StorageFormat": storage_format,
         "NonNegative": "",
         "Code": "https://github.com/bids-apps/giga_connectome.git",
     }
@@ -305,6 +313,35 @@ def create_sidecar(output_path: Path) -> None:
         json.dump(metadata, f, indent=4)
 
 
+def file_signature(path: str | Path) -> str:
+    """Resolved path, modification time and size of a file, to detect
+    edited or replaced inputs without reading them. Empty if the file
+    does not exist.
+    """
+    path = Path(path)
+    if not path.exists():
+        return ""
+    stat = path.stat()
+    return f"{path.resolve()}:{stat.st_mtime_ns}:{stat.st_size}"
+
+
+@contextmanager
+def atomic_path(path: Path) -> Iterator[Path]:
+    """Temporary path next to ``path``, renamed to ``path`` once written.
+
+    Readers never see partially written files. The temporary file has
+    the same extension, and is removed if writing fails.
+    """
+    tmp_path = path.with_name(
+        f"{path.stem}.{os.getpid()}-{threading.get_ident()}.tmp{path.suffix}"
+    )
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
 def output_filename(
     source_file: str,
     atlas: str,
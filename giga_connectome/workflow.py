@@ -3,13 +3,22 @@
 from __future__ import annotations
 
 import argparse
+from contextlib import nullcontext
 
 from giga_connectome import methods, utils
-from giga_connectome.atlas import load_atlas_setting
-from giga_connectome.denoise import get_denoise_strategy
+from giga_connectome.atlas import get_atlas_n_parcels, load_atlas_setting
+from giga_connectome.cache import VoxelCache
+from giga_connectome.confounds import ConfoundsCache
+from giga_connectome.denoise import cache_strategy, get_denoise_strategy
+from giga_connectome.group import build_group_connectomes
 from giga_connectome.logger import gc_logger
 from giga_connectome.mask import generate_gm_mask_atlas
+from giga_connectome.outputs import RELMAT_STORAGE
+from giga_connectome.plan import format_plan, plan_dataset
 from giga_connectome.postprocess import run_postprocessing_dataset
+from giga_connectome.profiling import Profiler
+from giga_connectome.reports import write_saved_reports
+from giga_connectome.timing import StageTimer
 
 gc_log = gc_logger()
 
@@ -33,14 +42,106 @@ def workflow(args: argparse.Namespace) -> None:
     # set file paths
     bids_dir = args.bids_dir
     output_dir = args.output_dir
+    if args.analysis_level == "group":
+        set_verbosity(args.verbosity)
+        gc_log.info(f"Gathering group level connectomes in:\n\t{output_dir}")
+        build_group_connectomes(
+            output_dir, args.participant_label, n_jobs=args.n_jobs
+        )
+        return
+
     atlases_dir = args.atlases_dir
     standardize = True  # always standardising the time series
     smoothing_fwhm = args.smoothing_fwhm
     calculate_average_correlation = (
         args.calculate_intranetwork_average_correlation
     )
+    denoise_level = args.denoise_level
+    n_jobs = args.n_jobs
+    if denoise_level == "parcel" and smoothing_fwhm:
+        raise ValueError(
+            "Parcel level denoising is only available without spatial "
+            "smoothing. Please use `--smoothing-fwhm 0`."
+        )
+    if args.reports_only and args.reports == "none":
+        raise ValueError(
+            "`--reports-only` cannot be used with `--reports none`."
+        )
+    if denoise_level == "parcel" and calculate_average_correlation:
+        raise ValueError(
+            "The average intranetwork correlation needs voxel level "
+            "denoising. Please use `--denoise-level voxel`."
+        )
+    if args.no_dense_relmat and (
+        args.relmat_top_k is None and args.relmat_threshold is None
+    ):
+        raise ValueError(
+            "`--no-dense-relmat` needs sparse connectomes. Please use "
+            "`--relmat-top-k` and/or `--relmat-threshold`."
+        )
+    if args.relmat_top_k is not None and args.relmat_top_k < 1:
+        raise ValueError("`--relmat-top-k` must be at least 1.")
+    if args.relmat_threshold is not None and not (
+        0 <= args.relmat_threshold <= 1
+    ):
+        raise ValueError("`--relmat-threshold` must be between 0 and 1.")
+    if denoise_level == "parcel" and args.voxel_cache_dir is not None:
+        gc_log.warning(
+            "The voxel cache is not used with parcel level denoising."
+        )
+    if args.profile_stages and not args.profile:
+        raise ValueError(
+            "`--profile-stages` needs a profiler. Please use `--profile`."
+        )
     subjects = utils.get_subject_lists(args.participant_label, bids_dir)
     strategy = get_denoise_strategy(args.denoise_strategy)
+    if args.plan:
+        set_verbosity(args.verbosity)
+        template, bids_filters = utils.prepare_bidsfilter_and_template(
+            strategy, utils.parse_bids_filter(args.bids_filter_file)
+        )
+        atlas_name, n_parcels = get_atlas_n_parcels(args.atlas)
+        plan = plan_dataset(
+            subjects,
+            template,
+            bids_dir,
+            args.reindex_bids,
+            bids_filters,
+            strategy,
+            atlas_name,
+            n_parcels,
+            output_dir,
+            denoise_level,
+            args.output_format,
+            args.relmat_storage,
+            args.timeseries_encoding,
+            args.relmat_top_k,
+            args.relmat_threshold,
+            not args.no_dense_relmat,
+            args.prefetch,
+            args.reports,
+        )
+        print(format_plan(plan))
+        return
+    confounds_cache = None
+    if args.cache_dir is not None:
+        confounds_cache = ConfoundsCache(args.cache_dir)
+        strategy = cache_strategy(strategy, confounds_cache)
+    voxel_cache = None
+    if args.voxel_cache_dir is not None:
+        voxel_cache = VoxelCache(
+            args.voxel_cache_dir,
+            max_size=(
+                None
+                if args.voxel_cache_max_size is None
+                else int(args.voxel_cache_max_size * 1e9)
+            ),
+            max_age=(
+                None
+                if args.voxel_cache_max_age is None
+                else args.voxel_cache_max_age * 24 * 3600
+            ),
+        )
 
     atlas = load_atlas_setting(args.atlas)
     user_bids_filter = utils.parse_bids_filter(args.bids_filter_file)
@@ -59,7 +160,10 @@ def workflow(args: argparse.Namespace) -> None:
     gc_log.info(f"Indexing BIDS directory:\n\t{bids_dir}")
 
     utils.create_ds_description(output_dir)
-    utils.create_sidecar(output_dir / "meas-PearsonCorrelation_relmat.json")
+    utils.create_sidecar(
+        output_dir / "meas-PearsonCorrelation_relmat.json",
+        RELMAT_STORAGE[args.relmat_storage],
+    )
     methods.generate_method_section(
         output_dir=output_dir,
         atlas=atlas["name"],
@@ -68,26 +172,75 @@ def workflow(args: argparse.Namespace) -> None:
         strategy=args.denoise_strategy,
         mni_space=template,
         average_correlation=calculate_average_correlation,
+        denoise_level=denoise_level,
     )
 
     for subject in subjects:
-        subj_data, _ = utils.get_bids_images(
-            [subject], template, bids_dir, args.reindex_bids, bids_filters
-        )
-        subject_mask_nii, subject_seg_niis = generate_gm_mask_atlas(
-            atlases_dir, atlas, template, subj_data["mask"]
-        )
-
-        gc_log.info(f"Generate subject level connectomes: sub-{subject}")
-
-        run_postprocessing_dataset(
-            strategy,
-            atlas,
-            subject_seg_niis,
-            subj_data["bold"],
-            subject_mask_nii,
-            standardize,
-            smoothing_fwhm,
-            output_dir,
-            calculate_average_correlation,
+        profiler = None
+        if args.profile:
+            profiler = Profiler(args.profile, args.profile_stages or ())
+        timer = StageTimer(f"sub-{subject}", profiler)
+        with nullcontext() if profiler is None else profiler.profile():
+            with timer.stage("bids_index"):
+                subj_data, _ = utils.get_bids_images(
+                    [subject],
+                    template,
+                    bids_dir,
+                    args.reindex_bids,
+                    bids_filters,
+                )
+            subject_mask_nii, subject_seg_niis = generate_gm_mask_atlas(
+                atlases_dir, atlas, template, subj_data["mask"], timer
+            )
+
+            if args.reports_only:
+                gc_log.info(f"Generate the reports of sub-{subject}")
+                write_saved_reports(
+                    strategy["name"],
+                    atlas,
+                    subject_seg_niis,
+                    subj_data["bold"],
+                    subject_mask_nii,
+                    output_dir,
+                    args.output_format,
+                    args.reports,
+                )
+                continue
+
+            gc_log.info(f"Generate subject level connectomes: sub-{subject}")
+
+            run_postprocessing_dataset(
+                strategy,
+                atlas,
+                subject_seg_niis,
+                subj_data["bold"],
+                subject_mask_nii,
+                standardize,
+                smoothing_fwhm,
+                output_dir,
+                calculate_average_correlation,
+                denoise_level,
+                n_jobs,
+                confounds_cache,
+                args.output_format,
+                args.relmat_storage,
+                args.timeseries_encoding,
+                args.relmat_top_k,
+                args.relmat_threshold,
+                not args.no_dense_relmat,
+                args.n_writers,
+                args.prefetch,
+                args.reports,
+                args.resume,
+                voxel_cache,
+                timer,
+            )
+        name = (
+            f"sub-{subject}_seg-{atlas['name']}_desc-denoise"
+            f"{strategy['name'].capitalize()}"
         )
+        timer.write(output_dir / "logs" / f"{name}_timing.tsv")
+        gc_log.info(timer.summary())
+        if profiler is not None:
+            for path in profiler.write(output_dir / "logs" / "profile" / name):
+                gc_log.info(f"Profile saved to {path}")
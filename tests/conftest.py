@@ -1,8 +1,105 @@
+import json
 from pathlib import Path
 
+import nibabel as nib
+import numpy as np
+import pandas as pd
 import pytest
 
+MOTION = ["trans_x", "trans_y", "trans_z", "rot_x", "rot_y", "rot_z"]
+
 
 @pytest.fixture
 def data_dir() -> Path:
     return Path(__file__).parent / "data"
+
+
+def _fake_confounds(n_volumes: int, rng: np.random.Generator) -> pd.DataFrame:
+    """Confounds in the fMRIPrep format covering the preset strategies."""
+    confounds = {}
+    for name in [*MOTION, "white_matter", "csf", "global_signal"]:
+        base = rng.standard_normal(n_volumes).cumsum() * 0.01
+        derivative = np.concatenate([[np.nan], np.diff(base)])
+        confounds[name] = base
+        confounds[f"{name}_derivative1"] = derivative
+        confounds[f"{name}_power2"] = base**2
+        confounds[f"{name}_derivative1_power2"] = derivative**2
+    time = np.arange(n_volumes)
+    for i in range(3):
+        confounds[f"cosine{i:02d}"] = np.cos(
+            np.pi * (i + 1) * (time + 0.5) / n_volumes
+        )
+    framewise_displacement = rng.uniform(0.02, 0.15, n_volumes)
+    framewise_displacement[rng.choice(n_volumes, 4, replace=False)] = 0.7
+    framewise_displacement[0] = np.nan
+    confounds["framewise_displacement"] = framewise_displacement
+    confounds["std_dvars"] = rng.uniform(0.8, 1.2, n_volumes)
+    non_steady_state = np.zeros(n_volumes)
+    non_steady_state[0] = 1
+    confounds["non_steady_state_outlier00"] = non_steady_state
+    return pd.DataFrame(confounds)
+
+
+@pytest.fixture
+def fmriprep_dir(tmp_path) -> Path:
+    """Minimal fMRIPrep derivative: one subject, two runs, 2 parcels."""
+    rng = np.random.default_rng(0)
+    root = tmp_path / "fmriprep"
+    func = root / "sub-01" / "func"
+    func.mkdir(parents=True)
+    (root / "dataset_description.json").write_text(
+        json.dumps(
+            {
+                "Name": "fake",
+                "BIDSVersion": "1.9.0",
+                "DatasetType": "derivative",
+                "GeneratedBy": [{"Name": "fMRIPrep"}],
+            }
+        )
+    )
+    shape, n_volumes = (8, 9, 7), 60
+    affine = np.diag([4.0, 4.0, 4.0, 1.0])
+    brain = np.zeros(shape, dtype=np.uint8)
+    brain[1:7, 1:8, 1:6] = 1
+    for run in (1, 2):
+        prefix = f"sub-01_task-rest_run-{run}"
+        space = "space-MNI152NLin2009cAsym_res-2"
+        bold = (
+            rng.standard_normal((*shape, n_volumes)) + 100 * brain[..., None]
+        )
+        nib.save(
+            nib.Nifti1Image(bold.astype(np.float32), affine),
+            func / f"{prefix}_{space}_desc-preproc_bold.nii.gz",
+        )
+        (func / f"{prefix}_{space}_desc-preproc_bold.json").write_text(
+            json.dumps({"RepetitionTime": 2.0})
+        )
+        nib.save(
+            nib.Nifti1Image(brain, affine),
+            func / f"{prefix}_{space}_desc-brain_mask.nii.gz",
+        )
+        _fake_confounds(n_volumes, rng).to_csv(
+            func / f"{prefix}_desc-confounds_timeseries.tsv",
+            sep="\t",
+            index=False,
+            na_rep="n/a",
+        )
+        (func / f"{prefix}_desc-confounds_timeseries.json").write_text("{}")
+
+    atlases = tmp_path / "atlases" / "sub-01" / "func"
+    atlases.mkdir(parents=True)
+    gm = np.zeros(shape, dtype=np.uint8)
+    gm[2:6, 2:7, 2:5] = 1
+    nib.save(
+        nib.Nifti1Image(gm, affine),
+        atlases
+        / "sub-01_space-MNI152NLin2009cAsym_res-2_label-GM_mask.nii.gz",
+    )
+    dseg = np.zeros(shape, dtype=np.int16)
+    dseg[1:4, 1:8, 1:6] = 1
+    dseg[4:7, 1:8, 1:6] = 2
+    nib.save(
+        nib.Nifti1Image(dseg, affine),
+        atlases / "sub-01_seg-fake2_dseg.nii.gz",
+    )
+    return root
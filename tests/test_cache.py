@@ -0,0 +1,44 @@
+import os
+import time
+
+import numpy as np
+
+from giga_connectome.cache import VoxelCache
+
+
+def _write(cache, name, size, age=0.0):
+    path = cache.cache_dir / f"{name}.npy"
+    np.save(path, np.zeros(size // 4, dtype=np.float32))
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_read_write(tmp_path) -> None:
+    cache = VoxelCache(tmp_path)
+    path = cache.cache_dir / "run.npy"
+    assert cache.read(path) is None
+    time_series = np.random.default_rng(0).random((10, 5))
+    cache.write(path, time_series)
+    cached = cache.read(path)
+    assert isinstance(cached, np.memmap)
+    assert cached.dtype == np.float32
+    np.testing.assert_allclose(cached, time_series, rtol=1e-6)
+
+
+def test_evict(tmp_path) -> None:
+    cache = VoxelCache(tmp_path)
+    old = _write(cache, "old", 4000, age=3600)
+    used = _write(cache, "used", 4000, age=1800)
+    recent = _write(cache, "recent", 4000)
+    # reading a file makes it the most recently used
+    cache.read(used)
+
+    cache.max_size = 9000
+    assert cache.evict() == [old]
+    cache.max_age = 60.0
+    cache.max_size = None
+    assert cache.evict() == []
+    os.utime(recent, (time.time() - 120,) * 2)
+    assert cache.evict() == [recent]
+    assert [path.name for path in cache.cache_dir.iterdir()] == ["used.npy"]
@@ -6,8 +6,8 @@ from pathlib import Path
 
 import pandas as pd
 import pytest
-from giga_connectome._version import __version__
 
+from giga_connectome._version import __version__
 from giga_connectome.run import main
 
 
@@ -161,3 +161,65 @@ def test_smoke(data_dir, tmp_path, caplog) -> None:
             "participant",
         ]
     )
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        ["--denoise-level", "parcel"],
+        [
+            "--denoise-level",
+            "parcel",
+            "--smoothing-fwhm",
+            "0",
+            "--calculate-intranetwork-average-correlation",
+        ],
+    ],
+)
+def test_parcel_level_denoising_options(tmp_path, options) -> None:
+    with pytest.raises(ValueError):
+        main([*options, str(tmp_path), str(tmp_path / "out"), "participant"])
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        ["--relmat-top-k", "0"],
+        ["--relmat-threshold", "-0.1"],
+        ["--relmat-threshold", "1.5"],
+    ],
+)
+def test_sparse_relmat_options(tmp_path, options) -> None:
+    with pytest.raises(ValueError, match="--relmat"):
+        main([*options, str(tmp_path), str(tmp_path / "out"), "participant"])
+
+
+def test_profile_options(tmp_path) -> None:
+    with pytest.raises(ValueError, match="--profile"):
+        main(
+            [
+                str(tmp_path),
+                str(tmp_path / "out"),
+                "participant",
+                "--profile-stages",
+                "cleaning",
+            ]
+        )
+
+
+def test_plan(fmriprep_dir, tmp_path, capsys) -> None:
+    output_dir = tmp_path / "output"
+    main(
+        [
+            str(fmriprep_dir),
+            str(output_dir),
+            "participant",
+            "--atlas",
+            "MIST",
+            "--plan",
+        ]
+    )
+    captured = capsys.readouterr()
+    assert "sub-01" in captured.out
+    assert "total" in captured.out
+    assert not output_dir.exists()
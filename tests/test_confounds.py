@@ -0,0 +1,74 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from giga_connectome.confounds import ConfoundsCache
+from giga_connectome.denoise import (
+    cache_strategy,
+    denoise_meta_data,
+    get_denoise_strategy,
+)
+
+pytest.importorskip("pyarrow")
+
+
+def _run_files(fmriprep_dir):
+    func = fmriprep_dir / "sub-01" / "func"
+    img = str(
+        func / "sub-01_task-rest_run-1_space-MNI152NLin2009cAsym_res-2"
+        "_desc-preproc_bold.nii.gz"
+    )
+    return img, func / "sub-01_task-rest_run-1_desc-confounds_timeseries.tsv"
+
+
+def test_read_table(fmriprep_dir, tmp_path) -> None:
+    _, confounds_file = _run_files(fmriprep_dir)
+    cache = ConfoundsCache(tmp_path / "cache")
+    expected = pd.read_csv(confounds_file, sep="\t")
+
+    pd.testing.assert_frame_equal(cache.read_table(confounds_file), expected)
+    assert len(list(cache.cache_dir.glob("*.parquet"))) == 1
+    pd.testing.assert_frame_equal(
+        cache.read_table(confounds_file, ["framewise_displacement"]),
+        expected[["framewise_displacement"]],
+    )
+    assert cache.columns(confounds_file) == expected.columns.tolist()
+
+    # a modified input is converted again
+    expected.iloc[:, 0] += 1
+    expected.to_csv(confounds_file, sep="\t", index=False, na_rep="n/a")
+    stat = confounds_file.stat()
+    os.utime(confounds_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    pd.testing.assert_frame_equal(cache.read_table(confounds_file), expected)
+    assert len(list(cache.cache_dir.glob("*.parquet"))) == 2
+
+
+@pytest.mark.parametrize("strategy_name", ["simple", "scrubbing.5"])
+def test_cache_strategy(fmriprep_dir, tmp_path, strategy_name) -> None:
+    img, _ = _run_files(fmriprep_dir)
+    strategy = get_denoise_strategy(strategy_name)
+    calls = []
+
+    def counted(img, **kwargs):
+        calls.append(img)
+        return strategy["function"](img, **kwargs)
+
+    cache = ConfoundsCache(tmp_path / "cache")
+    cached = cache_strategy({**strategy, "function": counted}, cache)
+    expected_cf, expected_sm = strategy["function"](
+        img, **strategy["parameters"]
+    )
+    for _ in range(2):
+        cf, sm = cached["function"](img, **cached["parameters"])
+        pd.testing.assert_frame_equal(cf, expected_cf)
+        if expected_sm is None:
+            assert sm is None
+        else:
+            np.testing.assert_array_equal(sm, expected_sm)
+    assert len(calls) == 1
+
+    assert denoise_meta_data(cached, img, cache) == denoise_meta_data(
+        strategy, img
+    )
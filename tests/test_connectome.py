@@ -1,9 +1,13 @@
 import numpy as np
 from nibabel import Nifti1Image
 from nilearn.connectome import ConnectivityMeasure
-from nilearn.maskers import NiftiLabelsMasker, NiftiMasker
+from nilearn.maskers import NiftiLabelsMasker, NiftiMapsMasker, NiftiMasker
 
-from giga_connectome.connectome import generate_timeseries_connectomes
+from giga_connectome.connectome import (
+    build_size_roi,
+    generate_timeseries_connectomes,
+    maps_gram,
+)
 
 
 def _extract_time_series_voxel(img, mask, confounds=None, smoothing_fwhm=None):
@@ -63,3 +67,54 @@ def test_calculate_intranetwork_correlation() -> None:
     )  # output of the function is in float32
     assert np.abs(corr[0] - conn[0, 0]) < 1e-6
     assert np.abs(corr[1] - conn[1, 1]) < 1e-6
+
+
+def test_calculate_intranetwork_correlation_maps() -> None:
+    img, mask, _, _ = _simulate_img()
+    weights = np.array([[1.0, 0.5, 0.2, 0.0], [0.0, 0.3, 0.8, 1.0]])
+    maps = np.zeros((*img.shape[:3], 2))
+    maps[4, 4, 3:7, :] = weights.T
+    time_series_voxel, masker_voxel = _extract_time_series_voxel(img, mask)
+    denoised_img = masker_voxel.inverse_transform(time_series_voxel)
+    # brute force average of the correlations weighted by w_i w_j
+    corr = np.corrcoef(time_series_voxel.transpose())
+    off_diagonal = ~np.eye(corr.shape[0], dtype=bool)
+    expected = [
+        np.sum((np.outer(w, w) * corr)[off_diagonal])
+        / np.sum(np.outer(w, w)[off_diagonal])
+        for w in weights
+    ]
+
+    correlation_measure = ConnectivityMeasure(
+        kind="correlation", vectorize=False, discard_diagonal=False
+    )
+    conn, _, _ = generate_timeseries_connectomes(
+        masker=NiftiMapsMasker(
+            maps_img=Nifti1Image(maps, np.eye(4)), standardize=None
+        ),
+        denoised_img=denoised_img,
+        group_mask=mask,
+        correlation_measure=correlation_measure,
+        calculate_average_correlation=True,
+    )
+    np.testing.assert_allclose(np.diag(conn), expected, atol=1e-5)
+
+
+def test_maps_gram(monkeypatch) -> None:
+    rng = np.random.default_rng(0)
+    maps = rng.random((1000, 5))
+    maps[100:400] = 0
+    monkeypatch.setattr("giga_connectome.connectome.GRAM_CHUNK_SIZE", 64)
+    gram = maps_gram(maps)
+    assert gram.dtype == np.float64
+    np.testing.assert_allclose(gram, maps.T @ maps, rtol=1e-5)
+
+
+def test_build_size_roi() -> None:
+    rng = np.random.default_rng(0)
+    mask = rng.choice([0, 1, 3, 7], size=(1, 500)).astype(float)
+    region_ids = {0: 1, 1: 3, 2: 7, 3: 9}
+    size_roi = build_size_roi(mask, region_ids)
+    assert size_roi.shape == (4, 1)
+    for num_r, label in region_ids.items():
+        assert size_roi[num_r, 0] == np.count_nonzero(mask == label)
@@ -0,0 +1,190 @@
+import nibabel as nib
+import numpy as np
+import pandas as pd
+import pytest
+from nilearn.connectome import ConnectivityMeasure
+from nilearn.maskers import NiftiLabelsMasker, NiftiMapsMasker
+
+from giga_connectome.connectome import (
+    extract_timeseries_connectomes,
+    generate_timeseries_connectomes,
+)
+from giga_connectome.context import build_subject_context
+from giga_connectome.denoise import (
+    denoise_nifti_voxel,
+    denoise_voxel_timeseries,
+    prepare_parcel_denoising,
+)
+
+
+def _fake_strategy(n_volumes, seed=0):
+    rng = np.random.default_rng(seed)
+    confounds = pd.DataFrame(
+        rng.standard_normal((n_volumes, 3)), columns=["a", "b", "c"]
+    )
+    return {
+        "name": "fake",
+        "function": lambda img, **kwargs: (confounds, None),
+        "parameters": {},
+    }
+
+
+@pytest.fixture
+def subject_data(tmp_path):
+    """Simulate a subject: bold, mask, dseg and probseg atlases."""
+    rng = np.random.default_rng(42)
+    shape = (9, 10, 8)
+    affine = np.diag([3.0, 3.0, 3.0, 1.0])
+    bold = rng.standard_normal((*shape, 40)).astype(np.float32) + 100
+    bold_path = tmp_path / (
+        "sub-01_task-rest_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz"
+    )
+    nib.save(nib.Nifti1Image(bold, affine), bold_path)
+
+    mask = np.zeros(shape, dtype=np.int8)
+    mask[2:7, 2:8, 2:6] = 1
+    mask_path = tmp_path / "sub-01_label-GM_mask.nii.gz"
+    nib.save(nib.Nifti1Image(mask, affine), mask_path)
+
+    # parcels extending beyond the mask
+    dseg = np.zeros(shape, dtype=np.int16)
+    dseg[1:5, 1:9, 1:7] = 1
+    dseg[5:8, 1:5, 1:7] = 2
+    dseg[5:8, 5:9, 1:7] = 4
+    dseg_path = tmp_path / "sub-01_seg-fake100_dseg.nii.gz"
+    nib.save(nib.Nifti1Image(dseg, affine), dseg_path)
+
+    probseg = rng.uniform(size=(*shape, 3)).astype(np.float32)
+    probseg[probseg < 0.5] = 0
+    probseg_path = tmp_path / "sub-01_seg-fake3_probseg.nii.gz"
+    nib.save(nib.Nifti1Image(probseg, affine), probseg_path)
+    return bold_path, mask_path, dseg_path, probseg_path
+
+
+def test_build_subject_context(subject_data) -> None:
+    _, mask_path, dseg_path, probseg_path = subject_data
+    context = build_subject_context(mask_path, [dseg_path, probseg_path])
+    assert context.n_voxels == 5 * 6 * 4
+    assert list(context.atlases) == ["fake100", "fake3"]
+    dseg = context.atlases["fake100"]
+    assert dseg.region_ids == {0: 1, 1: 2, 2: 4}
+    assert dseg.size_parcels.sum() == context.n_voxels
+    assert context.atlases["fake3"].n_parcels == 3
+
+
+@pytest.mark.parametrize("smoothing_fwhm", [0.0, 5.0])
+def test_context_matches_nilearn_maskers(subject_data, smoothing_fwhm) -> None:
+    bold_path, mask_path, dseg_path, probseg_path = subject_data
+    strategy = _fake_strategy(40)
+    context = build_subject_context(mask_path, [dseg_path, probseg_path])
+
+    time_series_voxel = denoise_voxel_timeseries(
+        strategy, context, True, smoothing_fwhm, str(bold_path)
+    )
+    denoised_img = denoise_nifti_voxel(
+        strategy, mask_path, True, smoothing_fwhm, str(bold_path)
+    )
+    correlation_measure = ConnectivityMeasure(
+        kind="correlation", vectorize=False, discard_diagonal=False
+    )
+
+    conn, ts, _ = generate_timeseries_connectomes(
+        masker=NiftiLabelsMasker(labels_img=dseg_path, standardize=False),
+        denoised_img=denoised_img,
+        group_mask=mask_path,
+        correlation_measure=correlation_measure,
+        calculate_average_correlation=True,
+    )
+    conn_context, ts_context = extract_timeseries_connectomes(
+        context.atlases["fake100"],
+        time_series_voxel,
+        correlation_measure,
+        calculate_average_correlation=True,
+    )
+    np.testing.assert_allclose(ts_context, ts, atol=1e-5)
+    off_diagonal = ~np.eye(conn.shape[0], dtype=bool)
+    np.testing.assert_allclose(
+        conn_context[off_diagonal], conn[off_diagonal], atol=1e-5
+    )
+    # parcels extend beyond the mask: the diagonal is the average
+    # correlation between the voxels of each parcel within the mask
+    labels = context.atlases["fake100"].weights.nonzero()
+    for parcel in range(conn.shape[0]):
+        voxels = labels[0][labels[1] == parcel]
+        corr = np.corrcoef(time_series_voxel[:, voxels].T)
+        expected = corr[np.triu_indices(voxels.shape[0], k=1)].mean()
+        assert np.abs(conn_context[parcel, parcel] - expected) < 1e-5
+
+    ts = NiftiMapsMasker(maps_img=probseg_path).fit_transform(denoised_img)
+    _, ts_context = extract_timeseries_connectomes(
+        context.atlases["fake3"],
+        time_series_voxel,
+        correlation_measure,
+        calculate_average_correlation=False,
+    )
+    np.testing.assert_allclose(ts_context, ts, atol=1e-5)
+
+
+def test_intranetwork_correlation_probseg(subject_data) -> None:
+    bold_path, mask_path, _, probseg_path = subject_data
+    context = build_subject_context(mask_path, [probseg_path])
+    time_series_voxel = denoise_voxel_timeseries(
+        _fake_strategy(40), context, True, 0.0, str(bold_path)
+    )
+    correlation_measure = ConnectivityMeasure(
+        kind="correlation", vectorize=False, discard_diagonal=False
+    )
+    conn, _ = extract_timeseries_connectomes(
+        context.atlases["fake3"],
+        time_series_voxel,
+        correlation_measure,
+        calculate_average_correlation=True,
+    )
+    # brute force: correlations between voxels weighted by the maps
+    corr = np.corrcoef(time_series_voxel.T)
+    np.fill_diagonal(corr, 0)
+    weights = context.atlases["fake3"].weights.toarray()
+    for parcel in range(weights.shape[1]):
+        w = weights[:, parcel]
+        pair_weights = np.outer(w, w)
+        np.fill_diagonal(pair_weights, 0)
+        expected = (pair_weights * corr).sum() / pair_weights.sum()
+        assert np.abs(conn[parcel, parcel] - expected) < 1e-5
+
+
+def test_parcel_level_denoising(subject_data) -> None:
+    """Without standardization, denoising commutes with extraction."""
+    bold_path, mask_path, dseg_path, probseg_path = subject_data
+    strategy = _fake_strategy(40)
+    context = build_subject_context(mask_path, [dseg_path, probseg_path])
+    correlation_measure = ConnectivityMeasure(
+        kind="correlation", vectorize=False, discard_diagonal=False
+    )
+    time_series_voxel = denoise_voxel_timeseries(
+        strategy, context, False, 0.0, str(bold_path)
+    )
+    raw_voxel, parcel_cleaner = prepare_parcel_denoising(
+        strategy, context, False, str(bold_path)
+    )
+    for atlas_context in context.atlases.values():
+        conn, ts = extract_timeseries_connectomes(
+            atlas_context, time_series_voxel, correlation_measure, False
+        )
+        conn_parcel, ts_parcel = extract_timeseries_connectomes(
+            atlas_context,
+            raw_voxel,
+            correlation_measure,
+            False,
+            parcel_cleaner,
+        )
+        np.testing.assert_allclose(ts_parcel, ts, atol=1e-4)
+        np.testing.assert_allclose(conn_parcel, conn, atol=1e-4)
+
+    with pytest.raises(ValueError, match="voxel level"):
+        extract_timeseries_connectomes(
+            context.atlases["fake100"],
+            raw_voxel,
+            correlation_measure,
+            True,
+            parcel_cleaner,
+        )
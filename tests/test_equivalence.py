@@ -0,0 +1,69 @@
+import nibabel as nib
+import numpy as np
+import pandas as pd
+import pytest
+
+from giga_connectome.context import build_subject_context
+from giga_connectome.equivalence import EQUIVALENCE_COLUMNS, compare_run
+
+
+@pytest.fixture
+def subject_data(tmp_path):
+    """Simulate a run with a dseg and a probseg atlas."""
+    rng = np.random.default_rng(0)
+    shape = (9, 10, 8)
+    affine = np.diag([3.0, 3.0, 3.0, 1.0])
+    bold = rng.standard_normal((*shape, 40)).astype(np.float32) + 100
+    bold_path = tmp_path / (
+        "sub-01_task-rest_run-1_space-MNI152NLin2009cAsym_desc-preproc_"
+        "bold.nii.gz"
+    )
+    nib.save(nib.Nifti1Image(bold, affine), bold_path)
+    mask = np.zeros(shape, dtype=np.int8)
+    mask[2:7, 2:8, 2:6] = 1
+    mask_path = tmp_path / "sub-01_label-GM_mask.nii.gz"
+    nib.save(nib.Nifti1Image(mask, affine), mask_path)
+    dseg = np.zeros(shape, dtype=np.int16)
+    dseg[1:5, 1:9, 1:7] = 1
+    dseg[5:8, 1:9, 1:7] = 2
+    dseg_path = tmp_path / "sub-01_seg-fake2_dseg.nii.gz"
+    nib.save(nib.Nifti1Image(dseg, affine), dseg_path)
+    probseg = rng.uniform(size=(*shape, 3)).astype(np.float32)
+    probseg_path = tmp_path / "sub-01_seg-fake3_probseg.nii.gz"
+    nib.save(nib.Nifti1Image(probseg, affine), probseg_path)
+    return bold_path, mask_path, [dseg_path, probseg_path]
+
+
+def _scrubbing_strategy(n_volumes):
+    rng = np.random.default_rng(1)
+    confounds = pd.DataFrame(
+        rng.standard_normal((n_volumes, 3)), columns=["a", "b", "c"]
+    )
+    sample_mask = np.delete(np.arange(n_volumes), [0, 10, 11, 25])
+    return {
+        "name": "scrubbing",
+        "function": lambda img, **kwargs: (confounds, sample_mask),
+        "parameters": {},
+    }
+
+
+def test_compare_run(subject_data) -> None:
+    bold_path, mask_path, atlases = subject_data
+    context = build_subject_context(mask_path, atlases)
+    table = compare_run(
+        _scrubbing_strategy(40), context, str(bold_path), smoothing_fwhm=5.0
+    )
+    assert list(table.columns) == EQUIVALENCE_COLUMNS
+    assert len(table) == 4
+    assert set(table["seg"]) == {"fake2", "fake3"}
+    assert set(table["output"]) == {"timeseries", "relmat"}
+    assert (table["run"] == "task-rest_run-1").all()
+    assert table["passed"].all()
+    assert (table["max_abs_error"] < 1e-4).all()
+    assert (table["speedup"] > 0).all()
+
+    # tolerances are applied to both errors
+    table = compare_run(
+        _scrubbing_strategy(40), context, str(bold_path), atol=-1.0
+    )
+    assert not table["passed"].any()
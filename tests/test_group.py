@@ -0,0 +1,120 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from giga_connectome.group import (
+    build_group_connectomes,
+    find_connectomes,
+    group_connectome_paths,
+    load_group_connectomes,
+)
+from giga_connectome.outputs import HDF5Writer
+from giga_connectome.run import main
+
+
+def _fake_outputs(output_dir, subjects, n_parcels=4, seed=0):
+    """Participant level TSV connectomes of two atlases."""
+    rng = np.random.default_rng(seed)
+    relmats = {}
+    for subject in subjects:
+        func = output_dir / f"sub-{subject}" / "ses-1" / "func"
+        func.mkdir(parents=True, exist_ok=True)
+        for run in (1, 2):
+            for seg, n in (("fake4", n_parcels), ("fake3", 3)):
+                relmat = np.corrcoef(rng.standard_normal((n, 20)))
+                filename = (
+                    f"sub-{subject}_ses-1_task-rest_run-{run}_seg-{seg}"
+                    "_meas-PearsonCorrelation_desc-denoiseSimple_relmat.tsv"
+                )
+                pd.DataFrame(relmat).to_csv(
+                    func / filename, sep="\t", index=False
+                )
+                relmats[(subject, run, seg)] = relmat
+    return relmats
+
+
+def test_build_group_connectomes(tmp_path) -> None:
+    relmats = _fake_outputs(tmp_path, ["01", "02"])
+    connectomes = find_connectomes(tmp_path)
+    assert len(connectomes) == 8
+    assert set(connectomes["seg"]) == {"fake3", "fake4"}
+
+    data_paths = build_group_connectomes(tmp_path, n_jobs=2)
+    assert len(data_paths) == 2
+    data, index = load_group_connectomes(tmp_path, "fake4", "denoiseSimple")
+    assert isinstance(data, np.memmap)
+    assert data.shape == (4, 10)
+    assert list(index["sub"]) == ["01", "01", "02", "02"]
+    assert list(index["ses"]) == ["1"] * 4
+    triu = np.triu_indices(4)
+    for row, entry in index.iterrows():
+        expected = relmats[(entry["sub"], int(entry["run"]), "fake4")]
+        np.testing.assert_allclose(data[row], expected[triu], atol=1e-6)
+
+    # only the new subject is read
+    relmats.update(_fake_outputs(tmp_path, ["03"], seed=1))
+    (tmp_path / "sub-01" / "ses-1" / "func").rename(tmp_path / "moved")
+    build_group_connectomes(tmp_path, n_jobs=0)
+    data, index = load_group_connectomes(tmp_path, "fake4", "denoiseSimple")
+    assert data.shape == (6, 10)
+    assert list(index["sub"]) == ["01", "01", "02", "02", "03", "03"]
+    np.testing.assert_allclose(
+        data[5], relmats[("03", 2, "fake4")][triu], atol=1e-6
+    )
+    _, _, sidecar_path = group_connectome_paths(
+        tmp_path, "fake4", "denoiseSimple"
+    )
+    sidecar = json.loads(sidecar_path.read_text())
+    assert sidecar["NumberOfConnectomes"] == 6
+
+
+def test_group_connectomes_size_mismatch(tmp_path) -> None:
+    _fake_outputs(tmp_path, ["01"])
+    build_group_connectomes(tmp_path)
+    _fake_outputs(tmp_path, ["02"], n_parcels=5)
+    with pytest.raises(ValueError, match="edges"):
+        build_group_connectomes(tmp_path)
+
+
+def test_group_level_hdf5(tmp_path) -> None:
+    h5py = pytest.importorskip("h5py")
+    func = tmp_path / "sub-01" / "func"
+    func.mkdir(parents=True)
+    relmat = np.corrcoef(np.random.default_rng(0).standard_normal((3, 10)))
+    with h5py.File(
+        func / "sub-01_seg-fake_desc-denoiseSimple_connectome.h5", "w"
+    ) as h5_file:
+        group = h5_file.create_group("task-rest_run-1")
+        group.attrs["sub"] = "01"
+        group.attrs["task"] = "rest"
+        group.attrs["run"] = "1"
+        group.create_group("seg-fake3").create_dataset("relmat", data=relmat)
+
+    main([str(tmp_path), str(tmp_path), "group"])
+    data, index = load_group_connectomes(tmp_path, "fake3", "denoiseSimple")
+    assert data.shape == (1, 6)
+    assert index.loc[0, "task"] == "rest"
+    np.testing.assert_allclose(data[0], relmat[np.triu_indices(3)], atol=1e-6)
+
+
+def test_group_level_sparse_only_hdf5(tmp_path, caplog) -> None:
+    pytest.importorskip("h5py")
+    writer = HDF5Writer(
+        tmp_path, "fake", "simple", relmat_top_k=1, dense_relmat=False
+    )
+    time_series = np.random.default_rng(0).standard_normal((10, 3))
+    writer.write(
+        "sub-01_task-rest_run-1_space-MNI152NLin2009cAsym_desc-preproc_"
+        "bold.nii.gz",
+        "3",
+        np.corrcoef(time_series.T),
+        time_series,
+    )
+    writer.close()
+
+    assert find_connectomes(tmp_path).empty
+    assert "without dense relmat" in caplog.text
+    main([str(tmp_path), str(tmp_path), "group"])
+    assert build_group_connectomes(tmp_path) == []
@@ -0,0 +1,191 @@
+import time
+
+import nibabel as nib
+import numpy as np
+import pytest
+from nilearn.image import get_data
+from nilearn.maskers import NiftiMasker
+
+from giga_connectome.context import build_subject_context
+from giga_connectome.denoise import (
+    denoise_nifti_voxel,
+    denoise_voxel_timeseries,
+    get_denoise_strategy,
+    load_voxel_timeseries,
+)
+from giga_connectome.loader import (
+    available_gzip_backends,
+    open_bold,
+    prefetch,
+    read_bold_box,
+)
+
+
+@pytest.fixture
+def bold_and_mask(tmp_path):
+    rng = np.random.default_rng(0)
+    shape = (12, 11, 10)
+    affine = np.diag([3.0, 3.0, 3.0, 1.0])
+    # integer data with scaling factors, as often written by fMRIPrep
+    bold = nib.Nifti1Image(
+        rng.integers(0, 1000, (*shape, 8)).astype(np.int16), affine
+    )
+    bold.header.set_slope_inter(0.5, 10.0)
+    bold_path = tmp_path / "bold.nii.gz"
+    nib.save(bold, bold_path)
+    mask = np.zeros(shape, dtype=np.int8)
+    mask[3:9, 2:7, 4:10] = 1
+    mask[5, 5, 5] = 0
+    mask_path = tmp_path / "mask.nii.gz"
+    nib.save(nib.Nifti1Image(mask, affine), mask_path)
+    return bold_path, mask_path
+
+
+def test_read_bold_box(bold_and_mask) -> None:
+    bold_path, mask_path = bold_and_mask
+    context = build_subject_context(mask_path, [])
+    box = context.bounding_box()
+    assert box == (slice(3, 9), slice(2, 7), slice(4, 10))
+    assert context.bounding_box(margin=(2, 2, 2))[2] == slice(2, 10)
+
+    data = read_bold_box(str(bold_path), box, context.mask_array.shape)
+    full = nib.load(bold_path).get_fdata()
+    assert data.shape == (6, 5, 6, 8)
+    assert data.dtype == np.float32
+    np.testing.assert_allclose(data, full[box])
+    np.testing.assert_allclose(
+        context.apply_mask(data, box), context.apply_mask(full)
+    )
+    np.testing.assert_allclose(
+        load_voxel_timeseries(context, 0.0, str(bold_path)),
+        context.apply_mask(full),
+    )
+
+    with pytest.raises(ValueError, match="grid of the subject mask"):
+        read_bold_box(str(bold_path), box, (12, 11, 9))
+
+
+def test_read_bold_box_volumes(bold_and_mask) -> None:
+    bold_path, mask_path = bold_and_mask
+    context = build_subject_context(mask_path, [])
+    box = context.bounding_box(margin=(1, 1, 1))
+    volumes = np.array([0, 1, 2, 5, 7])
+    data = read_bold_box(
+        str(bold_path), box, context.mask_array.shape, volumes
+    )
+    full = nib.load(bold_path).get_fdata()
+    np.testing.assert_allclose(data, full[box][..., volumes])
+
+
+@pytest.mark.parametrize("smoothing_fwhm", [0.0, 5.0])
+def test_censoring_at_load_time(fmriprep_dir, smoothing_fwhm) -> None:
+    """Reading only the kept volumes matches the nilearn masker."""
+    img = str(
+        fmriprep_dir
+        / "sub-01"
+        / "func"
+        / "sub-01_task-rest_run-1_space-MNI152NLin2009cAsym_res-2"
+        "_desc-preproc_bold.nii.gz"
+    )
+    mask_path = (
+        fmriprep_dir.parent
+        / "atlases"
+        / "sub-01"
+        / "func"
+        / "sub-01_space-MNI152NLin2009cAsym_res-2_label-GM_mask.nii.gz"
+    )
+    strategy = get_denoise_strategy("scrubbing.5")
+    _, sample_mask = strategy["function"](img, **strategy["parameters"])
+    assert sample_mask.shape[0] < 60
+
+    context = build_subject_context(mask_path, [])
+    time_series_voxel = denoise_voxel_timeseries(
+        strategy, context, True, smoothing_fwhm, img
+    )
+    denoised_img = denoise_nifti_voxel(
+        strategy, mask_path, True, smoothing_fwhm, img
+    )
+    expected = context.apply_mask(get_data(denoised_img))
+    assert time_series_voxel.shape == expected.shape
+    np.testing.assert_allclose(time_series_voxel, expected, atol=1e-4)
+
+
+def test_read_bold_box_other_grid(bold_and_mask, tmp_path) -> None:
+    bold_path, mask_path = bold_and_mask
+    # same shape as the BOLD image, shifted by half a voxel
+    mask = nib.load(mask_path)
+    affine = mask.affine.copy()
+    affine[:3, 3] += 1.5
+    shifted_path = tmp_path / "mask_shifted.nii.gz"
+    nib.save(nib.Nifti1Image(get_data(mask), affine), shifted_path)
+    context = build_subject_context(shifted_path, [])
+    box = context.bounding_box()
+    with pytest.raises(ValueError, match="grid of the subject mask"):
+        read_bold_box(
+            str(bold_path), box, context.mask_array.shape, None, affine
+        )
+
+    # resampled to the mask, as by the nilearn masker
+    expected = NiftiMasker(shifted_path).fit_transform(bold_path)
+    np.testing.assert_allclose(
+        load_voxel_timeseries(context, 0.0, str(bold_path)),
+        expected,
+        rtol=1e-5,
+    )
+
+
+@pytest.mark.parametrize("gzip_backend", available_gzip_backends())
+def test_open_bold_gzip_backends(bold_and_mask, gzip_backend) -> None:
+    bold_path, mask_path = bold_and_mask
+    context = build_subject_context(mask_path, [])
+    box = context.bounding_box()
+    with open_bold(bold_path, gzip_backend) as bold:
+        np.testing.assert_allclose(
+            read_bold_box(
+                bold, box, context.mask_array.shape, np.array([1, 4])
+            ),
+            nib.load(bold_path).get_fdata()[box][..., [1, 4]],
+        )
+    if gzip_backend != "indexed_gzip":
+        assert bold.file_map["image"].fileobj.closed
+
+
+def test_open_bold_unknown_backend(bold_and_mask) -> None:
+    assert available_gzip_backends()[-1] == "zlib"
+    with (
+        pytest.raises(ValueError, match="not available"),
+        open_bold(bold_and_mask[0], "pigz"),
+    ):
+        pass
+
+
+@pytest.mark.parametrize("depth", [0, 1, 3])
+def test_prefetch(depth) -> None:
+    loaded = []
+
+    def load(item):
+        loaded.append(item)
+        return item * 10
+
+    for item, result in prefetch(load, range(5), depth):
+        assert result == item * 10
+        # the next items are loaded ahead, at most depth of them
+        expected = min(item + depth, 4)
+        assert max(loaded) <= expected
+        if depth:
+            time.sleep(0.05)
+            assert max(loaded) == expected
+    assert loaded == list(range(5))
+
+
+def test_prefetch_error() -> None:
+    def load(item):
+        if item == 2:
+            raise OSError("unreadable")
+        return item
+
+    results = []
+    with pytest.raises(OSError, match="unreadable"):
+        for _, result in prefetch(load, range(5), 2):
+            results.append(result)
+    assert results == [0, 1]
@@ -0,0 +1,44 @@
+import os
+
+from giga_connectome.manifest import Manifest, input_hash, parameter_hash
+
+
+def test_input_hash(tmp_path) -> None:
+    bold = tmp_path / "bold.nii.gz"
+    bold.write_bytes(b"bold")
+    original = input_hash([bold])
+    assert input_hash([bold]) == original
+    stat = bold.stat()
+    os.utime(bold, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+    assert input_hash([bold]) != original
+    assert input_hash([tmp_path / "missing.nii.gz"]) != original
+
+
+def test_parameter_hash() -> None:
+    parameters = {"strategy": "simple", "smoothing_fwhm": 5.0}
+    assert parameter_hash(parameters) == parameter_hash(
+        dict(reversed(parameters.items()))
+    )
+    assert parameter_hash(parameters) != parameter_hash(
+        {**parameters, "smoothing_fwhm": 0.0}
+    )
+
+
+def test_manifest(tmp_path) -> None:
+    output = tmp_path / "sub-01" / "func" / "sub-01_relmat.tsv"
+    output.parent.mkdir(parents=True)
+    output.write_text("relmat")
+    manifest = Manifest(tmp_path, "sub-01")
+    assert not manifest.is_complete("run-1", "inputs", "parameters")
+    manifest.record("run-1", "inputs", "parameters", [output])
+    assert manifest.path.exists()
+
+    manifest = Manifest(tmp_path, "sub-01")
+    assert manifest.runs["run-1"]["outputs"] == [
+        "sub-01/func/sub-01_relmat.tsv"
+    ]
+    assert manifest.is_complete("run-1", "inputs", "parameters")
+    assert not manifest.is_complete("run-1", "changed", "parameters")
+    assert not manifest.is_complete("run-1", "inputs", "changed")
+    output.unlink()
+    assert not manifest.is_complete("run-1", "inputs", "parameters")
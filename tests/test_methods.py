@@ -11,3 +11,18 @@ def test_generate_method_section(tmp_path):
         mni_space="MNI152NLin6Asym",
         average_correlation=True,
     )
+
+
+def test_generate_method_section_parcel_level(tmp_path):
+    methods.generate_method_section(
+        output_dir=tmp_path,
+        atlas="Schaefer2018",
+        smoothing_fwhm=0,
+        standardize="zscore",
+        strategy="simple",
+        mni_space="MNI152NLin2009cAsym",
+        average_correlation=False,
+        denoise_level="parcel",
+    )
+    citation = (tmp_path / "logs" / "CITATION.md").read_text()
+    assert "performed on the parcel level" in citation
@@ -0,0 +1,118 @@
+import shutil
+
+import pandas as pd
+import pytest
+
+from giga_connectome.atlas import get_atlas_n_parcels
+from giga_connectome.denoise import get_denoise_strategy
+from giga_connectome.plan import (
+    COST_MODEL,
+    MEMORY_BASE_MB,
+    PLAN_COLUMNS,
+    TSV_BYTES_PER_VALUE,
+    format_plan,
+    plan_dataset,
+    run_output_bytes,
+)
+from giga_connectome.timing import TIMING_COLUMNS
+
+
+def test_get_atlas_n_parcels() -> None:
+    name, n_parcels = get_atlas_n_parcels("Schaefer2018")
+    assert name == "Schaefer2018"
+    assert n_parcels["100Parcels7Networks"] == 100
+    assert get_atlas_n_parcels("DiFuMo")[1]["64dimensions"] == 64
+    assert get_atlas_n_parcels("MIST")[1]["7"] == 7
+    assert set(get_atlas_n_parcels("HarvardOxfordCortical")[1].values()) == {
+        48
+    }
+
+
+def test_run_output_bytes() -> None:
+    assert run_output_bytes(10, 20) == (200 + 100) * TSV_BYTES_PER_VALUE
+    assert run_output_bytes(10, 20, relmat_storage="upper") == (
+        (200 + 55) * TSV_BYTES_PER_VALUE
+    )
+    assert (
+        run_output_bytes(
+            10,
+            20,
+            output_format="hdf5",
+            timeseries_encoding="int16",
+            dense_relmat=False,
+            relmat_top_k=2,
+        )
+        == 200 * 2 + 20 * 12
+    )
+    # the top k edges of each parcel are at most all the edges
+    assert run_output_bytes(
+        10, 20, relmat_top_k=20, dense_relmat=False
+    ) == run_output_bytes(10, 20, relmat_threshold=0.1, dense_relmat=False)
+
+
+def _plan(fmriprep_dir, output_dir, subjects=("01",), **kwargs):
+    return plan_dataset(
+        list(subjects),
+        "MNI152NLin2009cAsym",
+        fmriprep_dir,
+        True,
+        None,
+        get_denoise_strategy("simple"),
+        "fake",
+        {"2": 2, "unknown": None},
+        output_dir,
+        **kwargs,
+    )
+
+
+@pytest.mark.filterwarnings("ignore::UserWarning")
+def test_plan_dataset(fmriprep_dir, tmp_path, caplog) -> None:
+    output_dir = tmp_path / "output"
+    plan = _plan(fmriprep_dir, output_dir)
+    assert "default cost model" in caplog.text
+    assert list(plan.columns) == PLAN_COLUMNS
+    assert plan.loc[0, "subject"] == "sub-01"
+    assert plan.loc[0, "runs"] == 2
+    assert plan.loc[0, "volumes"] == 120
+    assert plan.loc[0, "peak_memory_mb"] > MEMORY_BASE_MB
+    assert plan.loc[0, "cpu_seconds"] > COST_MODEL["bids_index"]
+    assert plan.loc[0, "output_bytes"] > 0
+    assert not output_dir.exists()
+    assert "total" in format_plan(plan)
+    without_reports = _plan(fmriprep_dir, output_dir, report_level="none")
+    assert without_reports.loc[0, "output_bytes"] < plan.loc[0, "output_bytes"]
+
+    # calibrated on the timing table of a previous run
+    timing = pd.DataFrame(
+        [
+            ["sub-01", "task-rest_run-1", "", "bold_load", 600.0, 1, 4000.0],
+            ["sub-01", "task-rest_run-2", "", "bold_load", 400.0, 1, 9000.0],
+        ],
+        columns=TIMING_COLUMNS,
+    )
+    (output_dir / "logs").mkdir(parents=True)
+    timing.to_csv(
+        output_dir / "logs" / "sub-01_seg-fake_desc-denoiseSimple_timing.tsv",
+        sep="\t",
+        index=False,
+    )
+    caplog.clear()
+    calibrated = _plan(fmriprep_dir, output_dir)
+    assert "default cost model" not in caplog.text
+    assert "subjects processed before: sub-01" in caplog.text
+    assert calibrated.loc[0, "peak_memory_mb"] == pytest.approx(9000)
+    # the bold_load stage takes the 1000 s of the previous run
+    assert calibrated.loc[0, "cpu_seconds"] > 1000
+    assert calibrated.loc[0, "cpu_seconds"] < plan.loc[0, "cpu_seconds"] + 1000
+
+    # a subject not processed yet, calibrated on the processed one
+    func = fmriprep_dir / "sub-02" / "func"
+    func.mkdir(parents=True)
+    for path in (fmriprep_dir / "sub-01" / "func").iterdir():
+        shutil.copy(path, func / path.name.replace("sub-01", "sub-02"))
+    other = _plan(fmriprep_dir, output_dir, subjects=["02"])
+    assert list(other["subject"]) == ["sub-02"]
+    assert other.loc[0, "peak_memory_mb"] == pytest.approx(9000)
+    assert other.loc[0, "cpu_seconds"] == pytest.approx(
+        calibrated.loc[0, "cpu_seconds"]
+    )
@@ -0,0 +1,589 @@
+import json
+import threading
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+from nilearn.maskers import NiftiLabelsMasker
+from scipy.sparse import load_npz
+
+from giga_connectome import postprocess, utils
+from giga_connectome.cache import VoxelCache
+from giga_connectome.denoise import get_denoise_strategy
+from giga_connectome.group import read_connectome
+from giga_connectome.manifest import Manifest
+from giga_connectome.outputs import (
+    BackgroundWriter,
+    HDF5Writer,
+    TSVWriter,
+    decode_timeseries,
+    encode_timeseries,
+    pack_relmat,
+    sparsify_relmat,
+    unpack_relmat,
+)
+from giga_connectome.postprocess import run_postprocessing_dataset
+from giga_connectome.profiling import Profiler
+from giga_connectome.reports import write_saved_reports
+from giga_connectome.timing import StageTimer
+
+
+def _run(fmriprep_dir, output_dir, **kwargs):
+    subj_data, _ = utils.get_bids_images(
+        ["01"], "MNI152NLin2009cAsym", fmriprep_dir, True, None
+    )
+    atlases_dir = fmriprep_dir.parent / "atlases" / "sub-01" / "func"
+    parameters = {
+        "strategy": get_denoise_strategy("simple"),
+        "atlas": {"name": "fake", "file_paths": {}, "type": "dseg"},
+        "resampled_atlases": [atlases_dir / "sub-01_seg-fake2_dseg.nii.gz"],
+        "images": subj_data["bold"],
+        "group_mask": (
+            atlases_dir
+            / "sub-01_space-MNI152NLin2009cAsym_res-2_label-GM_mask.nii.gz"
+        ),
+        "standardize": True,
+        "smoothing_fwhm": 0.0,
+        "output_path": output_dir,
+    }
+    parameters.update(kwargs)
+    run_postprocessing_dataset(**parameters)
+    return output_dir / "sub-01" / "func"
+
+
+@pytest.mark.parametrize("denoise_level", ["voxel", "parcel"])
+def test_run_postprocessing_dataset(
+    fmriprep_dir, tmp_path, denoise_level
+) -> None:
+    output_folder = _run(
+        fmriprep_dir, tmp_path / "output", denoise_level=denoise_level
+    )
+    base = "sub-01_task-rest_run-{run}"
+    for run in (1, 2):
+        prefix = base.format(run=run)
+        relmat = pd.read_csv(
+            output_folder / f"{prefix}_seg-fake2_meas-PearsonCorrelation"
+            "_desc-denoiseSimple_relmat.tsv",
+            sep="\t",
+        )
+        assert relmat.shape == (2, 2)
+        timeseries = pd.read_csv(
+            output_folder
+            / f"{prefix}_seg-fake2_desc-denoiseSimple_timeseries.tsv",
+            sep="\t",
+        )
+        assert timeseries.shape == (59, 2)
+        with open(
+            output_folder / f"{prefix}_desc-denoiseSimple_timeseries.json"
+        ) as f:
+            meta_data = json.load(f)
+        assert meta_data["SamplingFrequency"] == 0.5
+        # deviation from voxel level denoising measured on the first run
+        has_deviation = "ParcelLevelDenoisingMaxDeviation" in meta_data
+        assert has_deviation == (denoise_level == "parcel" and run == 1)
+
+
+def test_parcel_denoising_smoothing(fmriprep_dir, tmp_path) -> None:
+    with pytest.raises(ValueError, match="without spatial smoothing"):
+        _run(
+            fmriprep_dir,
+            tmp_path / "output",
+            denoise_level="parcel",
+            smoothing_fwhm=5.0,
+        )
+    assert not (tmp_path / "output").exists()
+
+
+def test_hdf5_output(fmriprep_dir, tmp_path) -> None:
+    h5py = pytest.importorskip("h5py")
+    tsv_folder = _run(fmriprep_dir, tmp_path / "tsv")
+    h5_folder = _run(fmriprep_dir, tmp_path / "hdf5", output_format="hdf5")
+    assert not list(h5_folder.glob("*.tsv"))
+    assert not list(h5_folder.glob("*.json"))
+
+    with h5py.File(
+        h5_folder / "sub-01_seg-fake_desc-denoiseSimple_connectome.h5", "r"
+    ) as h5_file:
+        assert sorted(h5_file) == ["task-rest_run-1", "task-rest_run-2"]
+        for run in (1, 2):
+            group = h5_file[f"task-rest_run-{run}"]
+            assert group.attrs["sub"] == "01"
+            assert group.attrs["run"] == str(run)
+            meta_data = json.loads(group.attrs["metadata"])
+            assert meta_data["SamplingFrequency"] == 0.5
+            prefix = f"sub-01_task-rest_run-{run}"
+            for name, filename in (
+                ("relmat", "_meas-PearsonCorrelation_desc-denoiseSimple"),
+                ("timeseries", "_desc-denoiseSimple"),
+            ):
+                dataset = group["seg-fake2"][name]
+                assert dataset.dtype == np.float32
+                assert dataset.compression == "gzip"
+                expected = pd.read_csv(
+                    tsv_folder / f"{prefix}_seg-fake2{filename}_{name}.tsv",
+                    sep="\t",
+                )
+                np.testing.assert_allclose(dataset[()], expected, atol=1e-6)
+
+
+def test_hdf5_run_groups(tmp_path) -> None:
+    h5py = pytest.importorskip("h5py")
+    writer = HDF5Writer(tmp_path, "fake", "simple")
+    rng = np.random.default_rng(0)
+    sources, series = [], []
+    for acq in ("mb4", "mb8"):
+        source = (
+            f"sub-01_task-rest_acq-{acq}_run-1_space-MNI152NLin2009cAsym_"
+            "res-2_desc-preproc_bold.nii.gz"
+        )
+        time_series = rng.standard_normal((10, 2)).astype(np.float32)
+        writer.write_metadata(source, {"acq": acq})
+        writer.write(source, "2", np.corrcoef(time_series.T), time_series)
+        sources.append(source)
+        series.append(time_series)
+    writer.close()
+
+    with h5py.File(writer.subject_file("sub-01"), "r") as h5_file:
+        assert sorted(h5_file) == [
+            "task-rest_acq-mb4_run-1",
+            "task-rest_acq-mb8_run-1",
+        ]
+    for source, time_series in zip(sources, series, strict=True):
+        np.testing.assert_allclose(
+            writer.read_timeseries(source, "2"), time_series
+        )
+        assert writer.read_metadata(source)["acq"] in source
+
+
+def test_upper_relmat_storage(fmriprep_dir, tmp_path) -> None:
+    full_folder = _run(fmriprep_dir, tmp_path / "full")
+    upper_folder = _run(
+        fmriprep_dir, tmp_path / "upper", relmat_storage="upper"
+    )
+    filename = (
+        "sub-01_task-rest_run-1_seg-fake2_meas-PearsonCorrelation"
+        "_desc-denoiseSimple_relmat.tsv"
+    )
+    full = pd.read_csv(full_folder / filename, sep="\t").to_numpy()
+    upper = pd.read_csv(upper_folder / filename, sep="\t").to_numpy()
+    assert upper.shape == (3, 1)
+    np.testing.assert_allclose(unpack_relmat(upper), full)
+    np.testing.assert_allclose(
+        read_connectome(tmp_path / "upper", f"sub-01/func/{filename}"), full
+    )
+
+
+def test_pack_relmat() -> None:
+    matrix = np.corrcoef(np.random.default_rng(0).standard_normal((5, 20)))
+    packed = pack_relmat(matrix)
+    assert packed.shape == (15,)
+    np.testing.assert_allclose(unpack_relmat(packed), matrix)
+    with pytest.raises(ValueError, match="upper triangle"):
+        unpack_relmat(packed[:-1])
+
+
+@pytest.mark.parametrize(
+    "encoding, dtype, tolerance",
+    [("float16", np.float16, 2e-3), ("int16", np.int16, 1e-4)],
+)
+def test_encode_timeseries(encoding, dtype, tolerance) -> None:
+    time_series = np.random.default_rng(0).standard_normal((100, 6))
+    encoded, encoding_info = encode_timeseries(time_series, encoding)
+    assert encoded.dtype == dtype
+    assert encoding_info["Encoding"] == encoding
+    error = np.abs(decode_timeseries(encoded, encoding_info) - time_series)
+    assert encoding_info["MaxQuantizationError"] == pytest.approx(error.max())
+    assert error.max() < tolerance
+
+
+@pytest.mark.parametrize("output_format", ["tsv", "hdf5"])
+def test_encoded_timeseries_output(
+    fmriprep_dir, tmp_path, output_format
+) -> None:
+    if output_format == "hdf5":
+        h5py = pytest.importorskip("h5py")
+    output_folder = _run(
+        fmriprep_dir,
+        tmp_path,
+        output_format=output_format,
+        timeseries_encoding="int16",
+    )
+    if output_format == "tsv":
+        filename = (
+            output_folder / "sub-01_task-rest_run-1_seg-fake2"
+            "_desc-denoiseSimple_timeseries.npy"
+        )
+        assert not list(output_folder.glob("*_timeseries.tsv"))
+        encoded = np.load(filename)
+        with open(filename.with_suffix(".json")) as f:
+            encoding_info = json.load(f)
+    else:
+        with h5py.File(
+            output_folder / "sub-01_seg-fake_desc-denoiseSimple_connectome.h5"
+        ) as h5_file:
+            dataset = h5_file["task-rest_run-1/seg-fake2/timeseries"]
+            encoded = dataset[()]
+            encoding_info = dict(dataset.attrs)
+    assert encoded.dtype == np.int16
+    assert encoded.shape == (59, 2)
+    assert encoding_info["Encoding"] == "int16"
+    time_series = decode_timeseries(encoded, encoding_info)
+    # z-scored time series
+    np.testing.assert_allclose(time_series.mean(axis=0), 0, atol=1e-3)
+
+
+def test_sparsify_relmat() -> None:
+    matrix = np.corrcoef(np.random.default_rng(0).standard_normal((6, 20)))
+    sparse = sparsify_relmat(matrix, top_k=2)
+    assert np.all(sparse.row < sparse.col)
+    dense = sparse.toarray() + sparse.toarray().T
+    strength = np.abs(matrix - np.eye(6))
+    for node in range(6):
+        strongest = np.argsort(strength[node])[-2:]
+        assert np.all(dense[node, strongest] != 0)
+    np.testing.assert_allclose(sparse.data, matrix[sparse.row, sparse.col])
+
+    sparse = sparsify_relmat(matrix, threshold=0.2)
+    expected = np.abs(matrix[np.triu_indices(6, k=1)]) >= 0.2
+    assert sparse.nnz == expected.sum()
+    assert sparsify_relmat(matrix, top_k=2, threshold=0.2).nnz <= sparse.nnz
+    with pytest.raises(ValueError, match="top_k"):
+        sparsify_relmat(matrix)
+    with pytest.raises(ValueError, match="top_k"):
+        sparsify_relmat(matrix, top_k=0)
+    with pytest.raises(ValueError, match="threshold"):
+        sparsify_relmat(matrix, threshold=1.5)
+
+
+@pytest.mark.parametrize("output_format", ["tsv", "hdf5"])
+def test_sparse_relmat_output(fmriprep_dir, tmp_path, output_format) -> None:
+    if output_format == "hdf5":
+        h5py = pytest.importorskip("h5py")
+    output_folder = _run(
+        fmriprep_dir,
+        tmp_path,
+        output_format=output_format,
+        relmat_threshold=0.0,
+        dense_relmat=False,
+    )
+    if output_format == "tsv":
+        assert not list(output_folder.glob("*_relmat.tsv"))
+        sparse = load_npz(
+            output_folder / "sub-01_task-rest_run-1_seg-fake2"
+            "_meas-PearsonCorrelation_desc-denoiseSimple_relmat.npz"
+        )
+        shape, nnz = sparse.shape, sparse.nnz
+    else:
+        with h5py.File(
+            output_folder / "sub-01_seg-fake_desc-denoiseSimple_connectome.h5"
+        ) as h5_file:
+            group = h5_file["task-rest_run-1/seg-fake2"]
+            assert "relmat" not in group
+            shape = tuple(group["relmat_sparse"].attrs["shape"])
+            nnz = group["relmat_sparse/data"].shape[0]
+    # a single edge between the two parcels
+    assert shape == (2, 2)
+    assert nnz == 1
+
+
+@pytest.mark.parametrize("output_format", ["tsv", "hdf5"])
+def test_background_writer(fmriprep_dir, tmp_path, output_format) -> None:
+    if output_format == "hdf5":
+        pytest.importorskip("h5py")
+    reference = _run(
+        fmriprep_dir, tmp_path / "reference", output_format=output_format
+    )
+    background = _run(
+        fmriprep_dir,
+        tmp_path / "background",
+        output_format=output_format,
+        n_writers=2,
+    )
+    assert not list(background.glob("*.tmp*"))
+    filenames = sorted(path.name for path in reference.iterdir())
+    assert sorted(path.name for path in background.iterdir()) == filenames
+    for filename in filenames:
+        if filename.endswith((".tsv", ".json")):
+            assert (background / filename).read_text() == (
+                reference / filename
+            ).read_text()
+
+
+@pytest.mark.parametrize("denoise_level", ["voxel", "parcel"])
+def test_prefetch_images(fmriprep_dir, tmp_path, denoise_level) -> None:
+    reference = _run(
+        fmriprep_dir, tmp_path / "reference", denoise_level=denoise_level
+    )
+    prefetched = _run(
+        fmriprep_dir,
+        tmp_path / "prefetched",
+        denoise_level=denoise_level,
+        prefetch_depth=2,
+    )
+    for path in reference.glob("*.tsv"):
+        np.testing.assert_array_equal(
+            pd.read_csv(prefetched / path.name, sep="\t"),
+            pd.read_csv(path, sep="\t"),
+        )
+
+
+def test_background_writer_error(tmp_path) -> None:
+    class FailingWriter(TSVWriter):
+        def write_metadata(self, source_file, metadata):
+            raise OSError(f"disk full: {source_file}")
+
+    writer = BackgroundWriter(FailingWriter(tmp_path, "fake", "simple"), 2)
+    for run in (1, 2):
+        writer.write_metadata(f"sub-01_task-rest_run-{run}_bold.nii.gz", {})
+    with pytest.raises(OSError, match="disk full"):
+        writer.close()
+
+
+def test_processing_error_closes_writer(
+    fmriprep_dir, tmp_path, monkeypatch
+) -> None:
+    pytest.importorskip("h5py")
+    extract = postprocess.extract_timeseries_connectomes
+    calls = []
+
+    def failing_extract(*args):
+        calls.append(args)
+        if len(calls) > 1:
+            raise RuntimeError("extraction failed")
+        return extract(*args)
+
+    monkeypatch.setattr(
+        postprocess, "extract_timeseries_connectomes", failing_extract
+    )
+    with pytest.raises(RuntimeError, match="extraction failed"):
+        _run(
+            fmriprep_dir,
+            tmp_path,
+            output_format="hdf5",
+            n_writers=1,
+            prefetch_depth=1,
+        )
+    # the outputs of the first run are saved, no temporary file is left
+    assert not list(tmp_path.glob("**/*.tmp*"))
+    assert len(list(tmp_path.glob("sub-01/func/*_connectome.h5"))) == 1
+    assert not [
+        thread
+        for thread in threading.enumerate()
+        if thread.name.startswith("giga_connectome_")
+    ]
+
+
+@pytest.mark.parametrize("output_format", ["tsv", "hdf5"])
+def test_deferred_reports(
+    fmriprep_dir, tmp_path, monkeypatch, output_format
+) -> None:
+    if output_format == "hdf5":
+        pytest.importorskip("h5py")
+    rendered = []
+    generate_report = NiftiLabelsMasker.generate_report
+
+    def counted(masker, *args, **kwargs):
+        rendered.append(masker)
+        return generate_report(masker, *args, **kwargs)
+
+    monkeypatch.setattr(NiftiLabelsMasker, "generate_report", counted)
+    output_folder = _run(
+        fmriprep_dir,
+        tmp_path / "no_reports",
+        output_format=output_format,
+        report_level="none",
+    )
+    assert not list(output_folder.glob("*_report.html"))
+    assert not rendered
+
+    # rendered once for the two runs
+    output_folder = _run(
+        fmriprep_dir, tmp_path / "reports", output_format=output_format
+    )
+    assert len(list(output_folder.glob("*_report.html"))) == 2
+    assert len(rendered) == 1
+
+    subj_data, _ = utils.get_bids_images(
+        ["01"], "MNI152NLin2009cAsym", fmriprep_dir, True, None
+    )
+    atlases_dir = fmriprep_dir.parent / "atlases" / "sub-01" / "func"
+    n_reports = write_saved_reports(
+        "simple",
+        {"name": "fake", "file_paths": {}, "type": "dseg"},
+        [atlases_dir / "sub-01_seg-fake2_dseg.nii.gz"],
+        subj_data["bold"],
+        atlases_dir
+        / "sub-01_space-MNI152NLin2009cAsym_res-2_label-GM_mask.nii.gz",
+        tmp_path / "no_reports",
+        output_format,
+    )
+    assert n_reports == 2
+    assert len(rendered) == 2
+    saved = sorted(
+        path.name
+        for path in (tmp_path / "no_reports").glob("**/*_report.html")
+    )
+    assert saved == sorted(
+        path.name for path in output_folder.glob("*_report.html")
+    )
+
+
+@pytest.mark.parametrize("output_format", ["tsv", "hdf5"])
+def test_subject_report(fmriprep_dir, tmp_path, output_format) -> None:
+    if output_format == "hdf5":
+        pytest.importorskip("h5py")
+    output_folder = _run(
+        fmriprep_dir,
+        tmp_path / "report",
+        output_format=output_format,
+        report_level="subject",
+    )
+    reports = list(output_folder.glob("*_report.html"))
+    assert [path.name for path in reports] == [
+        "sub-01_seg-fake_desc-denoiseSimple_report.html"
+    ]
+    html = reports[0].read_text()
+    assert "task-rest_run-1" in html
+    assert "task-rest_run-2" in html
+    # the atlas and the average connectome
+    assert html.count("data:image/png;base64") == 2
+
+    # from saved outputs
+    saved_folder = _run(
+        fmriprep_dir,
+        tmp_path / "saved",
+        output_format=output_format,
+        report_level="none",
+        timeseries_encoding="int16",
+    )
+    subj_data, _ = utils.get_bids_images(
+        ["01"], "MNI152NLin2009cAsym", fmriprep_dir, True, None
+    )
+    atlases_dir = fmriprep_dir.parent / "atlases" / "sub-01" / "func"
+    write_saved_reports(
+        "simple",
+        {"name": "fake", "file_paths": {}, "type": "dseg"},
+        [atlases_dir / "sub-01_seg-fake2_dseg.nii.gz"],
+        subj_data["bold"],
+        atlases_dir
+        / "sub-01_space-MNI152NLin2009cAsym_res-2_label-GM_mask.nii.gz",
+        tmp_path / "saved",
+        output_format,
+        "subject",
+    )
+    saved = (saved_folder / reports[0].name).read_text()
+    assert "task-rest_run-2" in saved
+    assert saved.count("data:image/png;base64") == 2
+
+
+@pytest.mark.parametrize(
+    "output_format,n_writers", [("tsv", 0), ("tsv", 1), ("hdf5", 0)]
+)
+def test_resume(
+    fmriprep_dir, tmp_path, monkeypatch, output_format, n_writers
+) -> None:
+    if output_format == "hdf5":
+        pytest.importorskip("h5py")
+    loaded = []
+
+    def load_run(strategy, context, smoothing_fwhm, img, *args):
+        loaded.append(img)
+        return postprocess_load_run(
+            strategy, context, smoothing_fwhm, img, *args
+        )
+
+    postprocess_load_run = postprocess.load_run
+    monkeypatch.setattr(postprocess, "load_run", load_run)
+    output_path = tmp_path / "output"
+    kwargs = {
+        "output_format": output_format,
+        "n_writers": n_writers,
+        "report_level": "subject",
+        "resume": True,
+    }
+    output_folder = _run(fmriprep_dir, output_path, **kwargs)
+    assert len(loaded) == 2
+    manifest = Manifest(output_path, "sub-01_seg-fake_desc-denoiseSimple")
+    assert sorted(manifest.runs) == [
+        "sub-01_task-rest_run-1_space-MNI152NLin2009cAsym_res-2_desc-"
+        "preproc_bold.nii.gz",
+        "sub-01_task-rest_run-2_space-MNI152NLin2009cAsym_res-2_desc-"
+        "preproc_bold.nii.gz",
+    ]
+    report = "sub-01_seg-fake_desc-denoiseSimple_report.html"
+    (output_folder / report).unlink()
+
+    # all runs complete
+    loaded.clear()
+    _run(fmriprep_dir, output_path, **kwargs)
+    assert loaded == []
+    # the subject report is written from the saved outputs
+    html = (output_folder / report).read_text()
+    assert "task-rest_run-1" in html
+    assert "task-rest_run-2" in html
+
+    # a missing output
+    if output_format == "tsv":
+        next(output_folder.glob("*run-2*_relmat.tsv")).unlink()
+        _run(fmriprep_dir, output_path, **kwargs)
+        assert [Path(img).name[:25] for img in loaded] == [
+            "sub-01_task-rest_run-2_sp"
+        ]
+
+    # changed parameters
+    loaded.clear()
+    _run(fmriprep_dir, output_path, **kwargs, smoothing_fwhm=5.0)
+    assert len(loaded) == 2
+
+
+def test_voxel_cache(fmriprep_dir, tmp_path, monkeypatch) -> None:
+    voxel_cache = VoxelCache(tmp_path / "cache")
+    reference = _run(
+        fmriprep_dir, tmp_path / "reference", voxel_cache=voxel_cache
+    )
+    assert len(list(voxel_cache.cache_dir.glob("*.npy"))) == 2
+
+    def load_run(*args):
+        raise AssertionError("the cached runs should not be loaded")
+
+    monkeypatch.setattr(postprocess, "load_run", load_run)
+    cached = _run(fmriprep_dir, tmp_path / "cached", voxel_cache=voxel_cache)
+    for path in reference.glob("*_relmat.tsv"):
+        np.testing.assert_array_equal(
+            pd.read_csv(path, sep="\t"),
+            pd.read_csv(cached / path.name, sep="\t"),
+        )
+
+
+@pytest.mark.parametrize("denoise_level", ["voxel", "parcel"])
+def test_stage_timer(fmriprep_dir, tmp_path, denoise_level) -> None:
+    # stages of the prefetch thread and of the main thread
+    profiler = Profiler(["cpu"], ["bold_load", "extraction"])
+    timer = StageTimer("sub-01", profiler)
+    with profiler.profile():
+        _run(
+            fmriprep_dir,
+            tmp_path / "output",
+            denoise_level=denoise_level,
+            n_writers=1,
+            prefetch_depth=1,
+            timer=timer,
+        )
+    assert len(profiler.write(tmp_path / "profile" / "sub-01")) == 2
+    table = timer.to_frame()
+    stages = set(table["stage"])
+    assert {
+        "context",
+        "confounds",
+        "bold_load",
+        "cleaning",
+        "extraction",
+        "correlation",
+        "report",
+        "write",
+    } <= stages
+    assert ("smoothing" in stages) == (denoise_level == "voxel")
+    extraction = table[table["stage"] == "extraction"]
+    assert sorted(extraction["run"]) == ["task-rest_run-1", "task-rest_run-2"]
+    assert set(extraction["seg"]) == {"fake2"}
@@ -0,0 +1,48 @@
+import pstats
+
+import numpy as np
+import pytest
+
+from giga_connectome.profiling import Profiler
+from giga_connectome.timing import StageTimer
+
+
+def _allocate():
+    return np.ones((1000, 1000))
+
+
+def _stages(timer):
+    with timer.stage("bold_load"):
+        data = _allocate()
+    with timer.stage("cleaning"):
+        data = data - data.mean()
+    return data
+
+
+@pytest.mark.parametrize("stages", [[], ["bold_load"]])
+def test_profiler(tmp_path, stages) -> None:
+    profiler = Profiler(["cpu", "memory"], stages)
+    timer = StageTimer("sub-01", profiler)
+    with profiler.profile():
+        _stages(timer)
+    paths = profiler.write(tmp_path / "profile" / "sub-01")
+    assert [path.name for path in paths] == [
+        "sub-01_cpu.prof",
+        "sub-01_cpu.txt",
+        "sub-01_memory.txt",
+    ]
+    functions = {name for _, _, name in pstats.Stats(str(paths[0])).stats}
+    assert "_allocate" in functions
+    assert "_stages" in functions or stages
+
+    memory = paths[2].read_text()
+    assert "bold_load" in memory
+    assert ("cleaning" in memory) != bool(stages)
+    # the arrays allocated in the stages
+    assert "Largest live allocations" in memory
+    assert "test_profiling.py" in memory
+
+
+def test_unknown_profiler() -> None:
+    with pytest.raises(ValueError, match="Unknown profilers"):
+        Profiler(["gpu"])
@@ -0,0 +1,67 @@
+import nibabel as nib
+import numpy as np
+import pytest
+from nilearn.image import get_data, smooth_img
+
+from giga_connectome.context import build_subject_context
+from giga_connectome.denoise import load_voxel_timeseries
+from giga_connectome.smoothing import (
+    fwhm_to_sigma,
+    kernel_radius,
+    smooth_volumes,
+)
+
+
+def test_kernel_radius() -> None:
+    sigma = fwhm_to_sigma(5.0, np.diag([2.0, 2.0, 4.0, 1.0]))
+    np.testing.assert_allclose(sigma[0], 5.0 / (2 * np.sqrt(8 * np.log(2))))
+    assert kernel_radius(sigma) == (4, 4, 2)
+    assert kernel_radius(np.zeros(3)) == (0, 0, 0)
+
+
+@pytest.mark.parametrize("n_jobs", [1, 3])
+def test_smooth_volumes(n_jobs) -> None:
+    rng = np.random.default_rng(0)
+    affine = np.diag([2.0, 3.0, 2.5, 1.0])
+    data = rng.standard_normal((10, 9, 8, 7)).astype(np.float32)
+    data[0, 0, 0, 0] = np.nan
+    expected = get_data(smooth_img(nib.Nifti1Image(data, affine), 6.0))
+    smoothed = smooth_volumes(
+        data.copy(), fwhm_to_sigma(6.0, affine), n_jobs=n_jobs
+    )
+    np.testing.assert_allclose(smoothed, expected, atol=1e-5)
+
+
+@pytest.mark.parametrize(
+    "mask_box",
+    [
+        (slice(6, 12), slice(5, 10), slice(4, 9)),
+        # mask touching the edge of the field of view
+        (slice(0, 5), slice(8, 16), slice(2, 12)),
+    ],
+)
+def test_smoothing_on_mask_bounding_box(tmp_path, mask_box) -> None:
+    """Smoothing the padded bounding box matches the whole field of view."""
+    rng = np.random.default_rng(1)
+    shape = (18, 16, 14)
+    affine = np.diag([2.0, 2.0, 3.0, 1.0])
+    bold = rng.standard_normal((*shape, 12)).astype(np.float32) + 50
+    bold_path = tmp_path / "bold.nii.gz"
+    nib.save(nib.Nifti1Image(bold, affine), bold_path)
+    mask = np.zeros(shape, dtype=np.int8)
+    mask[mask_box] = 1
+    mask_path = tmp_path / "mask.nii.gz"
+    nib.save(nib.Nifti1Image(mask, affine), mask_path)
+
+    context = build_subject_context(mask_path, [])
+    box = context.bounding_box(margin=(2, 2, 2))
+    assert all(
+        s.start >= 0 and s.stop <= n for s, n in zip(box, shape, strict=True)
+    )
+
+    time_series_voxel = load_voxel_timeseries(
+        context, 5.0, str(bold_path), n_jobs=2
+    )
+    expected = context.apply_mask(get_data(smooth_img(str(bold_path), 5.0)))
+    assert time_series_voxel.dtype == np.float32
+    np.testing.assert_allclose(time_series_voxel, expected, rtol=1e-5)
@@ -0,0 +1,34 @@
+import time
+
+import pandas as pd
+
+from giga_connectome.timing import TIMING_COLUMNS, StageTimer, timed
+
+
+def test_stage_timer(tmp_path) -> None:
+    timer = StageTimer("sub-01")
+    with timer.stage("bids_index"):
+        time.sleep(0.01)
+    run_timer = timer.bind("sub-01_task-rest_run-1_bold.nii.gz")
+    seg_timer = run_timer.bind(seg="fake2")
+    for _ in range(2):
+        with timed(seg_timer, "extraction"):
+            pass
+    with timed(None, "extraction"):
+        pass
+
+    table = timer.to_frame()
+    assert table.columns.tolist() == TIMING_COLUMNS
+    assert table[["run", "seg", "stage", "calls"]].to_numpy().tolist() == [
+        ["", "", "bids_index", 1],
+        ["task-rest_run-1", "fake2", "extraction", 2],
+    ]
+    assert table.loc[0, "seconds"] >= 0.01
+    assert (table["peak_rss_mb"] > 0).all()
+    assert timer.summary().startswith("sub-01: ")
+    assert "bids_index" in timer.summary()
+
+    path = tmp_path / "logs" / "sub-01_timing.tsv"
+    timer.write(path)
+    saved = pd.read_csv(path, sep="\t", na_filter=False)
+    assert saved["stage"].tolist() == ["bids_index", "extraction"]
@@ -0,0 +1,121 @@
+"""
+Check the processing path against nilearn on a synthetic fMRIPrep dataset.
+
+Usage::
+
+    python tools/benchmarks/equivalence.py WORK_DIR \
+        [--atlas Schaefer2018 ...] [--strategy simple ...] \
+        [--subjects 1] [--runs 1] [--volumes 100] [--resolution 2] \
+        [--smoothing-fwhm 5] [--atol 1e-4] [--rtol 1e-4] \
+        [--output equivalence.tsv]
+
+A dataset is generated in WORK_DIR with ``synthetic_fmriprep.py``, once
+per size, then each run is processed by the nilearn reference and by the
+fast path of the participant level, for each atlas and denoising
+strategy (all the presets by default), with
+:func:`giga_connectome.equivalence.compare_run`. The maximum absolute and
+relative errors of the time series and connectomes are reported with the
+speedup, and the script exits with status 1 when an error exceeds the
+tolerances.
+"""
+
+from __future__ import annotations
+
+import argparse
+import sys
+from pathlib import Path
+
+import pandas as pd
+from pipeline import dataset
+
+from giga_connectome import utils
+from giga_connectome.atlas import get_atlas_labels, load_atlas_setting
+from giga_connectome.context import build_subject_context
+from giga_connectome.denoise import PRESET_STRATEGIES, get_denoise_strategy
+from giga_connectome.equivalence import compare_run
+from giga_connectome.logger import gc_logger
+from giga_connectome.mask import generate_gm_mask_atlas
+
+gc_log = gc_logger()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("work_dir", type=Path)
+    parser.add_argument(
+        "--atlas", nargs="+", default=sorted(get_atlas_labels())
+    )
+    parser.add_argument("--strategy", nargs="+", default=PRESET_STRATEGIES)
+    parser.add_argument("--subjects", type=int, default=1)
+    parser.add_argument("--runs", type=int, default=1)
+    parser.add_argument("--volumes", type=int, default=100)
+    parser.add_argument("--resolution", type=float, default=2.0)
+    parser.add_argument("--smoothing-fwhm", type=float, default=5.0)
+    parser.add_argument("--atol", type=float, default=1e-4)
+    parser.add_argument("--rtol", type=float, default=1e-4)
+    parser.add_argument("--output", type=Path)
+    args = parser.parse_args()
+
+    args.work_dir.mkdir(parents=True, exist_ok=True)
+    bids_dir = dataset(
+        args.work_dir,
+        {
+            "n_subjects": args.subjects,
+            "n_runs": args.runs,
+            "n_volumes": args.volumes,
+            "resolution": args.resolution,
+            "ica_aroma": "icaaroma" in args.strategy,
+        },
+    )
+    atlases_dir = args.work_dir / "atlases"
+    tables = []
+    for strategy_name in args.strategy:
+        strategy = get_denoise_strategy(strategy_name)
+        template, bids_filters = utils.prepare_bidsfilter_and_template(
+            strategy, None
+        )
+        for subject in utils.get_subject_lists(None, bids_dir):
+            subj_data, _ = utils.get_bids_images(
+                [subject], template, bids_dir, False, bids_filters
+            )
+            for atlas_name in args.atlas:
+                atlas = load_atlas_setting(atlas_name)
+                mask, segs = generate_gm_mask_atlas(
+                    atlases_dir, atlas, template, subj_data["mask"]
+                )
+                context = build_subject_context(mask, segs)
+                for img in subj_data["bold"]:
+                    table = compare_run(
+                        strategy,
+                        context,
+                        img.path,
+                        smoothing_fwhm=args.smoothing_fwhm,
+                        atol=args.atol,
+                        rtol=args.rtol,
+                    )
+                    table.insert(0, "atlas", atlas_name)
+                    table.insert(0, "subject", f"sub-{subject}")
+                    tables.append(table)
+    results = pd.concat(tables, ignore_index=True)
+    if args.output is not None:
+        results.to_csv(args.output, sep="\t", index=False)
+        gc_log.info(f"Results saved to {args.output}")
+
+    summary = results.groupby(["strategy", "atlas", "output"]).agg(
+        max_abs_error=("max_abs_error", "max"),
+        max_rel_error=("max_rel_error", "max"),
+        speedup=("speedup", "median"),
+        passed=("passed", "all"),
+    )
+    gc_log.info("\n" + summary.to_string(float_format="%.3g"))
+    failed = results[~results["passed"]]
+    if len(failed):
+        gc_log.error(
+            f"{len(failed)} outputs exceed the tolerances (atol "
+            f"{args.atol}, rtol {args.rtol})."
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Benchmark the gzip decompression backends used to read the BOLD images.
+
+Usage::
+
+    python tools/benchmarks/gzip_backends.py [BOLD.nii.gz] [--repeat N]
+
+Without a BOLD image, a synthetic one of the size of a typical fMRIPrep
+output (97 x 115 x 97 voxels, 300 volumes) is written to a temporary
+directory.
+"""
+
+from __future__ import annotations
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+
+from giga_connectome.loader import available_gzip_backends, open_bold
+from giga_connectome.logger import gc_logger
+
+gc_log = gc_logger()
+
+
+def _synthetic_bold(path: Path, shape: tuple[int, ...]) -> Path:
+    rng = np.random.default_rng(0)
+    data = rng.normal(1000, 50, shape).astype(np.int16)
+    nib.save(nib.Nifti1Image(data, np.diag([2.0, 2.0, 2.0, 1.0])), path)
+    return path
+
+
+def benchmark(img: Path, repeat: int) -> dict[str, float]:
+    """Best time in seconds to read the whole image with each backend."""
+    timings = {}
+    reference = None
+    for backend in available_gzip_backends():
+        best = np.inf
+        for _ in range(repeat):
+            start = time.perf_counter()
+            with open_bold(img, backend) as bold:
+                data = np.asarray(bold.dataobj)
+            best = min(best, time.perf_counter() - start)
+        if reference is None:
+            reference = data
+        elif not np.array_equal(reference, data):
+            raise RuntimeError(f"{backend} does not decode {img} identically.")
+        timings[backend] = best
+    return timings
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("bold", nargs="?", type=Path)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--shape", type=int, nargs=4, default=(97, 115, 97, 300)
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        img = args.bold or _synthetic_bold(
+            Path(tmp) / "bold.nii.gz", tuple(args.shape)
+        )
+        timings = benchmark(img, args.repeat)
+    baseline = timings["zlib"]
+    for backend, seconds in timings.items():
+        gc_log.info(
+            f"{backend:>12}: {seconds:.2f} s ({baseline / seconds:.1f}x zlib)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""
+Time the stages of the participant level on a synthetic fMRIPrep dataset.
+
+Usage::
+
+    python tools/benchmarks/pipeline.py WORK_DIR \
+        [--atlas Schaefer2018 ...] [--strategy simple ...] \
+        [--subjects 2] [--runs 2] [--volumes 200] [--resolution 2] \
+        [--output results.json] [-- OPTIONS OF GIGA_CONNECTOME]
+
+A dataset is generated in WORK_DIR with ``synthetic_fmriprep.py``, once
+per size, then each atlas and denoising strategy (all the presets by
+default) is processed by the ``giga_connectome`` command in its own
+process. The time of each stage is read from the timing tables in
+``logs``, summed over the subjects and runs, with the wall time and the
+peak memory of the process. The grey matter masks and the resampled
+atlases are computed by the first strategy of each atlas and reused by
+the others, as in a normal run. Timings depend on the machine, so only
+compare results measured on the same one.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Any
+
+import nilearn
+import numpy as np
+import pandas as pd
+from synthetic_fmriprep import make_dataset
+
+from giga_connectome._version import __version__
+from giga_connectome.atlas import get_atlas_labels
+from giga_connectome.denoise import PRESET_STRATEGIES
+from giga_connectome.logger import gc_logger
+
+gc_log = gc_logger()
+
+
+def dataset(work_dir: Path, config: dict[str, Any]) -> Path:
+    """Generate the synthetic dataset, or reuse the one of this size."""
+    name = (
+        f"fmriprep_sub-{config['n_subjects']}_run-{config['n_runs']}"
+        f"_vol-{config['n_volumes']}_res-{config['resolution']:g}"
+        f"{'_aroma' if config['ica_aroma'] else ''}"
+    )
+    path = work_dir / name
+    if path.exists():
+        gc_log.info(f"Reusing the synthetic dataset {path}")
+        return path
+    tmp_path = work_dir / f"{name}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    make_dataset(tmp_path, **config)
+    tmp_path.rename(path)
+    return path
+
+
+def run(
+    bids_dir: Path,
+    work_dir: Path,
+    atlas: str,
+    strategy: str,
+    options: list[str],
+) -> dict[str, Any]:
+    """Process the dataset with an atlas and strategy.
+
+    Returns
+    -------
+    dict
+        Wall time in seconds, peak resident set size in MB, and seconds
+        of each stage summed over the subjects and runs.
+    """
+    output_dir = work_dir / "outputs" / f"{atlas}_{strategy}"
+    shutil.rmtree(output_dir, ignore_errors=True)
+    command = [
+        "giga_connectome",
+        str(bids_dir),
+        str(output_dir),
+        "participant",
+        "--atlases-dir",
+        str(work_dir / "atlases" / atlas),
+        "--atlas",
+        atlas,
+        "--denoise-strategy",
+        strategy,
+        *options,
+    ]
+    gc_log.info(" ".join(command))
+    start = time.perf_counter()
+    subprocess.run(command, check=True)
+    wall = time.perf_counter() - start
+    timing = pd.concat(
+        [
+            pd.read_csv(path, sep="\t")
+            for path in sorted((output_dir / "logs").glob("*_timing.tsv"))
+        ]
+    )
+    stages = timing.groupby("stage")["seconds"].sum()
+    return {
+        "wall_seconds": wall,
+        "peak_rss_mb": float(timing["peak_rss_mb"].max()),
+        "stages": {stage: float(seconds) for stage, seconds in stages.items()},
+    }
+
+
+def environment() -> dict[str, Any]:
+    """Machine and versions of the results."""
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "giga_connectome": __version__,
+        "nilearn": nilearn.__version__,
+        "numpy": np.__version__,
+    }
+
+
+def main() -> None:
+    argv = sys.argv[1:]
+    options = []
+    if "--" in argv:
+        options = argv[argv.index("--") + 1 :]
+        argv = argv[: argv.index("--")]
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("work_dir", type=Path)
+    parser.add_argument(
+        "--atlas", nargs="+", default=sorted(get_atlas_labels())
+    )
+    parser.add_argument("--strategy", nargs="+", default=PRESET_STRATEGIES)
+    parser.add_argument("--subjects", type=int, default=2)
+    parser.add_argument("--runs", type=int, default=2)
+    parser.add_argument("--volumes", type=int, default=200)
+    parser.add_argument("--resolution", type=float, default=2.0)
+    parser.add_argument("--output", type=Path)
+    args = parser.parse_args(argv)
+
+    if shutil.which("giga_connectome") is None:
+        parser.error("Install giga_connectome to run the benchmark.")
+    config = {
+        "n_subjects": args.subjects,
+        "n_runs": args.runs,
+        "n_volumes": args.volumes,
+        "resolution": args.resolution,
+        "ica_aroma": "icaaroma" in args.strategy,
+    }
+    args.work_dir.mkdir(parents=True, exist_ok=True)
+    bids_dir = dataset(args.work_dir, config)
+    # masks and atlases are timed by the first strategy of each atlas
+    shutil.rmtree(args.work_dir / "atlases", ignore_errors=True)
+    results: dict[str, Any] = {
+        "environment": environment(),
+        "dataset": config,
+        "options": options,
+        "runs": {},
+    }
+    for atlas in args.atlas:
+        for strategy in args.strategy:
+            key = f"{atlas}/{strategy}"
+            results["runs"][key] = run(
+                bids_dir, args.work_dir, atlas, strategy, options
+            )
+            gc_log.info(f"{key}: {results['runs'][key]['wall_seconds']:.1f} s")
+
+    if args.output is not None:
+        args.output.write_text(json.dumps(results, indent=2))
+        gc_log.info(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+"""
+Generate a synthetic fMRIPrep derivative dataset for benchmarks.
+
+Usage::
+
+    python tools/benchmarks/synthetic_fmriprep.py OUTPUT_DIR \
+        [--subjects 2] [--runs 2] [--volumes 200] [--resolution 2] \
+        [--ica-aroma]
+
+The images are on the MNI152NLin2009cAsym grid at the requested
+resolution (97 x 115 x 97 voxels at 2 mm), with an ellipsoid brain mask.
+The BOLD signal mixes smooth spatial networks with noise, and is
+written volume by volume so generating large datasets needs little
+memory. The confounds tables cover the columns of all the preset
+denoising strategies, including the aCompCor metadata, and the
+framewise displacement has outliers so scrubbing removes volumes.
+"""
+
+from __future__ import annotations
+
+import argparse
+import gzip
+import json
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+from scipy.ndimage import gaussian_filter
+
+from giga_connectome.logger import gc_logger
+
+gc_log = gc_logger()
+
+# MNI152NLin2009cAsym at 2 mm
+TEMPLATE_SHAPE = np.array([97, 115, 97])
+TEMPLATE_ORIGIN = np.array([-96.0, -132.0, -78.0])
+TEMPLATE_RESOLUTION = 2.0
+MOTION = ["trans_x", "trans_y", "trans_z", "rot_x", "rot_y", "rot_z"]
+N_NETWORKS = 10
+N_COMPCOR = 50
+N_AROMA = 10
+
+
+def template_grid(resolution: float) -> tuple[tuple[int, ...], np.ndarray]:
+    """Shape and affine of the MNI152NLin2009cAsym grid at a resolution."""
+    shape = np.round(TEMPLATE_SHAPE * TEMPLATE_RESOLUTION / resolution)
+    affine = np.diag([resolution, resolution, resolution, 1.0])
+    affine[:3, 3] = TEMPLATE_ORIGIN
+    return tuple(int(size) for size in shape), affine
+
+
+def brain_mask(shape: tuple[int, ...], affine: np.ndarray) -> np.ndarray:
+    """Ellipsoid roughly covering the brain in MNI space."""
+    center = np.array([0.0, -18.0, 15.0])
+    radii = np.array([68.0, 88.0, 65.0])
+    grid = np.indices(shape).reshape(3, -1).T
+    world = grid @ affine[:3, :3].T + affine[:3, 3]
+    inside = (((world - center) / radii) ** 2).sum(axis=1) <= 1
+    return inside.reshape(shape).astype(np.uint8)
+
+
+def confounds_table(
+    n_volumes: int,
+    rng: np.random.Generator,
+    outlier_fraction: float = 0.1,
+    n_non_steady: int = 2,
+) -> tuple[pd.DataFrame, dict[str, dict[str, object]]]:
+    """Confounds table of fMRIPrep and its json sidecar.
+
+    A fraction of the volumes have a framewise displacement above 0.5 mm
+    and a high standardized DVARS, so the scrubbing strategies censor
+    them.
+    """
+    confounds = {}
+    for name in [*MOTION, "white_matter", "csf", "global_signal"]:
+        base = rng.standard_normal(n_volumes).cumsum() * 0.01
+        derivative = np.concatenate([[np.nan], np.diff(base)])
+        confounds[name] = base
+        confounds[f"{name}_derivative1"] = derivative
+        confounds[f"{name}_power2"] = base**2
+        confounds[f"{name}_derivative1_power2"] = derivative**2
+    time = np.arange(n_volumes)
+    # discrete cosine basis of a 128 s high pass filter, TR of 2 s
+    for i in range(max(1, n_volumes * 2 // 128)):
+        confounds[f"cosine{i:02d}"] = np.cos(
+            np.pi * (i + 1) * (time + 0.5) / n_volumes
+        )
+    metadata: dict[str, dict[str, object]] = {}
+    variance = np.sort(rng.uniform(0.001, 0.05, N_COMPCOR))[::-1]
+    for i in range(N_COMPCOR):
+        confounds[f"a_comp_cor_{i:02d}"] = rng.standard_normal(n_volumes)
+        metadata[f"a_comp_cor_{i:02d}"] = {
+            "Method": "aCompCor",
+            "Mask": "combined",
+            "Retained": True,
+            "VarianceExplained": float(variance[i]),
+            "CumulativeVarianceExplained": float(variance[: i + 1].sum()),
+            "SingularValue": float(variance[i] * 100),
+        }
+    framewise_displacement = rng.uniform(0.02, 0.18, n_volumes)
+    std_dvars = rng.uniform(0.8, 1.2, n_volumes)
+    n_outliers = round(outlier_fraction * n_volumes)
+    outliers = rng.choice(n_volumes, n_outliers, replace=False)
+    framewise_displacement[outliers] = rng.uniform(0.6, 1.2, n_outliers)
+    std_dvars[outliers] = rng.uniform(1.6, 3.0, n_outliers)
+    framewise_displacement[0] = np.nan
+    std_dvars[0] = np.nan
+    confounds["framewise_displacement"] = framewise_displacement
+    confounds["std_dvars"] = std_dvars
+    # noise components of ICA-AROMA, already regressed out of its outputs
+    for i in range(N_AROMA):
+        confounds[f"aroma_motion_{i:02d}"] = rng.standard_normal(n_volumes)
+    for i in range(n_non_steady):
+        non_steady_state = np.zeros(n_volumes)
+        non_steady_state[i] = 1
+        confounds[f"non_steady_state_outlier{i:02d}"] = non_steady_state
+    return pd.DataFrame(confounds), metadata
+
+
+def write_bold(
+    path: Path,
+    mask: np.ndarray,
+    affine: np.ndarray,
+    n_volumes: int,
+    rng: np.random.Generator,
+    repetition_time: float = 2.0,
+) -> None:
+    """Write a BOLD image one volume at a time.
+
+    The signal is a mix of smooth spatial networks driven by random
+    time courses, plus noise, on a baseline of 1000 within the mask.
+    The data are stored as scaled int16, as fMRIPrep does.
+    """
+    shape = mask.shape
+    networks = np.stack(
+        [
+            gaussian_filter(rng.standard_normal(shape), 4).astype(np.float32)
+            for _ in range(N_NETWORKS)
+        ]
+    )
+    networks *= mask / np.abs(networks).max(axis=(1, 2, 3), keepdims=True)
+    time_courses = gaussian_filter(
+        rng.standard_normal((N_NETWORKS, n_volumes)), (0, 2)
+    ).astype(np.float32)
+
+    header = nib.Nifti1Header()
+    header.set_data_shape((*shape, n_volumes))
+    header.set_data_dtype(np.int16)
+    header.set_qform(affine, code=1)
+    header.set_sform(affine, code=1)
+    header.set_xyzt_units("mm", "sec")
+    header["pixdim"][4] = repetition_time
+    header["scl_slope"] = 0.1
+    header["scl_inter"] = 0
+    header["vox_offset"] = 352
+    baseline = 1000 * mask.astype(np.float32)
+    with gzip.open(path, "wb", compresslevel=1) as f:
+        f.write(header.binaryblock)
+        # no extension
+        f.write(b"\x00" * 4)
+        for t in range(n_volumes):
+            volume = (
+                baseline
+                + np.tensordot(time_courses[:, t], networks, axes=1) * 50
+            )
+            volume += rng.standard_normal(shape, dtype=np.float32) * 20
+            # stored value = real value / slope
+            f.write(np.round(volume * 10).astype("<i2").tobytes(order="F"))
+
+
+def make_dataset(
+    output_dir: Path,
+    n_subjects: int = 2,
+    n_runs: int = 2,
+    n_volumes: int = 200,
+    resolution: float = 2.0,
+    ica_aroma: bool = False,
+    outlier_fraction: float = 0.1,
+    seed: int = 0,
+) -> Path:
+    """Write a synthetic fMRIPrep derivative dataset.
+
+    Parameters
+    ----------
+    output_dir : pathlib.Path
+        Root of the dataset.
+
+    n_subjects, n_runs, n_volumes : int
+        Number of subjects, resting state runs per subject and volumes
+        per run.
+
+    resolution : float
+        Voxel size in mm.
+
+    ica_aroma : bool
+        Also write the ICA-AROMA denoised BOLD images, on the same grid,
+        for the ``icaaroma`` strategy.
+
+    outlier_fraction : float
+        Fraction of the volumes with a framewise displacement above the
+        scrubbing thresholds.
+
+    seed : int
+        Seed of the random generator.
+
+    Returns
+    -------
+    pathlib.Path
+        ``output_dir``.
+    """
+    rng = np.random.default_rng(seed)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    (output_dir / "dataset_description.json").write_text(
+        json.dumps(
+            {
+                "Name": "synthetic",
+                "BIDSVersion": "1.9.0",
+                "DatasetType": "derivative",
+                "GeneratedBy": [{"Name": "fMRIPrep"}],
+            },
+            indent=4,
+        )
+    )
+    shape, affine = template_grid(resolution)
+    mask = brain_mask(shape, affine)
+    res = "_res-2" if resolution == TEMPLATE_RESOLUTION else ""
+    for subject in range(1, n_subjects + 1):
+        func = output_dir / f"sub-{subject:02d}" / "func"
+        func.mkdir(parents=True, exist_ok=True)
+        for run in range(1, n_runs + 1):
+            prefix = f"sub-{subject:02d}_task-rest_run-{run}"
+            space = f"space-MNI152NLin2009cAsym{res}"
+            gc_log.info(f"Writing {prefix}")
+            bolds = [f"{prefix}_{space}_desc-preproc_bold"]
+            if ica_aroma:
+                bolds.append(
+                    f"{prefix}_space-MNI152NLin6Asym{res}"
+                    "_desc-smoothAROMAnonaggr_bold"
+                )
+            for bold in bolds:
+                write_bold(
+                    func / f"{bold}.nii.gz", mask, affine, n_volumes, rng
+                )
+                (func / f"{bold}.json").write_text(
+                    json.dumps({"RepetitionTime": 2.0, "TaskName": "rest"})
+                )
+            nib.save(
+                nib.Nifti1Image(mask, affine),
+                func / f"{prefix}_{space}_desc-brain_mask.nii.gz",
+            )
+            confounds, metadata = confounds_table(
+                n_volumes, rng, outlier_fraction
+            )
+            confounds.to_csv(
+                func / f"{prefix}_desc-confounds_timeseries.tsv",
+                sep="\t",
+                index=False,
+                na_rep="n/a",
+            )
+            (func / f"{prefix}_desc-confounds_timeseries.json").write_text(
+                json.dumps(metadata, indent=4)
+            )
+    return output_dir
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("output_dir", type=Path)
+    parser.add_argument("--subjects", type=int, default=2)
+    parser.add_argument("--runs", type=int, default=2)
+    parser.add_argument("--volumes", type=int, default=200)
+    parser.add_argument("--resolution", type=float, default=2.0)
+    parser.add_argument("--ica-aroma", action="store_true")
+    parser.add_argument("--outlier-fraction", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    make_dataset(
+        args.output_dir,
+        args.subjects,
+        args.runs,
+        args.volumes,
+        args.resolution,
+        args.ica_aroma,
+        args.outlier_fraction,
+        args.seed,
+    )
+
+
+if __name__ == "__main__":
+    main()